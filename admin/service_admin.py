@@ -6,7 +6,9 @@ from django.utils.translation import gettext_lazy as _
 from django.urls import reverse
 from django.contrib.admin import widgets
 from django.contrib.admin.options import get_ul_class
-from .models import Attachment, Customer, Location, EmployeeWorkBlock, Job, ServiceTicket, Settings
+from .models import (
+    Attachment, Customer, Location, EmployeeWorkBlock, Job, ServiceTicket, ServiceTicketExport, Settings
+)
 
 class ServiceTicketGeneralInfo:
 
@@ -99,7 +101,7 @@ class ServiceTicketAdmin(ServiceTicketGeneralInfo, admin.ModelAdmin):
             kwargs['queryset'] = Job.objects.filter(status=1).order_by('-number')
         return super().formfield_for_foreignkey(db_field, request, **kwargs)
     
-    readonly_fields = ('is_archive', 'requester', 'approval',)
+    readonly_fields = ('is_archive', 'requester', 'approval',) + ServiceTicket.TOTALS_FIELDS
     search_fields = ['id']
     inlines = (EmployeeWorkBlockInLine, AttachmentInLine,)
 
@@ -115,6 +117,13 @@ class LocationAdmin(admin.ModelAdmin):
     pass
 
 
+@admin.register(ServiceTicketExport)
+class ServiceTicketExportAdmin(admin.ModelAdmin):
+    list_display = ('id', 'job', 'requested_by', 'status', 'processed', 'total', 'created_at', 'finished_at')
+    list_filter = ('status',)
+    readonly_fields = ('job', 'requested_by', 'total', 'processed', 'file', 'error', 'started_at', 'finished_at')
+
+
 @admin.register(LogEntry)
 class LogEntryAdmin(admin.ModelAdmin):
 
@@ -0,0 +1,121 @@
+import json
+import logging
+from contextlib import contextmanager
+from threading import local
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+
+class BeamsPublisher:
+    """
+    Publishes Pusher Beams notifications through one pooled HTTP session.
+
+    Inside batch() the publishes are collected and the ones with the same body
+    are sent together, split into the largest requests Beams accepts.
+    base_url (BEAMS_BASE_URL) can point the publisher at a fake server for load tests.
+    """
+    USERS = 'users'
+    INTERESTS = 'interests'
+    # Beams limits of a single publish request
+    MAX_TARGETS = {USERS: 1000, INTERESTS: 100}
+
+    def __init__(self, instance_id=None, secret_key=None, base_url=None, pool_size=None, retries=None,
+                 backoff_factor=None, timeout=None):
+        self.instance_id = instance_id or getattr(settings, 'BEAMS_INSTANCE_ID', '')
+        self.secret_key = secret_key or getattr(settings, 'BEAMS_SECRET_KEY', '')
+        self.base_url = (
+            base_url or getattr(settings, 'BEAMS_BASE_URL', None)
+            or f'https://{self.instance_id}.pushnotifications.pusher.com'
+        ).rstrip('/')
+        self.pool_size = pool_size or getattr(settings, 'BEAMS_POOL_SIZE', 10)
+        self.retries = getattr(settings, 'BEAMS_RETRIES', 3) if retries is None else retries
+        self.backoff_factor = getattr(settings, 'BEAMS_BACKOFF_FACTOR', 0.5) if backoff_factor is None else backoff_factor
+        self.timeout = timeout or getattr(settings, 'BEAMS_TIMEOUT', 10)
+        self._session = None
+        self._local = local()
+
+    @property
+    def session(self):
+        if self._session is None:
+            retry = Retry(
+                total=self.retries,
+                backoff_factor=self.backoff_factor,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=frozenset(['POST']),
+                respect_retry_after_header=True,
+            )
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers.update({
+                'Authorization': f'Bearer {self.secret_key}',
+                'Content-Type': 'application/json',
+            })
+            self._session = session
+        return self._session
+
+    def publish_to_users(self, user_ids, publish_body):
+        return self._publish(self.USERS, [str(user_id) for user_id in user_ids], publish_body)
+
+    def publish_to_interests(self, interests, publish_body):
+        return self._publish(self.INTERESTS, list(interests), publish_body)
+
+    @contextmanager
+    def batch(self):
+        """
+        Collect the publishes of the block and send them grouped when it exits.
+        Nothing is sent when the block raises, e.g. its transaction rolled back.
+        """
+        depth = getattr(self._local, 'depth', 0)
+        if depth == 0:
+            self._local.pending = {}
+        self._local.depth = depth + 1
+        try:
+            yield self
+        except BaseException:
+            if depth == 0:
+                self._local.pending = {}
+            raise
+        finally:
+            self._local.depth = depth
+            if depth == 0:
+                pending, self._local.pending = self._local.pending, None
+                self._flush(pending)
+
+    def _publish(self, target, ids, publish_body):
+        pending = getattr(self._local, 'pending', None)
+        if pending is None:
+            return self._send(target, ids, publish_body)
+        key = (target, json.dumps(publish_body, sort_keys=True))
+        _body, targets = pending.setdefault(key, (publish_body, {}))
+        targets.update(dict.fromkeys(ids))
+        return []
+
+    def _flush(self, pending):
+        for (target, _key), (publish_body, targets) in pending.items():
+            try:
+                self._send(target, list(targets), publish_body)
+            except requests.RequestException:
+                logger.exception('Beams publish to %s %s failed', len(targets), target)
+
+    def _send(self, target, ids, publish_body):
+        """Send one request per MAX_TARGETS ids, returns the publish ids."""
+        url = f'{self.base_url}/publish_api/v1/instances/{self.instance_id}/publishes/{target}'
+        size = self.MAX_TARGETS[target]
+        publish_ids = []
+        for start in range(0, len(ids), size):
+            response = self.session.post(
+                url, data=json.dumps({**publish_body, target: ids[start:start + size]}), timeout=self.timeout
+            )
+            response.raise_for_status()
+            publish_ids.append(response.json().get('publishId'))
+        return publish_ids
+
+
+beams_publisher = BeamsPublisher()
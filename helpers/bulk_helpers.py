@@ -0,0 +1,29 @@
+def parse_ids(ids):
+    """Return the values of the request ids list that can be used as primary keys."""
+    pks = []
+    for value in ids:
+        try:
+            pks.append(int(value))
+        except (TypeError, ValueError):
+            pass
+    return pks
+
+
+def split_ids(ids, existing_pks):
+    """
+    Split the request ids into found and not found ones.
+    Keeps the request order and the original values for the response report.
+    """
+    success_ids = []
+    error_ids = []
+    for value in ids:
+        try:
+            pk = int(value)
+        except (TypeError, ValueError):
+            error_ids.append(value)
+            continue
+        if pk in existing_pks:
+            success_ids.append(value)
+        else:
+            error_ids.append(value)
+    return success_ids, error_ids
@@ -2,13 +2,16 @@
 import string
 import random
 import re
+from functools import lru_cache
 
 import pytz
 from dacite import from_dict
-from django.utils.safestring import SafeString
+from django.utils.safestring import SafeString, mark_safe
 from django.template.loader import render_to_string
 from dateutil.parser import parse
-from django.utils.translation import gettext as _
+from django.conf import settings
+from django.template.loader import get_template
+from django.utils.translation import gettext as _, get_language
 
 from utils.entities.row_render import RowData
 
@@ -21,33 +24,77 @@ def split_camel_case(text):
     return label.capitalize()
 
 
+@lru_cache(maxsize=None)
+def _compiled_template(template_name):
+    return get_template(template_name)
+
+
+def fragment(template_name):
+    """
+    Compiled template of a flattening fragment, looked up once per process.
+    With DEBUG the lookup is repeated so template edits are picked up.
+    """
+    if settings.DEBUG:
+        return get_template(template_name)
+    return _compiled_template(template_name)
+
+
+# typed: a SafeString title must not share the entry of the escaped str one
+@lru_cache(maxsize=2048, typed=True)
+def _rendered_fragment(template_name, context_key, value, language):
+    return fragment(template_name).render({context_key: value} if context_key else {})
+
+
+def render_fragment(template_name, context_key=None, value=None):
+    """
+    Render a fragment which output only depends on one string (or nothing),
+    e.g. the section heads: repeated renders come from memory.
+    """
+    if settings.DEBUG or not isinstance(value, (str, type(None))):
+        return fragment(template_name).render({context_key: value} if context_key else {})
+    return _rendered_fragment(template_name, context_key, value, get_language())
+
+
 class Render:
     """Helper class to render templates"""
     @staticmethod
     def row(row_data):
-        return render_to_string('row.html', {'data': row_data})
+        return fragment('row.html').render({'data': row_data})
 
     @staticmethod
     def sub_head(row_data):
-        return render_to_string('sub_head.html', {'data': row_data})
+        return render_fragment('sub_head.html', 'data', row_data)
 
     @staticmethod
     def subtitle(title):
-        return render_to_string('sub_title.html', {'title': title})
+        return render_fragment('sub_title.html', 'title', title)
 
     @staticmethod
     def divider():
-        return render_to_string('divider.html')
+        return render_fragment('divider.html')
 
     @staticmethod
     def end_sub_head():
-        return render_to_string('end_sub_head.html', {})
+        return render_fragment('end_sub_head.html')
 
     @staticmethod
     def table(fhir_resources, render_template='bundle_render.html'):
         """ Render data using django template system, return html string"""
         return render_to_string(render_template, {'fhir_data': fhir_resources}).encode('utf-8')
 
+    @staticmethod
+    def stream_table(rows, render_template='bundle_render.html'):
+        """
+        Same html as table(), yielded piece by piece: the template is rendered once
+        around a placeholder row, rows (e.g. JsonHelper.iter_flatten()) go in its place.
+        """
+        marker = f'<!--{generate_random_200_id()}-->'
+        head, tail = render_to_string(render_template, {'fhir_data': [mark_safe(marker)]}).split(marker, 1)
+        yield head
+        for row in rows:
+            yield str(row)
+        yield tail
+
 
 def save_html_render(html, save_path):
     """Save html string on file"""
@@ -90,11 +137,14 @@ def is_string(value):
 
 
 def get_resource_references(resource_ref_path):
-    from apps.healthcare.models import FhirResource
+    from apps.healthcare.models import FhirReference, FhirResource
     from utils.helpers.label import LabelUtil
-    results: list[FhirResource] = FhirResource.objects.filter(
-        resource_json__icontains=resource_ref_path
-    ).exclude(resource_type="Bundle").all()
+    target = FhirReference.parse(resource_ref_path)
+    if target:
+        results = FhirReference.referencing_resources(*target)
+    else:
+        results = FhirResource.objects.filter(resource_json__icontains=resource_ref_path)
+    results: list[FhirResource] = results.exclude(resource_type="Bundle").all()
     references = []
     for result in results:
         res_type = result.resource_json.get("resourceType")
@@ -0,0 +1,60 @@
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ZipStreamBuffer:
+    """
+    Write-only file object for zipfile.
+    It has no seek(), so zipfile writes entries with data descriptors
+    and the written bytes can be handed over to the client right away.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_zip(entries, compression=zipfile.ZIP_DEFLATED):
+    """
+    Yield a ZIP archive chunk by chunk from (name, data) pairs.
+    Only the entry being written is kept in memory.
+    """
+    buffer = ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, mode='w', compression=compression) as zip_file:
+        for name, data in entries:
+            zip_file.writestr(name, data)
+            yield buffer.pop()
+    yield buffer.pop()
+
+
+def bounded_map(func, items, max_workers):
+    """
+    Run func over items in a thread pool and yield the results in the items order.
+    At most 2 * max_workers items are in flight, so memory does not grow with
+    the number of items.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= max_workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
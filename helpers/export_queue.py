@@ -0,0 +1,95 @@
+import logging
+import tempfile
+
+from celery import shared_task
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.utils import timezone
+
+from .export_helpers import stream_zip
+
+logger = logging.getLogger(__name__)
+
+# The number of exports built at the same time is the concurrency of the
+# workers consuming this queue, e.g. `celery worker -Q exports --concurrency 2`.
+EXPORT_QUEUE = getattr(settings, 'SERVICE_TICKET_EXPORT_QUEUE', 'exports')
+# exports still queued or running after this many seconds are failed by ServiceTicketExport.fail_stale
+EXPORT_TIMEOUT = getattr(settings, 'SERVICE_TICKET_EXPORT_TIMEOUT', 60 * 60)
+
+
+def write_zip_file(entries, progress=None):
+    """
+    Write a ZIP archive from (name, data) pairs into a temporary file.
+    progress is called with the number of entries written so far.
+    """
+    zip_file = tempfile.TemporaryFile()
+    for chunk in stream_zip(_count_entries(entries, progress)):
+        zip_file.write(chunk)
+    zip_file.seek(0)
+    return zip_file
+
+
+def _count_entries(entries, progress):
+    for count, entry in enumerate(entries, 1):
+        yield entry
+        if progress:
+            progress(count)
+
+
+def build_service_ticket_export(export_id):
+    """Render the Service Tickets of the export Job and store the ZIP archive."""
+    from apps.api.models import ServiceTicketExport
+    from apps.api.views import ServiceTicketExportView
+
+    exports = ServiceTicketExport.objects.filter(pk=export_id)
+    claimed = exports.filter(status=ServiceTicketExport.QUEUED).update(
+        status=ServiceTicketExport.RUNNING, started_at=timezone.now()
+    )
+    if not claimed:
+        return  # already picked up, cancelled or timed out
+    export = exports.get()
+
+    def progress(count):
+        if count % 10 == 0:
+            exports.update(processed=count)
+
+    try:
+        service_tickets = ServiceTicketExportView.get_export_queryset(export.job_id)
+        failed = []
+        entries = ServiceTicketExportView().iter_pdf_entries(service_tickets, failed)
+        with write_zip_file(entries, progress) as zip_file:
+            export.file.save(f'job-{export.job_id}-service-tickets-{export.id}.zip', File(zip_file), save=False)
+        export.status = ServiceTicketExport.DONE
+        export.processed = export.total - len(failed)
+        if failed:
+            export.error = 'PDF rendering failed for Service Tickets: {}'.format(', '.join(map(str, failed)))
+    except Exception as exc:
+        logger.exception('Service ticket export %s failed', export_id)
+        export.status = ServiceTicketExport.FAILED
+        export.error = str(exc)
+    export.finished_at = timezone.now()
+    export.save(update_fields=['status', 'processed', 'file', 'error', 'finished_at'])
+
+
+# the hard limit kills a stuck build, fail_stale then releases the export of its requester
+@shared_task(time_limit=EXPORT_TIMEOUT)
+def export_service_tickets(export_id):
+    build_service_ticket_export(export_id)
+
+
+def enqueue_service_ticket_export(export):
+    """
+    Hand the export over to the configured backend.
+    'celery' sends it to the exports queue once the transaction commits,
+    'local' builds it in the current process (used in tests and development).
+    """
+    backend = getattr(settings, 'SERVICE_TICKET_EXPORT_BACKEND', 'celery')
+    if backend == 'local':
+        build_service_ticket_export(export.id)
+    elif backend == 'celery':
+        transaction.on_commit(
+            lambda: export_service_tickets.apply_async((export.id,), queue=EXPORT_QUEUE)
+        )
+    else:
+        raise ValueError(f'Unknown export backend: {backend}')
@@ -0,0 +1,53 @@
+from uuid import uuid4
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.translation import get_language
+
+
+class FhirRenderCache:
+    """
+    Cache of the HTML rendered for stored FHIR resources.
+
+    Entries are keyed by the resource, its fetched_at, the user, the language
+    and the timezone of the page. Saving the resource drops its version, so
+    the stale renders can't be reached anymore and simply expire.
+    """
+
+    @staticmethod
+    def _version_key(resource_pk):
+        return f'fhir_render_version_{resource_pk}'
+
+    @classmethod
+    def _key(cls, db_resource, user, user_tz):
+        version_key = cls._version_key(db_resource.pk)
+        version = cache.get(version_key)
+        if version is None:
+            version = uuid4().hex
+            cache.set(version_key, version, None)
+        fetched = db_resource.fetched_at.timestamp() if db_resource.fetched_at else ''
+        return f'fhir_render_{db_resource.pk}_{version}_{fetched}_{user.pk}_{get_language()}_{user_tz or ""}'
+
+    @classmethod
+    def get(cls, db_resource, user, user_tz):
+        return cache.get(cls._key(db_resource, user, user_tz))
+
+    @classmethod
+    def set(cls, db_resource, user, user_tz, html):
+        timeout = getattr(settings, 'FHIR_RENDER_CACHE_TIMEOUT', 24 * 60 * 60)
+        cache.set(cls._key(db_resource, user, user_tz), html, timeout)
+
+    @classmethod
+    def invalidate(cls, resource_pks):
+        cache.delete_many([cls._version_key(pk) for pk in resource_pks])
+
+
+async def render_cached(db_resource, user, user_tz, render):
+    """Return the cached HTML of db_resource, render() is awaited on a miss."""
+    # the cache calls block, they run in the sync thread instead of the event loop
+    html = await sync_to_async(FhirRenderCache.get)(db_resource, user, user_tz)
+    if html is None:
+        html = await render()
+        await sync_to_async(FhirRenderCache.set)(db_resource, user, user_tz, html)
+    return html
@@ -1,8 +1,10 @@
 from dataclasses import dataclass, field
-from typing import Union, TypeVar
+from functools import lru_cache
+from typing import NamedTuple, Optional, Union, TypeVar
 
 from dacite import from_dict
-from django.utils.translation import gettext as _
+from django.conf import settings
+from django.utils.translation import gettext as _, get_language
 from fhir.constraints import Constraints
 from fhir.datatypes.extension import Extension
 from fhir.datatypes.complex.attachment import Attachment
@@ -50,17 +52,12 @@ class JsonHelper:
     constrains: Constraints = Constraints()
 
     def start_flattening(self):
-        self.flatten_resource(
-            json_obj=self.resource.json_resource,
-            json_path=self.resource.resourceType,
-            profile=self.resource.meta_profile
-        )
+        self.flattened_values = list(self.iter_flatten())
 
     @decorate_flat_value
     def handle_property(self, json_obj, json_path, profile):
         """Handle a final value of the json: ie: string, int"""
-        label = LabelUtil.get_label(profile, json_path)
-        # print(json_path)
+        label = get_label(profile, json_path)
         json_obj = format_date(str(json_obj))
         row = Render.row(
             {'label': label, 'value': _(str(json_obj))})
@@ -90,126 +87,332 @@ class JsonHelper:
                 self.flatten_resource(json_obj[key], f"{json_path}.{key}", profile)
 
     def iter_dict_list(self, json_obj, json_path, profile):
+        is_divided = classify_path(json_path).is_divided
         for entry in json_obj:
             self.flatten_resource(entry, json_path, profile)
-            if json_path.split('.')[-1] in ['performer', 'participant', 'activity', 'section']:
+            if is_divided:
                 self.flattened_values.append(Render.divider())
 
     def create_section(self, json_obj, json_path, profile):
-        profiler = ProfileHandler(profile)
-        # get profile for this path
-        _profile = String.profile_id(profiler.search_profile(json_path))
-        # get base path for this new profile
-        base_path = profiler.search_type(json_path)
-        if _profile and base_path:
-            head_label = LabelUtil.get_label(_profile, base_path)
-        else:
-            head_label = LabelUtil.get_label(profile_name=profile, path=json_path)
-        self.flattened_values.append(Render.sub_head(head_label))
+        self.flattened_values.append(Render.sub_head(get_section_label(profile, json_path)))
         self.iter_dict_list(json_obj, json_path, profile)
         self.flattened_values.append(Render.end_sub_head())
 
     @apply_constrains
     def flatten_resource(self, json_obj: Union[dict, list, T], json_path: str, profile: str):
-        # print(json_path)
         if type(json_obj) is dict:
-            if Extension.type(json_obj):
-                results = ExtensionHandler(
-                    json_obj=json_obj, path=json_path,
-                    profile=profile, terminology=self.terminology
-                ).handle()
-                if type(results) is list and len(results) > 0:
-                    self.flattened_values += results
-                else:
-                    self.flattened_values.append(results)
-            elif HumanName.type(json_path):
-                HumanNameHandler(
-                    json_obj=json_obj, path=json_path, profile=profile
-                ).handle(self)
-            elif ContactPoint.type(json_path):
-                ContactPoint.manage(json_obj, json_path, profile, self)
-            elif Address.type(json_path):
-                Address.manage(json_obj, profile, json_path, self)
-            elif DateCriterion.type(json_path):
-                self.flattened_values += DateCriterion.handle(json_obj, self.terminology)
-            elif CodeableConcept.type(json_obj) or json_path.endswith('class'):
-                concept = json_obj
-                if json_path.endswith('class') and not json_obj.get('coding'):
-                    concept = {'coding': [json_obj]}
-                self.flattened_values += (CodeableConceptHandler(
-                    json_obj=concept, path=json_path, profile=profile,
-                    terminology=self.terminology
-                ).handle())
-            elif Component.type(json_path):
-                self.flattened_values += (ComponentHandler(
-                    json_obj=json_obj, path=json_path, profile=profile,
-                    terminology=self.terminology
-                ).handle())
-            elif Dosage.type(json_path):
-                self.flattened_values += (DosageHandler(
-                    json_obj=json_obj, path=json_path, profile=profile,
-                    terminology=self.terminology
-                ).handle())
-            elif Activity.type(json_path):
-                ActivityHandler(
-                    json_obj=json_obj, path=json_path, profile=profile,
-                    terminology=self.terminology
-                ).handle(self)
-            elif Collection.type(json_path):
-                self.flattened_values += (CollectionHandler(
-                    json_obj=json_obj, path=json_path, profile=profile,
-                    terminology=self.terminology
-                ).handle())
-            elif TimingRepeat.type(json_path):
-                self.flattened_values += TimingRepeat.handle(json_obj, json_path, profile)
-                if TimingRepeat.has_extension(json_obj):
-                    self.flatten_resource(TimingRepeat.has_extension(json_obj), f"{json_path}.extension", profile)
-            elif Communication.instance(json_path):
-                Communication.manage(json_obj, json_path, profile, self)
-            elif Reference.type(json_obj):
-                self.flattened_values += ReferenceHandler(
-                    json_obj=json_obj, path=json_path, profile=profile
-                ).handle()
-            elif Range.type(json_obj):
-                self.flattened_values.append(Range.handle(json_obj, profile, json_path))
-            elif ReferenceRange.type(json_obj, json_path):
-                self.flattened_values += ReferenceRange.handle(json_obj, profile, json_path, self)
-            elif Identifier.type(json_obj):
-                self.flattened_values += Identifier.handle(json_obj)
-            elif Period.type(json_obj):
-                self.flattened_values += Period.handle(json_obj, json_path, profile)
-            elif Quantity.type(json_obj):
-                self.flattened_values.append(Quantity.handle(json_obj, profile, json_path))
-            elif Attachment.type(json_obj):
-                self.flattened_values += Attachment.handle(json_obj)
-            else:
-                self.iter_dict_object(json_obj, json_path, profile)
+            self.flatten_dict(json_obj, json_path, profile)
         elif type(json_obj) is list:
             if RelationshipHandler.type(json_obj):
                 handler = from_dict(RelationshipHandler, {'relationship': json_obj})
                 self.flattened_values.append(handler.handle())
-            elif json_path.endswith('contact'):
-                self.create_section(json_obj, json_path, profile)
-            elif json_path.endswith('content'):
-                self.create_section(json_obj, json_path, profile)
-            elif json_path.endswith('telecom'):
-                self.create_section(json_obj, json_path, profile)
-            elif json_path.endswith('component'):
-                self.create_section(json_obj, json_path, profile)
-            elif json_path.endswith('participant'):
-                self.create_section(json_obj, json_path, profile)
-            elif json_path.endswith('performer'):
-                self.create_section(json_obj, json_path, profile)
-            elif json_path.endswith('section'):
-                self.create_section(json_obj, json_path, profile)
-            elif json_path.endswith('entry'):
-                self.create_section(json_obj, json_path, profile)
-            elif json_path.endswith('activity'):
-                self.create_section(json_obj, json_path, profile)
-            elif json_path.split('.')[-1] in ['dosage', 'dosageInstruction']:
+            elif classify_path(json_path).is_section:
                 self.create_section(json_obj, json_path, profile)
             else:
                 self.iter_dict_list(json_obj, json_path, profile)
         else:
             self.handle_property(json_obj, json_path, profile)
 
+    def flatten_dict(self, json_obj, json_path, profile):
+        handler = self.dict_handler(json_obj, json_path) or self.iter_dict_object
+        handler(json_obj, json_path, profile)
+
+    def dict_handler(self, json_obj, json_path):
+        """
+        Handler of a dict node, None when its keys are simply iterated. The checks on
+        the path are done once per path (classify_path), the ones on the node keep
+        their original order.
+        """
+        path_kind = classify_path(json_path)
+        if Extension.type(json_obj):
+            return self.handle_extension
+        if path_kind.before_codeable:
+            return getattr(self, path_kind.before_codeable)
+        if CodeableConcept.type(json_obj) or path_kind.is_class:
+            return self.handle_codeable_concept
+        if path_kind.after_codeable:
+            return getattr(self, path_kind.after_codeable)
+        for node_type, handler in NODE_TYPES:
+            if node_type(json_obj, json_path):
+                return getattr(self, handler)
+        return None
+
+    def iter_flatten(self):
+        """
+        Flatten the resource like start_flattening, with an explicit stack instead of
+        recursion, and yield the rows as soon as they are produced. The rows are not
+        kept, so a page can be streamed while the rest of the bundle is processed.
+        Typed handlers (names, codes, dosages...) still flatten their small subtree
+        themselves.
+        """
+        self.flattened_values = []
+        self._stack = [(self.expand_node, (
+            self.resource.json_resource, self.resource.resourceType, self.resource.meta_profile
+        ))]
+        while self._stack:
+            step, args = self._stack.pop()
+            if step is None:
+                yield args
+                continue
+            step(*args)
+            if self.flattened_values:
+                yield from self.flattened_values
+                self.flattened_values.clear()
+
+    def _push_entries(self, json_obj, json_path, profile, is_divided):
+        items = []
+        for entry in json_obj:
+            items.append((self.expand_node, (entry, json_path, profile)))
+            if is_divided:
+                items.append((None, Render.divider()))
+        self._stack.extend(reversed(items))
+
+    @apply_constrains
+    def expand_node(self, json_obj, json_path, profile):
+        """One step of iter_flatten: handle the node or push its children."""
+        if type(json_obj) is dict:
+            handler = self.dict_handler(json_obj, json_path)
+            if handler:
+                handler(json_obj, json_path, profile)
+                return
+            items = []
+            for key in json_obj:
+                if key.startswith('div'):
+                    items.append((None, f'<tr><td colspan="2" class="value">{json_obj[key]}</td></tr>'))
+                elif key.startswith('contained'):
+                    items.append((self.expand_contained, (json_obj[key], f"{json_path}.{key}", profile)))
+                else:
+                    items.append((self.expand_node, (json_obj[key], f"{json_path}.{key}", profile)))
+            self._stack.extend(reversed(items))
+        elif type(json_obj) is list:
+            path_kind = classify_path(json_path)
+            if RelationshipHandler.type(json_obj):
+                handler = from_dict(RelationshipHandler, {'relationship': json_obj})
+                self.flattened_values.append(handler.handle())
+            elif path_kind.is_section:
+                self._stack.append((None, Render.end_sub_head()))
+                self._push_entries(json_obj, json_path, profile, path_kind.is_divided)
+                self._stack.append((None, Render.sub_head(get_section_label(profile, json_path))))
+            else:
+                self._push_entries(json_obj, json_path, profile, path_kind.is_divided)
+        else:
+            self.handle_property(json_obj, json_path, profile)
+
+    @apply_constrains
+    def expand_contained(self, json_obj, json_path, profile):
+        if type(json_obj) is list:
+            items = []
+            for _obj in json_obj:
+                items.append((None, Render.sub_head(f"{_(_obj.get('resourceType', ''))}")))
+                items.append((self.expand_node, (json_obj, json_path, profile)))
+                items.append((None, Render.end_sub_head()))
+            self._stack.extend(reversed(items))
+        else:
+            self._stack.append((self.expand_node, (json_obj, json_path, profile)))
+
+    def handle_extension(self, json_obj, json_path, profile):
+        results = ExtensionHandler(
+            json_obj=json_obj, path=json_path,
+            profile=profile, terminology=self.terminology
+        ).handle()
+        if type(results) is list and len(results) > 0:
+            self.flattened_values += results
+        else:
+            self.flattened_values.append(results)
+
+    def handle_human_name(self, json_obj, json_path, profile):
+        HumanNameHandler(
+            json_obj=json_obj, path=json_path, profile=profile
+        ).handle(self)
+
+    def handle_contact_point(self, json_obj, json_path, profile):
+        ContactPoint.manage(json_obj, json_path, profile, self)
+
+    def handle_address(self, json_obj, json_path, profile):
+        Address.manage(json_obj, profile, json_path, self)
+
+    def handle_date_criterion(self, json_obj, json_path, profile):
+        self.flattened_values += DateCriterion.handle(json_obj, self.terminology)
+
+    def handle_codeable_concept(self, json_obj, json_path, profile):
+        concept = json_obj
+        if json_path.endswith('class') and not json_obj.get('coding'):
+            concept = {'coding': [json_obj]}
+        self.flattened_values += (CodeableConceptHandler(
+            json_obj=concept, path=json_path, profile=profile,
+            terminology=self.terminology
+        ).handle())
+
+    def handle_component(self, json_obj, json_path, profile):
+        self.flattened_values += (ComponentHandler(
+            json_obj=json_obj, path=json_path, profile=profile,
+            terminology=self.terminology
+        ).handle())
+
+    def handle_dosage(self, json_obj, json_path, profile):
+        self.flattened_values += (DosageHandler(
+            json_obj=json_obj, path=json_path, profile=profile,
+            terminology=self.terminology
+        ).handle())
+
+    def handle_activity(self, json_obj, json_path, profile):
+        ActivityHandler(
+            json_obj=json_obj, path=json_path, profile=profile,
+            terminology=self.terminology
+        ).handle(self)
+
+    def handle_collection(self, json_obj, json_path, profile):
+        self.flattened_values += (CollectionHandler(
+            json_obj=json_obj, path=json_path, profile=profile,
+            terminology=self.terminology
+        ).handle())
+
+    def handle_timing_repeat(self, json_obj, json_path, profile):
+        self.flattened_values += TimingRepeat.handle(json_obj, json_path, profile)
+        if TimingRepeat.has_extension(json_obj):
+            self.flatten_resource(TimingRepeat.has_extension(json_obj), f"{json_path}.extension", profile)
+
+    def handle_communication(self, json_obj, json_path, profile):
+        Communication.manage(json_obj, json_path, profile, self)
+
+    def handle_reference(self, json_obj, json_path, profile):
+        self.flattened_values += ReferenceHandler(
+            json_obj=json_obj, path=json_path, profile=profile
+        ).handle()
+
+    def handle_range(self, json_obj, json_path, profile):
+        self.flattened_values.append(Range.handle(json_obj, profile, json_path))
+
+    def handle_reference_range(self, json_obj, json_path, profile):
+        self.flattened_values += ReferenceRange.handle(json_obj, profile, json_path, self)
+
+    def handle_identifier(self, json_obj, json_path, profile):
+        self.flattened_values += Identifier.handle(json_obj)
+
+    def handle_period(self, json_obj, json_path, profile):
+        self.flattened_values += Period.handle(json_obj, json_path, profile)
+
+    def handle_quantity(self, json_obj, json_path, profile):
+        self.flattened_values.append(Quantity.handle(json_obj, profile, json_path))
+
+    def handle_attachment(self, json_obj, json_path, profile):
+        self.flattened_values += Attachment.handle(json_obj)
+
+
+class PathKind(NamedTuple):
+    before_codeable: Optional[str]
+    is_class: bool
+    after_codeable: Optional[str]
+    is_section: bool
+    is_divided: bool
+
+
+# checks on the path of a dict node, in the order they are applied,
+# the first group goes before the CodeableConcept check, the second after it
+PATH_TYPES_BEFORE_CODEABLE = (
+    (HumanName.type, 'handle_human_name'),
+    (ContactPoint.type, 'handle_contact_point'),
+    (Address.type, 'handle_address'),
+    (DateCriterion.type, 'handle_date_criterion'),
+)
+PATH_TYPES_AFTER_CODEABLE = (
+    (Component.type, 'handle_component'),
+    (Dosage.type, 'handle_dosage'),
+    (Activity.type, 'handle_activity'),
+    (Collection.type, 'handle_collection'),
+    (TimingRepeat.type, 'handle_timing_repeat'),
+    (Communication.instance, 'handle_communication'),
+)
+# checks on the dict node itself, applied when no path check matched
+NODE_TYPES = (
+    (lambda json_obj, json_path: Reference.type(json_obj), 'handle_reference'),
+    (lambda json_obj, json_path: Range.type(json_obj), 'handle_range'),
+    (ReferenceRange.type, 'handle_reference_range'),
+    (lambda json_obj, json_path: Identifier.type(json_obj), 'handle_identifier'),
+    (lambda json_obj, json_path: Period.type(json_obj), 'handle_period'),
+    (lambda json_obj, json_path: Quantity.type(json_obj), 'handle_quantity'),
+    (lambda json_obj, json_path: Attachment.type(json_obj), 'handle_attachment'),
+)
+# lists rendered as a section of their own
+SECTION_SUFFIXES = (
+    'contact', 'content', 'telecom', 'component', 'participant', 'performer', 'section', 'entry', 'activity'
+)
+SECTION_NAMES = ('dosage', 'dosageInstruction')
+# lists with a divider after each entry
+DIVIDED_NAMES = ('performer', 'participant', 'activity', 'section')
+
+
+def _first_match(path_types, json_path):
+    return next((handler for path_type, handler in path_types if path_type(json_path)), None)
+
+
+@lru_cache(maxsize=8192)
+def classify_path(json_path):
+    """
+    Everything flatten_resource decides from the path alone. Paths carry no list
+    indexes, so a bundle repeats the same few hundred of them.
+    """
+    name = json_path.split('.')[-1]
+    return PathKind(
+        before_codeable=_first_match(PATH_TYPES_BEFORE_CODEABLE, json_path),
+        is_class=json_path.endswith('class'),
+        after_codeable=_first_match(PATH_TYPES_AFTER_CODEABLE, json_path),
+        is_section=json_path.endswith(SECTION_SUFFIXES) or name in SECTION_NAMES,
+        is_divided=name in DIVIDED_NAMES,
+    )
+
+
+# Profiles and labels are resolved again and again with the same arguments during
+# a flattening run, and across requests. The caches are per process and bounded.
+PROFILE_CACHE_SIZE = getattr(settings, 'FHIR_PROFILE_CACHE_SIZE', 256)
+LABEL_CACHE_SIZE = getattr(settings, 'FHIR_LABEL_CACHE_SIZE', 16384)
+
+
+@lru_cache(maxsize=PROFILE_CACHE_SIZE)
+def get_profile_handler(profile):
+    """Parsed StructureDefinition of the profile, shared by all the flattening runs."""
+    return ProfileHandler(profile)
+
+
+@lru_cache(maxsize=LABEL_CACHE_SIZE)
+def _label(profile, json_path, language):
+    return LabelUtil.get_label(profile, json_path)
+
+
+@lru_cache(maxsize=LABEL_CACHE_SIZE)
+def _section_label(profile, json_path, language):
+    profiler = get_profile_handler(profile)
+    # get profile for this path
+    _profile = String.profile_id(profiler.search_profile(json_path))
+    # get base path for this new profile
+    base_path = profiler.search_type(json_path)
+    if _profile and base_path:
+        return LabelUtil.get_label(_profile, base_path)
+    return LabelUtil.get_label(profile_name=profile, path=json_path)
+
+
+def get_label(profile, json_path):
+    """LabelUtil.get_label, memoized per language."""
+    return _label(profile, json_path, get_language())
+
+
+def get_section_label(profile, json_path):
+    """Head label of a section, from the profile of its path when there is one."""
+    return _section_label(profile, json_path, get_language())
+
+
+def flattening_cache_stats():
+    """Hits, misses and sizes of the flattening caches of this process."""
+    return {
+        name: cached._asdict() for name, cached in (
+            ('profiles', get_profile_handler.cache_info()),
+            ('labels', _label.cache_info()),
+            ('section_labels', _section_label.cache_info()),
+            ('paths', classify_path.cache_info()),
+        )
+    }
+
+
+def clear_flattening_caches():
+    for cached in (get_profile_handler, _label, _section_label, classify_path):
+        cached.cache_clear()
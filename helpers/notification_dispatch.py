@@ -0,0 +1,147 @@
+import logging
+
+from celery import shared_task
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .beams import beams_publisher
+
+logger = logging.getLogger(__name__)
+
+NOTIFICATION_QUEUE = getattr(settings, 'NOTIFICATION_DISPATCH_QUEUE', 'notifications')
+# status changes committed within this many seconds are handled by one drain
+NOTIFICATION_WINDOW = getattr(settings, 'NOTIFICATION_DISPATCH_WINDOW', 5)
+DRAIN_BATCH_SIZE = 1000
+
+SCHEDULED_KEY = 'notification_dispatch_scheduled'
+SENT_KEY = 'notification_dispatch_sent'
+COALESCED_KEY = 'notification_dispatch_coalesced'
+
+
+def _count(key, delta):
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key, delta)
+    except ValueError:  # evicted between add and incr
+        pass
+
+
+def dispatch_status_change(instance):
+    """
+    Notify about the status change of a just saved Job or Service Ticket.
+
+    'celery' (default) and 'local' write the change to the PendingStatusChange
+    outbox in the running transaction, a rolled back save leaves nothing behind.
+    'celery' drains the outbox on the notifications queue NOTIFICATION_DISPATCH_WINDOW
+    seconds after the first commit, so the changes of several requests (e.g. a bulk
+    edit) are handled together, 'local' drains it in the current process right after
+    the commit. 'sync' runs the notifications right away, inside the transaction.
+    """
+    if _backend() == 'sync':
+        instance.run_notifications
+        return
+    from apps.api.models import PendingStatusChange
+
+    PendingStatusChange.objects.create(
+        object_label=instance._meta.label, object_id=instance.pk,
+        original_status=instance._original_status, status=instance.status,
+    )
+    # runs right away under autocommit, the row is committed already
+    transaction.on_commit(_schedule_drain)
+
+
+def _backend():
+    backend = getattr(settings, 'NOTIFICATION_DISPATCH_BACKEND', 'celery')
+    if backend not in ('celery', 'local', 'sync'):
+        raise ValueError(f'Unknown notification backend: {backend}')
+    return backend
+
+
+def _schedule_drain():
+    if _backend() == 'local':
+        drain()
+    elif cache.add(SCHEDULED_KEY, True, NOTIFICATION_WINDOW):
+        # one drain per window, the changes committed meanwhile wait for it
+        dispatch_notifications.apply_async(countdown=NOTIFICATION_WINDOW, queue=NOTIFICATION_QUEUE)
+
+
+def coalesce(changes):
+    """
+    [model label, pk, original status, status] events of PendingStatusChange rows,
+    several changes of one object become one change from its first to its last status.
+    """
+    events = {}
+    for change in sorted(changes, key=lambda change: change.id):
+        key = (change.object_label, change.object_id)
+        original_status = events[key][0] if key in events else change.original_status
+        events[key] = (original_status, change.status)
+    return [[label, pk, original_status, status] for (label, pk), (original_status, status) in events.items()]
+
+
+def drain(batch_size=DRAIN_BATCH_SIZE):
+    """Run the notifications of the pending status changes, batch_size rows per transaction."""
+    from apps.api.models import PendingStatusChange
+
+    # changes committed from now on schedule the next drain
+    cache.delete(SCHEDULED_KEY)
+    while True:
+        # pushes go out once the batch is committed, after its row locks are released,
+        # a rolled back batch stays in the outbox and sends nothing
+        with beams_publisher.batch(), transaction.atomic():
+            # concurrent drains skip each other's rows
+            changes = list(
+                PendingStatusChange.objects.select_for_update(skip_locked=True).order_by('id')[:batch_size]
+            )
+            if not changes:
+                return
+            PendingStatusChange.objects.filter(id__in=[change.id for change in changes]).delete()
+            events = coalesce(changes)
+            _count(COALESCED_KEY, len(changes) - len(events))
+            # the notifications of the batch are written in this one transaction
+            run_notifications(events)
+
+
+def run_notifications(events):
+    """Run the notifications of [model label, pk, original status, status] events."""
+    by_model = {}
+    for label, pk, original_status, status in events:
+        by_model.setdefault(label, {})[pk] = (original_status, status)
+    # pushes of the same notification to several users go out as one publish
+    with beams_publisher.batch():
+        _run_notifications(by_model)
+
+
+def _run_notifications(by_model):
+    for label, changes in by_model.items():
+        model = apps.get_model(label)
+        instances = model.objects.in_bulk(list(changes))
+        for pk, (original_status, status) in changes.items():
+            instance = instances.get(pk)
+            if instance is not None:
+                instance._original_status = original_status
+                instance.status = status
+                try:
+                    with transaction.atomic():
+                        instance.run_notifications
+                except Exception:
+                    logger.exception('Notifications of %s #%s failed', label, pk)
+        _count(SENT_KEY, len(changes))
+
+
+@shared_task
+def dispatch_notifications():
+    drain()
+
+
+def stats():
+    """Queue depth (outbox rows) and counters of the dispatcher, shared by all processes."""
+    from apps.api.models import PendingStatusChange
+
+    counters = cache.get_many([SENT_KEY, COALESCED_KEY])
+    return {
+        'pending': PendingStatusChange.objects.count(),
+        'sent': counters.get(SENT_KEY, 0),
+        'coalesced': counters.get(COALESCED_KEY, 0),
+    }
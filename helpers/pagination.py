@@ -0,0 +1,113 @@
+import json
+
+from django.db.models import F, Q
+from django.http import StreamingHttpResponse
+from rest_framework.pagination import CursorPagination
+from rest_framework.utils.encoders import JSONEncoder
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Cursor pagination, the page is found by the position of the last row
+    instead of an OFFSET, so deep pages cost the same as the first one.
+    """
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+
+def keyset_ordering(queryset):
+    """
+    The ordering of the queryset as field names, with the primary key appended as
+    tiebreaker so every row has a distinct position. Expression and random orderings
+    can't be continued from a row and fall back to the primary key.
+    """
+    ordering = list(queryset.query.order_by or queryset.model._meta.ordering)
+    if not all(isinstance(field, str) and field != '?' for field in ordering):
+        ordering = []
+    pk_names = ('pk', queryset.model._meta.pk.name)
+    if not any(field.lstrip('-') in pk_names for field in ordering):
+        ordering.append('pk')
+    return ordering
+
+
+def _nulls_last(ordering):
+    return [
+        F(field[1:]).desc(nulls_last=True) if field.startswith('-') else F(field).asc(nulls_last=True)
+        for field in ordering
+    ]
+
+
+def _after(ordering, values):
+    """Rows placed after the row with the given ordering values, NULLs sort last."""
+    condition = Q(pk__in=[])
+    equal = Q()
+    for field, value in zip(ordering, values):
+        name = field.lstrip('-')
+        if value is None:
+            equal &= Q(**{f'{name}__isnull': True})
+            continue
+        lookup = 'lt' if field.startswith('-') else 'gt'
+        condition |= equal & (Q(**{f'{name}__{lookup}': value}) | Q(**{f'{name}__isnull': True}))
+        equal &= Q(**{name: value})
+    return condition
+
+
+def stream_json_list(queryset, serialize, chunk_size=500):
+    """
+    Yield the queryset as a JSON array in its own ordering. The rows are read in
+    keyset chunks of chunk_size, each one starts after the ordering values of the
+    last row of the previous chunk, and serialize is called per chunk, so only
+    one chunk is kept in memory.
+    """
+    ordering = keyset_ordering(queryset)
+    names = [field.lstrip('-') for field in ordering]
+    queryset = queryset.order_by(*_nulls_last(ordering))
+    yield '['
+    separator = ''
+    chunk = queryset
+    while True:
+        objects = list(chunk[:chunk_size])
+        if not objects:
+            break
+        # read back from the DB, annotations and related fields included
+        last_values = queryset.filter(pk=objects[-1].pk).values_list(*names).first()
+        chunk = queryset.filter(_after(ordering, last_values))
+        for item in serialize(objects):
+            yield separator + json.dumps(item, cls=JSONEncoder)
+            separator = ','
+    yield ']'
+
+
+class KeysetPaginationMixin:
+    """
+    List modes of a ViewSet on top of the default page number pagination:
+
+        /?cursor=           keyset pagination on cursor_ordering, follow the next/previous links
+        /?all=true          all rows streamed as one JSON array in the list ordering, built in keyset chunks
+    """
+    cursor_ordering = ('-creation_date', '-id')
+    stream_chunk_size = 500
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            request = getattr(self, 'request', None)
+            if request is not None and 'cursor' in request.query_params:
+                self._paginator = KeysetPagination()
+                self._paginator.ordering = self.cursor_ordering
+                return self._paginator
+        return super().paginator
+
+    def list(self, request, *args, **kwargs):
+        if 'true' in request.query_params.get('all', '').lower():
+            return self.stream_list()
+        return super().list(request, *args, **kwargs)
+
+    def stream_list(self):
+        queryset = self.filter_queryset(self.get_queryset())
+        rows = stream_json_list(
+            queryset,
+            lambda objects: self.get_serializer(objects, many=True).data,
+            self.stream_chunk_size
+        )
+        return StreamingHttpResponse(rows, content_type='application/json')
@@ -0,0 +1,68 @@
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+class ServiceTicketPDFCache:
+    """
+    Cache of rendered service ticket PDFs.
+
+    Entries are keyed by a version of the ticket and a version of its job.
+    Invalidation drops the versions, so the stale PDFs can't be reached
+    anymore and simply expire. get() returns the key it looked up and set()
+    stores under that key, a PDF rendered before an invalidation is never
+    stored under the versions created after it.
+    """
+    HITS_KEY = 'st_pdf_hits'
+    MISSES_KEY = 'st_pdf_misses'
+
+    @staticmethod
+    def _version_keys(st_id, job_id):
+        return [f'st_pdf_version_st_{st_id}', f'st_pdf_version_job_{job_id}']
+
+    @classmethod
+    def _pdf_key(cls, st):
+        version_keys = cls._version_keys(st.id, st.connected_job_id)
+        versions = cache.get_many(version_keys)
+        missing = {key: uuid4().hex for key in version_keys if key not in versions}
+        if missing:
+            cache.set_many(missing, None)
+            versions.update(missing)
+        return f'st_pdf_{st.id}_' + '_'.join(versions[key] for key in version_keys)
+
+    @classmethod
+    def _count(cls, key):
+        cache.add(key, 0, None)
+        try:
+            cache.incr(key)
+        except ValueError:  # evicted between add and incr
+            pass
+
+    @classmethod
+    def get(cls, st):
+        """Return (key, pdf), pdf is None on a cache miss."""
+        key = cls._pdf_key(st)
+        pdf = cache.get(key)
+        cls._count(cls.MISSES_KEY if pdf is None else cls.HITS_KEY)
+        return key, pdf
+
+    @classmethod
+    def set(cls, key, pdf):
+        timeout = getattr(settings, 'SERVICE_TICKET_PDF_CACHE_TIMEOUT', 7 * 24 * 60 * 60)
+        cache.set(key, pdf, timeout)
+
+    @classmethod
+    def invalidate(cls, st_ids=(), job_ids=()):
+        keys = [f'st_pdf_version_st_{st_id}' for st_id in st_ids]
+        keys += [f'st_pdf_version_job_{job_id}' for job_id in job_ids]
+        if keys:
+            cache.delete_many(keys)
+
+    @classmethod
+    def stats(cls):
+        counters = cache.get_many([cls.HITS_KEY, cls.MISSES_KEY])
+        return {
+            'hits': counters.get(cls.HITS_KEY, 0),
+            'misses': counters.get(cls.MISSES_KEY, 0),
+        }
@@ -0,0 +1,15 @@
+from rest_framework.filters import SearchFilter
+
+
+class DocumentSearchFilter(SearchFilter):
+    """
+    ?search= over the search_document column of the model instead of icontains
+    over every search_fields lookup. Every term has to be found, like with SearchFilter.
+    search_fields still documents what the document is built from.
+    """
+    document_field = 'search_document'
+
+    def filter_queryset(self, request, queryset, view):
+        for term in self.get_search_terms(request):
+            queryset = queryset.filter(**{f'{self.document_field}__contains': term.lower()})
+        return queryset
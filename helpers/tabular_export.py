@@ -0,0 +1,58 @@
+import csv
+import tempfile
+
+from django.http import FileResponse, StreamingHttpResponse
+
+try:
+    from openpyxl import Workbook
+except ImportError:  # XLSX export is optional
+    Workbook = None
+
+CSV = 'csv'
+XLSX = 'xlsx'
+FILE_FORMATS = (CSV, XLSX)
+
+
+class EchoBuffer:
+    """File-like object handing the written line back to csv.writer's caller."""
+
+    def write(self, value):
+        return value
+
+
+def iter_csv(header, rows):
+    writer = csv.writer(EchoBuffer())
+    yield writer.writerow(header)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def write_xlsx(header, rows):
+    """
+    Write the rows into a temporary XLSX file with a write-only workbook,
+    which flushes every row to disk instead of keeping the sheet in memory.
+    """
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(header)
+    for row in rows:
+        sheet.append(row)
+    xlsx_file = tempfile.TemporaryFile()
+    workbook.save(xlsx_file)
+    xlsx_file.seek(0)
+    return xlsx_file
+
+
+def tabular_response(header, rows, file_format, filename):
+    """
+    CSV is streamed while the rows are read, XLSX is built on disk first
+    since the format can't be written incrementally to the client.
+    rows should be a lazy iterable, e.g. a queryset iterator().
+    """
+    if file_format == XLSX:
+        if Workbook is None:
+            raise ValueError('XLSX export requires openpyxl')
+        return FileResponse(write_xlsx(header, rows), as_attachment=True, filename=f'{filename}.xlsx')
+    response = StreamingHttpResponse(iter_csv(header, rows), content_type='text/csv')
+    response['Content-Disposition'] = f'attachment; filename="{filename}.csv"'
+    return response
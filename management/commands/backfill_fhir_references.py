@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from apps.healthcare.models import FhirReference, FhirResource
+
+
+class Command(BaseCommand):
+    help = 'Index the references of the stored FHIR resources for the reverse reference lookups.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        resources = FhirResource.objects.order_by('pk').only('pk', 'resource_type', 'resource_json')
+        indexed = 0
+        last_pk = 0
+        while True:
+            batch = list(resources.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+            FhirReference.index_resources(batch)
+            indexed += len(batch)
+        references = FhirReference.objects.count()
+        self.stdout.write(self.style.SUCCESS(f'Indexed {references} references of {indexed} resources.'))
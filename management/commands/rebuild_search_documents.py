@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from apps.api.models import Job, ServiceTicket
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the search documents of Jobs and Service Tickets and make sure they are indexed.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument(
+            '--skip-index', action='store_true', help='Only rebuild the documents.'
+        )
+
+    def handle(self, *args, **options):
+        if not options['skip_index']:
+            self.create_indexes()
+        for model in (Job, ServiceTicket):
+            model.refresh_search_documents(batch_size=options['batch_size'])
+            self.stdout.write(f'Rebuilt {model._meta.verbose_name_plural} search documents.')
+
+    def create_indexes(self):
+        """
+        Trigram GIN indexes let Postgres answer LIKE '%term%' without a sequential scan.
+        Other databases (SQLite in tests) search the column without an index.
+        """
+        if connection.vendor != 'postgresql':
+            self.stdout.write('Search indexes are only created on PostgreSQL.')
+            return
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            for model in (Job, ServiceTicket):
+                table = model._meta.db_table
+                cursor.execute(
+                    f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {table}_search_trgm_idx '
+                    f'ON {table} USING gin (search_document gin_trgm_ops)'
+                )
+        self.stdout.write('Search indexes are in place.')
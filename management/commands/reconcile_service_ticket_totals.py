@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+
+from apps.api.models import ServiceTicket
+
+
+class Command(BaseCommand):
+    help = 'Recompute the stored work block totals of Service Tickets and report the drifted ones.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument(
+            '--dry-run', action='store_true', help='Only report the drift, do not fix it.'
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        checked = drifted = 0
+        tickets = ServiceTicket.objects.order_by('pk').values('pk', *ServiceTicket.TOTALS_FIELDS)
+        last_pk = 0
+        while True:
+            batch = list(tickets.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1]['pk']
+            fresh_totals = ServiceTicket.compute_totals([row['pk'] for row in batch])
+            for row in batch:
+                st_id = row.pop('pk')
+                fresh = fresh_totals[st_id]
+                changed = {field: value for field, value in fresh.items() if row[field] != value}
+                checked += 1
+                if not changed:
+                    continue
+                drifted += 1
+                self.stdout.write(f'Service Ticket #{st_id}: ' + ', '.join(
+                    f'{field} {row[field]!r} -> {value!r}' for field, value in changed.items()
+                ))
+                if not options['dry_run']:
+                    ServiceTicket.objects.filter(pk=st_id).update(**changed)
+
+        action = 'found' if options['dry_run'] else 'fixed'
+        self.stdout.write(self.style.SUCCESS(f'Checked {checked} Service Tickets, {action} {drifted} with drift.'))
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from apps.api.models import DailyWorkRollup, Job
+from apps.time_tracker.models import IndirectHours
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the daily work rollup used by the reports.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        job_ids = list(Job.objects.order_by('pk').values_list('pk', flat=True))
+        for start in range(0, len(job_ids), batch_size):
+            DailyWorkRollup.refresh_jobs(job_ids[start:start + batch_size])
+        self.stdout.write(f'Rebuilt ticket rows of {len(job_ids)} Jobs.')
+
+        days = list(IndirectHours.objects.order_by('date').values_list('date', flat=True).distinct())
+        # days without indirect hours anymore may still have stale rows
+        days += DailyWorkRollup.objects.filter(time_code__isnull=False).values_list('day', flat=True).distinct()
+        days = sorted(set(days))
+        for start in range(0, len(days), batch_size):
+            DailyWorkRollup.refresh_indirect_days(days[start:start + batch_size])
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt indirect hours rows of {len(days)} days.'))
@@ -1,7 +1,12 @@
-from django.db import models
+import re
+
+from django.db import models, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 
 from apps.accounts.models import User
 from apps.providers.models import Endpoint
+from utils.helpers.fhir_render_cache import FhirRenderCache
 
 
 class FhirResource(models.Model):
@@ -33,6 +38,78 @@ class FhirResource(models.Model):
         return FhirResource.objects.count() == 0
 
 
+class FhirReference(models.Model):
+    """Index of the references of stored resources, for the reverse lookups."""
+    objects = models.Manager()
+
+    # Type/id, absolute urls and versioned references; contained (#id) and urn references are skipped
+    REFERENCE_PATTERN = re.compile(
+        r'(?:^|/)(?P<type>[A-Z][A-Za-z]+)/(?P<id>[A-Za-z0-9\-.]{1,64})(?:/_history/[^/]+)?$'
+    )
+
+    source = models.ForeignKey(FhirResource, on_delete=models.CASCADE, related_name='outgoing_references')
+    target_type = models.CharField(max_length=100, verbose_name="Target type")
+    target_id = models.CharField(max_length=100, verbose_name="Target id")
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['target_type', 'target_id'], name='fhir_reference_target_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['source', 'target_type', 'target_id'],
+                name='fhir_reference_unique'
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.source_id} -> {self.target_type}/{self.target_id}"
+
+    @classmethod
+    def parse(cls, reference):
+        """(type, id) of a reference string, None when it doesn't point to a resource."""
+        match = cls.REFERENCE_PATTERN.search(reference)
+        if match:
+            return match.group('type'), match.group('id')
+        return None
+
+    @classmethod
+    def extract(cls, resource_json):
+        """(type, id) of every reference field of the json."""
+        targets = set()
+        stack = [resource_json]
+        while stack:
+            node = stack.pop()
+            if type(node) is dict:
+                reference = node.get('reference')
+                if type(reference) is str:
+                    target = cls.parse(reference)
+                    if target:
+                        targets.add(target)
+                stack.extend(node.values())
+            elif type(node) is list:
+                stack.extend(node)
+        return targets
+
+    @classmethod
+    def index_resources(cls, resources):
+        """Replace the indexed references of the resources. Bundles are not indexed."""
+        resources = [resource for resource in resources if resource.resource_type != "Bundle"]
+        with transaction.atomic():
+            cls.objects.filter(source__in=[resource.pk for resource in resources]).delete()
+            cls.objects.bulk_create([
+                cls(source=resource, target_type=target_type, target_id=target_id)
+                for resource in resources
+                for target_type, target_id in cls.extract(resource.resource_json or {})
+            ])
+
+    @classmethod
+    def referencing_resources(cls, target_type, target_id):
+        return FhirResource.objects.filter(
+            pk__in=cls.objects.filter(target_type=target_type, target_id=target_id).values('source_id')
+        )
+
+
 class TerminologyCode(models.Model):
     objects = models.Manager()
     code = models.CharField(max_length=50)
@@ -86,3 +163,13 @@ class Medication(models.Model):
     treatment = models.CharField(max_length=300, verbose_name="Medication treatment", default="")
     patient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='medications', verbose_name="Patient")
 
+
+@receiver(post_save, sender=FhirResource)
+@receiver(post_delete, sender=FhirResource)
+def invalidate_fhir_render_cache(sender, instance, **kwargs):
+    FhirRenderCache.invalidate([instance.pk])
+
+
+@receiver(post_save, sender=FhirResource)
+def index_fhir_references(sender, instance, **kwargs):
+    FhirReference.index_resources([instance])
@@ -1,33 +1,89 @@
 from auditlog.registry import auditlog
 
+import time
+from contextlib import contextmanager
 from datetime import date, datetime, timedelta
+from threading import local
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.core.validators import MaxValueValidator
-from django.db import models
-from django.db.models import Sum
+from django.db import models, transaction
+from django.db.models import Count, DurationField, ExpressionWrapper, F, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django.utils.safestring import mark_safe
 # from django.contrib.postgres.fields.citext import CICharField
 
-from apps.authentication.models import Manager, Mechanic
+from apps.authentication.models import Manager, Mechanic, User
 from apps.utils.clean_single_field import CleanFieldsModelMixin
 from apps.utils.fields import DecimalField
 from apps.utils.request_middleware import RequestMiddleware
 from apps.utils.clean_single_field import CleanFieldsModelMixin
 from apps.utils.fields import DecimalField
+from apps.utils.pdf_cache import ServiceTicketPDFCache
 from apps.utils.notifications import JobActionNotifications, ServiceTicketActionNotifications
+from apps.utils.notification_dispatch import dispatch_status_change
 from .constants import US_STATES
 from .model_validators import validate_attachment_file_type, validate_request_job_perm
 from .utils import delete_file, get_customer_signature_img_path, get_file_attachment_path
 from solo.models import SingletonModel
 
 
-class DBLockDate(SingletonModel):
+class CachedSingletonMixin:
+    """
+    Singleton rows read through a process-local copy backed by the shared cache.
+    Saving or deleting the row drops both, other processes see the change once
+    their local copy expires (SINGLETON_LOCAL_CACHE_TIMEOUT seconds).
+    Subclasses must define the load_singleton() classmethod reading the row from the DB.
+    """
+    _local_copies = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if not callable(getattr(cls, 'load_singleton', None)):
+            raise TypeError(f'{cls.__name__} must define the load_singleton() classmethod')
+
+    @classmethod
+    def _singleton_cache_key(cls):
+        return f'singleton_{cls._meta.label_lower}'
+
+    @classmethod
+    def get_cached(cls):
+        now = time.monotonic()
+        local_copy = cls._local_copies.get(cls)
+        if local_copy and local_copy[1] > now:
+            return local_copy[0]
+        key = cls._singleton_cache_key()
+        # wrapped in a tuple, a missing row is cached as None
+        cached = cache.get(key)
+        if cached is None:
+            cached = (cls.load_singleton(),)
+            cache.set(key, cached, getattr(settings, 'SINGLETON_CACHE_TIMEOUT', 60 * 60))
+        cls._local_copies[cls] = (cached[0], now + getattr(settings, 'SINGLETON_LOCAL_CACHE_TIMEOUT', 10))
+        return cached[0]
+
+    @classmethod
+    def invalidate_cache(cls):
+        cls._local_copies.pop(cls, None)
+        cache.delete(cls._singleton_cache_key())
+
+
+class DBLockDate(CachedSingletonMixin, SingletonModel):
     lock_date = models.DateField(_("DB Lock Date"), null=True, blank=True)
 
+    @classmethod
+    def load_singleton(cls):
+        return cls.get_solo()
+
+    @classmethod
+    def get_lock_date(cls):
+        return cls.get_cached().lock_date
+
 
 class CommonInfo(CleanFieldsModelMixin, models.Model):
 
@@ -105,11 +161,11 @@ class CommonInfo(CleanFieldsModelMixin, models.Model):
         elif self.status == CommonInfo.PENDING_FOR_APPROVAL:
             self.approval = None
         super().save(*args, **kwargs)
-        # creation of notifications
-        self.run_notifications
+        # creation of notifications, after the transaction commits
+        dispatch_status_change(self)
 
 
-class Settings(models.Model):
+class Settings(CachedSingletonMixin, models.Model):
     """Singletone Model with custom settings."""
     job_number_starting_point = models.PositiveIntegerField(
         default=1,
@@ -127,12 +183,79 @@ class Settings(models.Model):
         """Disable creating new instances."""
         if not self.pk and Settings.objects.exists():
             raise ValidationError('There is can be only one Settings instance')
-        return super(Settings, self).save(*args, **kwargs)
+        result = super(Settings, self).save(*args, **kwargs)
+        # the next allocated Job number can't be below the starting point
+        JobNumberCounter.objects.filter(
+            last_number_id__lt=self.job_number_starting_point - 1
+        ).update(last_number_id=self.job_number_starting_point - 1)
+        return result
 
     def delete(self, *args, **kwargs):
         """Blocked delete method."""
         pass
 
+    @classmethod
+    def load_singleton(cls):
+        return cls.objects.first()
+
+
+class JobNumberCounter(models.Model):
+    """
+    Single row counter handing out Job number_ids.
+    The row is locked by the increment, so concurrent allocations never get the same number.
+    """
+    last_number_id = models.PositiveIntegerField(_('Last allocated number'), default=0)
+
+    COUNTER_ID = 1
+
+    @classmethod
+    def _create_counter(cls):
+        starting_point = Settings.objects.values_list('job_number_starting_point', flat=True).first() or 1
+        last_number_id = Job.objects.aggregate(last=models.Max('number_id'))['last'] or 0
+        cls.objects.get_or_create(
+            pk=cls.COUNTER_ID, defaults={'last_number_id': max(starting_point - 1, last_number_id)}
+        )
+
+    @classmethod
+    def allocate(cls, count=1):
+        """
+        Reserve count consecutive number_ids and return them as a range,
+        e.g. to number a block of imported Jobs at once.
+        """
+        with transaction.atomic():
+            counters = cls.objects.filter(pk=cls.COUNTER_ID)
+            if not counters.update(last_number_id=F('last_number_id') + count):
+                cls._create_counter()
+                counters.update(last_number_id=F('last_number_id') + count)
+            last_number_id = counters.values_list('last_number_id', flat=True).get()
+        return range(last_number_id - count + 1, last_number_id + 1)
+
+
+def build_search_document(values):
+    """Lowercased searchable values, one per line, so a search term never spans two of them."""
+    return '\n'.join(str(value).lower() for value in values if value not in (None, ''))
+
+
+class SearchDocumentMixin:
+    """
+    Model with a search_document column built from SEARCH_DOCUMENT_FIELDS (lookups allowed).
+    It's what DocumentSearchFilter searches instead of icontains over several joins.
+    """
+    SEARCH_DOCUMENT_FIELDS = ()
+
+    @classmethod
+    def refresh_search_documents(cls, queryset=None, batch_size=500):
+        queryset = cls.objects.all() if queryset is None else queryset
+        rows = queryset.order_by().values_list('pk', *cls.SEARCH_DOCUMENT_FIELDS)
+        batch = []
+        for pk, *values in rows.iterator(chunk_size=batch_size):
+            batch.append(cls(pk=pk, search_document=build_search_document(values)))
+            if len(batch) == batch_size:
+                cls.objects.bulk_update(batch, ['search_document'])
+                batch = []
+        if batch:
+            cls.objects.bulk_update(batch, ['search_document'])
+
 
 class Location(models.Model):
     """
@@ -159,7 +282,42 @@ class Customer(models.Model):
         return self.name
 
 
-class Job(CommonInfo, JobActionNotifications):
+WORKED_DURATION = ExpressionWrapper(F('end_time') - F('start_time'), output_field=DurationField())
+
+
+class JobQuerySet(models.QuerySet):
+
+    def with_list_counters(self):
+        """
+        Annotate tickets counters and worked time with correlated subqueries,
+        so a page of jobs costs the same number of queries whatever its size.
+        """
+        tickets = ServiceTicket.objects.filter(
+            connected_job=OuterRef('pk')
+        ).order_by().values('connected_job')
+        work_blocks = EmployeeWorkBlock.objects.filter(
+            service_ticket__connected_job=OuterRef('pk')
+        ).order_by().values('service_ticket__connected_job')
+        return self.annotate(
+            approved_tickets_count=Coalesce(
+                Subquery(
+                    tickets.filter(status=CommonInfo.APPROVED)
+                    .annotate(count=Count('id')).values('count')
+                ),
+                0
+            ),
+            total_tickets_count=Coalesce(
+                Subquery(tickets.annotate(count=Count('id')).values('count')),
+                0
+            ),
+            annotated_time_worked=Subquery(
+                work_blocks.annotate(total=Sum(WORKED_DURATION)).values('total'),
+                output_field=DurationField()
+            ),
+        )
+
+
+class Job(SearchDocumentMixin, CommonInfo, JobActionNotifications):
     """
     Job model.
     """
@@ -191,8 +349,20 @@ class Job(CommonInfo, JobActionNotifications):
     managers = models.ManyToManyField(
         Manager, blank=True, related_name='managers', verbose_name=_('Managers')
     )
+    search_document = models.TextField(_('Search document'), blank=True, editable=False)
+
+    objects = JobQuerySet.as_manager()
+
+    SEARCH_DOCUMENT_FIELDS = (
+        'location__name', 'customer__name', 'number',
+        'created_by__first_name', 'created_by__last_name', 'description',
+    )
 
     class Meta:
+        indexes = [
+            # keyset pagination order
+            models.Index(fields=['-creation_date', '-id'], name='job_creation_idx'),
+        ]
         permissions = [
             ('can_set_pending_for_approval_job', 'Can set Job status Pending for Approval'),
             ('can_archive_jobs', 'Can set Archive Jobs'),
@@ -202,18 +372,19 @@ class Job(CommonInfo, JobActionNotifications):
     def __init__(self, *args, **kwargs):
         super(Job, self).__init__(*args, **kwargs)
         self._original_status = self.status
+        self._original_ticket_search_values = self.ticket_search_values()
 
     def __str__(self):
         return f'Job #{self.number}'
 
+    def ticket_search_values(self):
+        """Values of the Job copied into the search documents of its tickets."""
+        # read from __dict__, deferred fields must not be fetched for every loaded Job
+        return tuple(self.__dict__.get(field) for field in ('number', 'customer_id', 'location_id'))
+
     def generate_number(self):
         if self.number_id is None:
-            last_job = Job.objects.last()
-            settings_number_id = Settings.objects.get().job_number_starting_point
-            if last_job is None or settings_number_id > last_job.number_id:
-                self.number_id = settings_number_id
-            else:
-                self.number_id = last_job.number_id + 1
+            self.number_id = JobNumberCounter.allocate()[0]
         return f'{date.today().strftime("%y%m")}-{"{:04d}".format(self.number_id)}'
 
     def clean_status(self):
@@ -228,12 +399,13 @@ class Job(CommonInfo, JobActionNotifications):
 
     @property
     def time_worked(self):
-        work_blocks = list(EmployeeWorkBlock.objects.filter(service_ticket__connected_job_id=self.id))
-        total_time = timedelta(0)
-        for wb in work_blocks:
-            if wb.hours_worked:
-                total_time += wb.hours_worked
-        return total_time/timedelta(hours=1)
+        if hasattr(self, 'annotated_time_worked'):  # see JobQuerySet.with_list_counters
+            total_time = self.annotated_time_worked
+        else:
+            total_time = EmployeeWorkBlock.objects.filter(
+                service_ticket__connected_job_id=self.id
+            ).aggregate(total=Sum(WORKED_DURATION))['total']
+        return (total_time or timedelta(0))/timedelta(hours=1)
 
     def _if_all_service_tickets_in_status_aproved(self):
         service_tickets = ServiceTicket.objects.filter(connected_job=self)
@@ -326,7 +498,7 @@ class ServicABC(models.Model):
         return is_nones, fields
 
 
-class ServiceTicket(CommonInfo, ServicABC, ServiceTicketActionNotifications):
+class ServiceTicket(SearchDocumentMixin, CommonInfo, ServicABC, ServiceTicketActionNotifications):
     """
     Service Ticket model.
     """
@@ -434,10 +606,29 @@ class ServiceTicket(CommonInfo, ServicABC, ServiceTicketActionNotifications):
 
     reject_description = models.CharField(_('Reject description'), max_length=500, blank=True)
 
+    # totals of the employee work blocks, kept up to date by refresh_totals
+    worked_duration = models.DurationField(_('Total worked time'), default=timedelta(0))
+    mileage_total = DecimalField(_('Total mileage'))
+    employee_names = models.TextField(_('Employees'), blank=True)
+    hotel_count = models.PositiveIntegerField(_('Hotel checkboxes'), default=0)
+    per_diem_count = models.PositiveIntegerField(_('Per Diem checkboxes'), default=0)
+
+    TOTALS_FIELDS = ('worked_duration', 'mileage_total', 'employee_names', 'hotel_count', 'per_diem_count')
+
+    search_document = models.TextField(_('Search document'), blank=True, editable=False)
+
+    SEARCH_DOCUMENT_FIELDS = (
+        'id', 'connected_job__location__name', 'connected_job__customer__name', 'connected_job__number',
+        'additional_notes', 'created_by__first_name', 'created_by__last_name', 'employee_names',
+    )
 
     class Meta:
         verbose_name = _('Service Ticket')
         verbose_name_plural = _('Service Tickets')
+        indexes = [
+            # keyset pagination order
+            models.Index(fields=['-creation_date', '-id'], name='service_ticket_creation_idx'),
+        ]
         permissions = [
             (
                 'can_set_pending_for_approval_service_ticket',
@@ -454,21 +645,15 @@ class ServiceTicket(CommonInfo, ServicABC, ServiceTicketActionNotifications):
         self.initialize_connected_job()
 
     def initialize_connected_job(self):
-        try:
-            self._original_connected_job = self.connected_job
-        except:
-            self._original_connected_job = None
+        # read the id from __dict__, touching the relation would fetch the Job for every loaded ticket
+        self._original_connected_job_id = self.__dict__.get('connected_job_id')
 
     def __str__(self):
         return 'Service ticket #{}' #.format(self.connected_job.number)
 
     @property
     def total_worked_hours(self):
-        total = 0
-        for employee_work in self.employee_works.all():
-            hours = employee_work.hours_worked
-            if hours:
-                total += hours.total_seconds()
+        total = self.worked_duration.total_seconds() if self.worked_duration else 0
         if total == 0:
             return ''
         minutes = divmod(total, 60)[0]
@@ -476,29 +661,60 @@ class ServiceTicket(CommonInfo, ServicABC, ServiceTicketActionNotifications):
 
     @property
     def total_mileage(self):
-        result = self.employee_works.all().aggregate(Sum('mileage'))
-        total = result.get('mileage__sum', 0)
-        if total is None or total == 0:
+        if self.mileage_total is None or self.mileage_total == 0:
             return ''
-        return str(total)
+        return str(self.mileage_total)
 
     @property
     def list_all_employees(self):
-        result = []
-        for employee_work in self.employee_works.all():
-            employee = employee_work.employee
-            result.append(f"{employee.first_name} {employee.last_name}")
-        if not result:
-            return ''
-        return ",".join(result)
+        return self.employee_names
 
     @property
     def sum_hotel_checkboxes(self):
-        return self.employee_works.filter(hotel=True).count()
+        return self.hotel_count
 
     @property
     def sum_per_diem_checkboxes(self):
-        return self.employee_works.filter(per_diem=True).count()
+        return self.per_diem_count
+
+    @staticmethod
+    def compute_totals(ids):
+        """Return the work block totals of the given tickets from two queries."""
+        totals = {
+            st_id: {
+                'worked_duration': timedelta(0), 'mileage_total': None,
+                'employee_names': [], 'hotel_count': 0, 'per_diem_count': 0,
+            }
+            for st_id in ids
+        }
+        rows = EmployeeWorkBlock.objects.filter(service_ticket__in=ids).values('service_ticket').annotate(
+            worked=Sum(WORKED_DURATION),
+            mileage=Sum('mileage'),
+            hotels=Count('id', filter=Q(hotel=True)),
+            per_diems=Count('id', filter=Q(per_diem=True)),
+        ).order_by()
+        for row in rows:
+            st_totals = totals[row['service_ticket']]
+            st_totals['worked_duration'] = row['worked'] or timedelta(0)
+            st_totals['mileage_total'] = row['mileage']
+            st_totals['hotel_count'] = row['hotels']
+            st_totals['per_diem_count'] = row['per_diems']
+        names = EmployeeWorkBlock.objects.filter(service_ticket__in=ids).order_by('id').values_list(
+            'service_ticket', 'employee__first_name', 'employee__last_name'
+        )
+        for st_id, first_name, last_name in names:
+            totals[st_id]['employee_names'].append(f"{first_name} {last_name}")
+        for st_totals in totals.values():
+            st_totals['employee_names'] = ",".join(st_totals['employee_names'])
+        return totals
+
+    @classmethod
+    def refresh_totals(cls, ids):
+        """Store freshly computed work block totals on the given tickets."""
+        for st_id, st_totals in cls.compute_totals(set(ids)).items():
+            cls.objects.filter(pk=st_id).update(**st_totals)
+        # employee names are searchable
+        cls.refresh_search_documents(cls.objects.filter(pk__in=ids))
 
     def clean_status(self):
         self.validate_status()
@@ -565,7 +781,7 @@ class ServiceTicket(CommonInfo, ServicABC, ServiceTicketActionNotifications):
                     'Please write the reason for Service Ticket rejection'
                 })
         # Restrict reassigning ST to another Job
-        if self._original_connected_job and self._original_connected_job != self.connected_job:
+        if self._original_connected_job_id and self._original_connected_job_id != self.connected_job_id:
             raise ValidationError({'connected_job': mark_safe(
                     "Service Ticket can not be reassigned to another Job."
                 )}
@@ -592,6 +808,13 @@ class ServiceTicket(CommonInfo, ServicABC, ServiceTicketActionNotifications):
                 self.approved_timestamp = None
         elif self.status == ServiceTicket.APPROVED and self._original_status != self.status:
             self.approved_timestamp = datetime.now(timezone.utc)
+        if not self._state.adding and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            # derived columns are written only by refresh_totals and refresh_search_documents,
+            # an instance loaded earlier may hold stale values
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.TOTALS_FIELDS + ('search_document',)
+            ]
         super().save(*args, **kwargs)
 
     def delete(self, *args, **kwargs):
@@ -641,6 +864,13 @@ class EmployeeWorkBlock(CleanFieldsModelMixin, models.Model):
     mileage = DecimalField(_('Mileage'))
     hotel = models.BooleanField(_('Hotel'), blank=True, null=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['employee', 'start_time', 'end_time'], name='work_block_overlap_idx'),
+            # ticket visibility check for mechanics
+            models.Index(fields=['employee', 'service_ticket'], name='work_block_employee_st_idx'),
+        ]
+
     @property
     def hours_worked(self):
         if not self.start_time or not self.end_time:
@@ -648,7 +878,6 @@ class EmployeeWorkBlock(CleanFieldsModelMixin, models.Model):
         return self.end_time - self.start_time
 
     def clean_employee(self):
-        print(self.start_time, self.end_time)
         if self.employee:
             mech_in_job = self.service_ticket.connected_job.mechanics.filter(id=self.employee.id)
             if not mech_in_job.exists():
@@ -664,4 +893,382 @@ class EmployeeWorkBlock(CleanFieldsModelMixin, models.Model):
             msg = 'Start Time can not be ahead of the End Time'
             raise ValidationError({'start_time': _(msg)})
 
+class ServiceTicketExport(models.Model):
+    """Background ZIP export of the Service Tickets of a Job."""
+
+    QUEUED = 1
+    RUNNING = 2
+    DONE = 3
+    FAILED = 4
+
+    STATUSES = (
+        (QUEUED, 'Queued',),
+        (RUNNING, 'Running',),
+        (DONE, 'Done',),
+        (FAILED, 'Failed',),
+    )
+    PENDING_STATUSES = (QUEUED, RUNNING)
+
+    job = models.ForeignKey(Job, on_delete=models.CASCADE, related_name='exports')
+    requested_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='service_ticket_exports'
+    )
+    status = models.PositiveSmallIntegerField(_('Status'), choices=STATUSES, default=QUEUED)
+    total = models.PositiveIntegerField(_('Total tickets'), default=0)
+    processed = models.PositiveIntegerField(_('Processed tickets'), default=0)
+    file = models.FileField(_('File'), upload_to='service_ticket_exports/', blank=True, null=True)
+    error = models.TextField(_('Error'), blank=True)
+    created_at = models.DateTimeField(_('Created at'), auto_now_add=True)
+    started_at = models.DateTimeField(_('Started at'), blank=True, null=True)
+    finished_at = models.DateTimeField(_('Finished at'), blank=True, null=True)
+
+    class Meta:
+        ordering = ('-created_at',)
+
+    @classmethod
+    def fail_stale(cls, **filters):
+        """
+        Mark the exports queued or running for longer than SERVICE_TICKET_EXPORT_TIMEOUT
+        as failed, e.g. when the worker building them was killed.
+        """
+        cutoff = timezone.now() - timedelta(seconds=getattr(settings, 'SERVICE_TICKET_EXPORT_TIMEOUT', 60 * 60))
+        return cls.objects.filter(
+            Q(status=cls.QUEUED, created_at__lt=cutoff) | Q(status=cls.RUNNING, started_at__lt=cutoff),
+            **filters
+        ).update(status=cls.FAILED, error='Export timed out', finished_at=timezone.now())
+
+    def delete(self, *args, **kwargs):
+        super().delete(*args, **kwargs)
+        try:
+            delete_file(self.file.path)
+        except ValueError:  # file can be null
+            pass
+
+
+class PendingStatusChange(models.Model):
+    """
+    Outbox of Job and Service Ticket status changes waiting for their notifications.
+    Rows are written in the transaction of the status change, so a rollback drops
+    them too, and apps.utils.notification_dispatch drains them in windows.
+    """
+    object_label = models.CharField(_('Model'), max_length=100)
+    object_id = models.PositiveIntegerField(_('Object id'))
+    original_status = models.PositiveSmallIntegerField(_('Original status'), choices=CommonInfo.STATUSES)
+    status = models.PositiveSmallIntegerField(_('Status'), choices=CommonInfo.STATUSES)
+    created_at = models.DateTimeField(_('Created at'), auto_now_add=True)
+
+    class Meta:
+        ordering = ('id',)
+
+
+class DailyWorkRollup(models.Model):
+    """
+    Hours per day and mechanic for the reports.
+    Rows with a job hold the work of approved Service Tickets of that job,
+    rows with a time code hold the approved Indirect Hours of that code.
+    Both kinds are rebuilt by slice: refresh_jobs and refresh_employee_days for tickets,
+    refresh_indirect_days for indirect hours. A slice is rebuilt under a lock
+    (the rows of its jobs, the time codes for indirect days), concurrent refreshes
+    of one slice run one after the other instead of both inserting its rows.
+    """
+    day = models.DateField(_('Day'))
+    mechanic = models.ForeignKey(Mechanic, on_delete=models.CASCADE, related_name='work_rollups')
+    job = models.ForeignKey(Job, on_delete=models.CASCADE, blank=True, null=True)
+    time_code = models.ForeignKey('time_tracker.TimeCode', on_delete=models.CASCADE, blank=True, null=True)
+    worked = models.DurationField(_('Worked time'), default=timedelta(0))
+    indirect_hours = models.DecimalField(_('Indirect hours'), max_digits=7, decimal_places=2, default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['day', 'mechanic'], name='work_rollup_day_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['day', 'mechanic', 'job'], condition=Q(job__isnull=False),
+                name='work_rollup_job_unique',
+            ),
+            models.UniqueConstraint(
+                fields=['day', 'mechanic', 'time_code'], condition=Q(time_code__isnull=False),
+                name='work_rollup_time_code_unique',
+            ),
+        ]
+
+    @classmethod
+    def refresh_jobs(cls, job_ids):
+        """Rebuild the ticket rows of the given jobs from their approved, not archived tickets."""
+        job_ids = {job_id for job_id in job_ids if job_id is not None}
+        cls._rebuild_ticket_rows(job_ids, Q(service_ticket__connected_job__in=job_ids), Q(job__in=job_ids))
+
+    @classmethod
+    def refresh_employee_days(cls, job_id, day, mechanic_ids):
+        """Rebuild the ticket rows of the given mechanics on one day of a job."""
+        mechanic_ids = {mechanic_id for mechanic_id in mechanic_ids if mechanic_id is not None}
+        if day is None or not mechanic_ids:
+            return
+        cls._rebuild_ticket_rows(
+            {job_id},
+            Q(service_ticket__connected_job=job_id, service_ticket__date=day, employee__in=mechanic_ids),
+            Q(job=job_id, day=day, mechanic__in=mechanic_ids),
+        )
+
+    @classmethod
+    def _rebuild_ticket_rows(cls, job_ids, work_blocks_filter, rows_filter):
+        rows = EmployeeWorkBlock.objects.filter(
+            work_blocks_filter,
+            service_ticket__status=CommonInfo.APPROVED,
+            service_ticket__is_archive=False,
+            service_ticket__date__isnull=False,
+            start_time__isnull=False,
+            end_time__isnull=False,
+        ).values('service_ticket__date', 'employee', 'service_ticket__connected_job').annotate(
+            total=Sum(WORKED_DURATION)
+        ).order_by()
+        with transaction.atomic():
+            # a concurrent refresh of these jobs waits here until this one commits
+            list(Job.objects.select_for_update().filter(id__in=job_ids).order_by('id').values_list('id'))
+            cls.objects.filter(rows_filter).delete()
+            cls.objects.bulk_create(
+                cls(
+                    day=row['service_ticket__date'], mechanic_id=row['employee'],
+                    job_id=row['service_ticket__connected_job'], worked=row['total'],
+                )
+                for row in rows
+            )
+
+    @classmethod
+    def refresh_indirect_days(cls, days):
+        """Rebuild the indirect hours rows of the given days."""
+        from apps.time_tracker.models import IndirectHours, TimeCode
+
+        days = {day for day in days if day is not None}
+        rows = IndirectHours.mechanic.through.objects.filter(
+            indirecthours__date__in=days,
+            indirecthours__status=IndirectHours.APPROVED,
+            indirecthours__is_archive=False,
+        ).values('indirecthours__date', 'mechanic', 'indirecthours__time_code').annotate(
+            total=Sum('indirecthours__hours')
+        ).order_by()
+        with transaction.atomic():
+            # a day holds the rows of every time code, so the (few) codes are all locked
+            list(TimeCode.objects.select_for_update().order_by('id').values_list('id'))
+            cls.objects.filter(day__in=days, time_code__isnull=False).delete()
+            cls.objects.bulk_create(
+                cls(
+                    day=row['indirecthours__date'], mechanic_id=row['mechanic'],
+                    time_code_id=row['indirecthours__time_code'], indirect_hours=row['total'],
+                )
+                for row in rows
+            )
+
+    @classmethod
+    def worked_hours_by_mechanic(cls, start_date, end_date, mechanic_ids=None):
+        """{mechanic_id: hours} of approved ticket work in the date range."""
+        rows = cls.objects.filter(day__range=(start_date, end_date), job__isnull=False)
+        if mechanic_ids is not None:
+            rows = rows.filter(mechanic__in=mechanic_ids)
+        totals = rows.values('mechanic').annotate(total=Sum('worked')).order_by()
+        return {row['mechanic']: round(row['total'] / timedelta(hours=1), 2) for row in totals}
+
+    @classmethod
+    def indirect_hours_by_mechanic(cls, start_date, end_date, mechanic_ids=None):
+        """{mechanic_id: {time_code_name: hours}} of approved indirect hours in the date range."""
+        rows = cls.objects.filter(day__range=(start_date, end_date), time_code__isnull=False)
+        if mechanic_ids is not None:
+            rows = rows.filter(mechanic__in=mechanic_ids)
+        totals = rows.values('mechanic', 'time_code__name').annotate(total=Sum('indirect_hours')).order_by()
+        result = {}
+        for row in totals:
+            result.setdefault(row['mechanic'], {})[row['time_code__name']] = row['total']
+        return result
+
+
+_deferred_totals = local()
+
+
+@contextmanager
+def deferred_totals_refresh(*ids):
+    """
+    Refresh ticket totals once when the block exits instead of on every work block signal.
+    Tickets changed with bulk queries (no signals) are passed in ids.
+    """
+    if getattr(_deferred_totals, 'ids', None) is not None:  # nested
+        _deferred_totals.ids.update(ids)
+        yield
+        return
+    _deferred_totals.ids = set(ids)
+    try:
+        yield
+        st_ids = _deferred_totals.ids
+    finally:
+        _deferred_totals.ids = None
+    ServiceTicket.refresh_totals(st_ids)
+    # bulk queries don't tell which employees changed, the whole jobs are rebuilt
+    DailyWorkRollup.refresh_jobs(
+        ServiceTicket.objects.filter(id__in=st_ids, status=CommonInfo.APPROVED).values_list(
+            'connected_job_id', flat=True
+        )
+    )
+
+
 auditlog.register(ServiceTicket)
+
+
+@receiver(post_save, sender=DBLockDate)
+@receiver(post_delete, sender=DBLockDate)
+@receiver(post_save, sender=Settings)
+@receiver(post_delete, sender=Settings)
+def invalidate_singleton_cache(sender, **kwargs):
+    sender.invalidate_cache()
+    # reads between the save and the commit may have cached the old row again
+    transaction.on_commit(sender.invalidate_cache)
+
+
+@receiver(post_save, sender=Job)
+def refresh_job_search_documents(sender, instance, created=False, **kwargs):
+    Job.refresh_search_documents(Job.objects.filter(pk=instance.pk))
+    ticket_search_values = instance.ticket_search_values()
+    if not created and ticket_search_values != instance._original_ticket_search_values:
+        ServiceTicket.refresh_search_documents(ServiceTicket.objects.filter(connected_job=instance.pk))
+    instance._original_ticket_search_values = ticket_search_values
+
+
+@receiver(post_save, sender=ServiceTicket)
+def refresh_service_ticket_search_document(sender, instance, **kwargs):
+    ServiceTicket.refresh_search_documents(ServiceTicket.objects.filter(pk=instance.pk))
+
+
+@receiver(post_save, sender=ServiceTicket)
+def refresh_service_ticket_rollup(sender, instance, **kwargs):
+    if CommonInfo.APPROVED in (instance.status, instance._original_status):
+        DailyWorkRollup.refresh_jobs([instance.connected_job_id])
+
+
+@receiver(pre_save, sender=EmployeeWorkBlock)
+def remember_work_block_employee(sender, instance, **kwargs):
+    if instance.pk is not None:
+        instance._rollup_original_employee_id = sender.objects.filter(pk=instance.pk).values_list(
+            'employee', flat=True
+        ).first()
+
+
+@receiver(post_save, sender=EmployeeWorkBlock)
+@receiver(post_delete, sender=EmployeeWorkBlock)
+def refresh_work_block_rollup(sender, instance, **kwargs):
+    if getattr(_deferred_totals, 'ids', None) is not None:
+        return  # refreshed by deferred_totals_refresh
+    service_ticket = ServiceTicket.objects.filter(
+        pk=instance.service_ticket_id, status=CommonInfo.APPROVED
+    ).values('connected_job', 'date').first()
+    if service_ticket is not None:
+        DailyWorkRollup.refresh_employee_days(
+            service_ticket['connected_job'], service_ticket['date'],
+            {instance.employee_id, getattr(instance, '_rollup_original_employee_id', None)}
+        )
+
+
+@receiver(pre_save, sender='time_tracker.IndirectHours')
+def remember_indirect_hours_day(sender, instance, **kwargs):
+    if instance.pk is not None:
+        instance._rollup_original_date = sender.objects.filter(pk=instance.pk).values_list('date', flat=True).first()
+
+
+@receiver(post_save, sender='time_tracker.IndirectHours')
+@receiver(post_delete, sender='time_tracker.IndirectHours')
+def refresh_indirect_hours_rollup(sender, instance, **kwargs):
+    DailyWorkRollup.refresh_indirect_days({instance.date, getattr(instance, '_rollup_original_date', None)})
+
+
+@receiver(m2m_changed)
+def refresh_indirect_hours_mechanics_rollup(sender, instance, action, reverse, pk_set=None, **kwargs):
+    # m2m_changed takes no lazy senders, so the IndirectHours.mechanic through model is matched here
+    through_owner = sender._meta.auto_created
+    if not through_owner or through_owner._meta.label != 'time_tracker.IndirectHours':
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        days = [instance.date]
+    elif pk_set:  # instance is a Mechanic, pk_set holds IndirectHours ids
+        days = through_owner.objects.filter(pk__in=pk_set).values_list('date', flat=True)
+    else:  # cleared from the Mechanic side, the days it had rows on
+        days = DailyWorkRollup.objects.filter(
+            mechanic=instance.pk, time_code__isnull=False
+        ).values_list('day', flat=True)
+    DailyWorkRollup.refresh_indirect_days(days)
+
+
+@receiver(post_save, sender=Customer)
+@receiver(post_save, sender=Location)
+def refresh_search_documents_for_names(sender, instance, created=False, **kwargs):
+    if created:
+        return
+    lookup = 'customer' if sender is Customer else 'location'
+    Job.refresh_search_documents(Job.objects.filter(**{lookup: instance.pk}))
+    ServiceTicket.refresh_search_documents(
+        ServiceTicket.objects.filter(**{f'connected_job__{lookup}': instance.pk})
+    )
+
+
+
+
+# Users are saved through their proxy models too (Mechanic, Manager, ...),
+# which send the proxy as sender, so these receivers take any sender.
+@receiver(pre_save)
+def remember_user_names(sender, instance, **kwargs):
+    if isinstance(instance, User) and instance.pk is not None:
+        instance._original_names = User.objects.filter(pk=instance.pk).values_list(
+            'first_name', 'last_name'
+        ).first()
+
+
+def is_user_renamed(instance):
+    original_names = getattr(instance, '_original_names', None)
+    return original_names is not None and original_names != (instance.first_name, instance.last_name)
+
+
+@receiver(post_save)
+def refresh_employee_names_for_user(sender, instance, **kwargs):
+    if not isinstance(instance, User) or not is_user_renamed(instance):
+        return
+    st_ids = list(
+        EmployeeWorkBlock.objects.filter(employee=instance.pk).values_list('service_ticket', flat=True).distinct()
+    )
+    for start in range(0, len(st_ids), 500):
+        ServiceTicket.refresh_totals(st_ids[start:start + 500])
+
+
+@receiver(post_save)
+def refresh_search_documents_for_user(sender, instance, **kwargs):
+    if not isinstance(instance, User) or not is_user_renamed(instance):
+        return
+    # tickets the user worked on are refreshed with their employee names above
+    Job.refresh_search_documents(Job.objects.filter(created_by=instance.pk))
+    ServiceTicket.refresh_search_documents(ServiceTicket.objects.filter(created_by=instance.pk))
+
+
+@receiver(post_save, sender=Job)
+def invalidate_job_pdf_cache(sender, instance, **kwargs):
+    ServiceTicketPDFCache.invalidate(job_ids=[instance.pk])
+
+
+@receiver(post_save, sender=ServiceTicket)
+def invalidate_service_ticket_pdf_cache(sender, instance, **kwargs):
+    ServiceTicketPDFCache.invalidate(st_ids=[instance.pk])
+
+
+@receiver(post_save, sender=EmployeeWorkBlock)
+@receiver(post_delete, sender=EmployeeWorkBlock)
+def refresh_service_ticket_totals(sender, instance, **kwargs):
+    deferred = getattr(_deferred_totals, 'ids', None)
+    if deferred is not None:
+        deferred.add(instance.service_ticket_id)
+    else:
+        ServiceTicket.refresh_totals([instance.service_ticket_id])
+
+
+@receiver(post_save, sender=EmployeeWorkBlock)
+@receiver(post_delete, sender=EmployeeWorkBlock)
+@receiver(post_save, sender=Attachment)
+@receiver(post_delete, sender=Attachment)
+def invalidate_related_pdf_cache(sender, instance, **kwargs):
+    ServiceTicketPDFCache.invalidate(st_ids=[instance.service_ticket_id])
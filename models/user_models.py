@@ -4,6 +4,9 @@ from django.contrib.auth.models import (
     AbstractBaseUser, Permission, PermissionsMixin,
 )
 from django.db import models, transaction
+from django.db.models.signals import m2m_changed
+from django.dispatch import receiver
+from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _
 
 from .managers import (
@@ -57,21 +60,40 @@ class User(AbstractBaseUser, PermissionsMixin):
     def __str__(self):
         return self.get_full_name()
 
+    @cached_property
+    def cached_groups(self):
+        """
+        User groups loaded once per instance. request.user lives as long as
+        the request, so all role checks of a request share a single query.
+        Uses prefetched groups when the queryset has them.
+        """
+        return list(self.groups.all())
+
+    def reset_role_cache(self):
+        self.__dict__.pop('cached_groups', None)
+
+    def refresh_from_db(self, *args, **kwargs):
+        self.reset_role_cache()
+        super().refresh_from_db(*args, **kwargs)
+
+    def _in_group(self, name):
+        return any(group.name == name for group in self.cached_groups)
+
     @property
     def is_admin(self):
-        return self.groups.filter(name='admin').exists()
+        return self._in_group('admin')
 
     @property
     def is_manager(self):
-        return self.groups.filter(name='Manager').exists()
+        return self._in_group('Manager')
 
     @property
     def is_biller(self):
-        return self.groups.filter(name='Biller').exists()
+        return self._in_group('Biller')
 
     @property
     def is_mechanic(self):
-        return self.groups.filter(name='Mechanic').exists()
+        return self._in_group('Mechanic')
 
     @property
     def is_status_archived(self):
@@ -142,29 +164,24 @@ class Mechanic(User):
         verbose_name = 'Mechanic'
         verbose_name_plural = 'Mechanics'
 
-    def get_unique_indirect_hours(self, queryset):
-        # TODO: Optimize it
-        unique_time_codes = set(queryset.values_list('time_code__name', flat=True))
-        unique_indirect_hours = {time_code: 0 for time_code in unique_time_codes}
-        for indirect_hour in queryset:
-            unique_indirect_hours[indirect_hour.time_code.name] += indirect_hour.hours
-        return unique_indirect_hours
+    def get_unique_indirect_hours(self, start_date, end_date):
+        """Approved indirect hours in the date range summed per time code name."""
+        return self.get_indirect_hours_by_mechanic(start_date, end_date, [self.pk]).get(self.pk, {})
+
+    @staticmethod
+    def get_indirect_hours_by_mechanic(start_date, end_date, mechanic_ids=None):
+        """{mechanic_id: {time_code_name: hours}} of approved indirect hours in the date range, in one query."""
+        from apps.api.models import DailyWorkRollup
+        return DailyWorkRollup.indirect_hours_by_mechanic(start_date, end_date, mechanic_ids)
 
     def get_total_working_time(self, start_date, end_date):
-        # TODO: Optimize it
-        from apps.api.models import CommonInfo
-        qs = self.employeeworkblock_set.filter(
-            service_ticket__status=CommonInfo.APPROVED,
-            service_ticket__date__gte=start_date,
-            service_ticket__date__lte=end_date,
-            service_ticket__is_archive=False,
-            start_time__isnull=False,
-            end_time__isnull=False
-        )
-        sum = 0
-        for instance in qs:
-            sum += instance.hours_worked.total_seconds()
-        return round(sum / 3600, 2)
+        return self.get_total_working_time_by_mechanic(start_date, end_date, [self.pk]).get(self.pk, 0)
+
+    @staticmethod
+    def get_total_working_time_by_mechanic(start_date, end_date, mechanic_ids=None):
+        """{mechanic_id: hours} for every mechanic with approved work in the date range, in one query."""
+        from apps.api.models import DailyWorkRollup
+        return DailyWorkRollup.worked_hours_by_mechanic(start_date, end_date, mechanic_ids)
 
 
 class Superuser(User):
@@ -178,3 +195,10 @@ class Superuser(User):
         proxy = True
         verbose_name = 'Superuser'
         verbose_name_plural = 'Superusers'
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def reset_user_role_cache(sender, instance, action, reverse, **kwargs):
+    """Forget cached role flags when groups are changed through the user instance."""
+    if not reverse and action in ('post_add', 'post_remove', 'post_clear'):
+        instance.reset_role_cache()
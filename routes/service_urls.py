@@ -15,7 +15,13 @@ router.register(r'customers', views.CustomerViewSet, basename='customer')
 urlpatterns = [
     path('db-lock/', views.DBLockView.as_view(), name='db-lock-view'),
     path('export-service-tickets/<int:job_id>/', views.ServiceTicketExportView.as_view(),
-         name='service-ticket-export-view')
+         name='service-ticket-export-view'),
+    path('service-ticket-exports/<int:export_id>/', views.ServiceTicketExportStatusView.as_view(),
+         name='service-ticket-export-status'),
+    path('service-ticket-exports/<int:export_id>/download/', views.ServiceTicketExportDownloadView.as_view(),
+         name='service-ticket-export-download'),
+    path('notifications/dispatch-stats/', views.NotificationDispatchStatsView.as_view(),
+         name='notification-dispatch-stats'),
 ]
 
 urlpatterns += router.urls
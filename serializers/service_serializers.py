@@ -1,12 +1,16 @@
 import os
 from collections import OrderedDict
-from datetime import datetime, timedelta
+from datetime import datetime
 from dateutil.parser import parse
 
 from django.conf import settings
 from django.core.exceptions import ValidationError as DjangoValidationError
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Q, prefetch_related_objects
 from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.safestring import mark_safe
 from django.utils.translation import gettext_lazy as _
 
 from drf_yasg.openapi import Schema
@@ -21,7 +25,10 @@ from apps.utils.fields import IntegerChoiceField
 from apps.utils.request_middleware import RequestMiddleware
 from .constants import US_STATES
 from .exceptions import DBLockedException
-from .models import Attachment, Customer, DBLockDate, EmployeeWorkBlock, Location, Job, ServiceTicket
+from .models import (
+    Attachment, Customer, DBLockDate, EmployeeWorkBlock, Location, Job, ServiceTicket, ServiceTicketExport,
+    deferred_totals_refresh,
+)
 
 
 class LocationSerializer(serializers.ModelSerializer):
@@ -89,7 +96,7 @@ class JobReadSerializer(serializers.ModelSerializer):
     managers = ManagerSerializer(many=True)
     approved_tickets = serializers.SerializerMethodField()
     total_tickets = serializers.SerializerMethodField()
-    get_time_worked = serializers.SerializerMethodField()
+    time_worked = serializers.SerializerMethodField()
     creation_date = serializers.DateTimeField(format='%m-%d-%Y')
     request_date = serializers.DateTimeField(format='%m-%d-%Y')
     update_date = serializers.DateField()
@@ -113,12 +120,16 @@ class JobReadSerializer(serializers.ModelSerializer):
         return obj.location.name
 
     def get_time_worked(self, obj):
-        return obj.time_worked/timedelta(hours=1)
+        return obj.time_worked
 
     def get_approved_tickets(self, obj):
+        if hasattr(obj, 'approved_tickets_count'):  # see JobQuerySet.with_list_counters
+            return obj.approved_tickets_count
         return obj.serviceticket_set.filter(status=ServiceTicket.APPROVED).count()
 
     def get_total_tickets(self, obj):
+        if hasattr(obj, 'total_tickets_count'):
+            return obj.total_tickets_count
         return obj.serviceticket_set.count()
 
 
@@ -138,7 +149,7 @@ class JobWriteSerializer(serializers.ModelSerializer):
         )
 
     def validate_created_by(self, value):
-        if value.groups.get().name == 'Mechanic':
+        if value.is_mechanic:
             raise ValidationError({'created_by': 'Job cannot be created by Mechanic.'})
         return value
 
@@ -263,6 +274,74 @@ class DeleteEmployeeWorksSerializer(serializers.Serializer):
         return employee_works
 
 
+class EmployeeWorkBlockListSerializer(serializers.ListSerializer):
+    """
+    Checks that the work blocks don't overlap each other or the stored blocks
+    of the same employees, with a single query for the whole list.
+    """
+    overlap_message = 'One or more mechanics were working during these hours'
+
+    def to_internal_value(self, data):
+        blocks = super().to_internal_value(data)
+        overlapping = self.find_overlaps(blocks)
+        if overlapping:
+            raise ValidationError([
+                {'time': [self.overlap_message]} if index in overlapping else {}
+                for index in range(len(blocks))
+            ])
+        return blocks
+
+    @staticmethod
+    def _as_stored(value):
+        """Bring a parsed datetime to the form the DB returns it in."""
+        if settings.USE_TZ and timezone.is_naive(value):
+            return timezone.make_aware(value)
+        if not settings.USE_TZ and timezone.is_aware(value):
+            return timezone.make_naive(value)
+        return value
+
+    def find_overlaps(self, blocks):
+        """Return the indexes of the blocks overlapping other work of their employee."""
+        timed = [
+            (index, block['employee'].pk, self._as_stored(block['start_time']), self._as_stored(block['end_time']))
+            for index, block in enumerate(blocks)
+            if block.get('employee') is not None and block.get('start_time') and block.get('end_time')
+        ]
+        if not timed:
+            return set()
+        overlapping = set()
+
+        # overlaps inside the request, each block is compared with the block
+        # ending last among the earlier ones of its employee
+        timed.sort(key=lambda item: item[1:3])
+        latest = None
+        for current in timed:
+            if latest is not None and latest[1] == current[1] and current[2] < latest[3]:
+                overlapping.update((latest[0], current[0]))
+            if latest is None or latest[1] != current[1] or current[3] > latest[3]:
+                latest = current
+
+        # overlaps with the stored blocks
+        conditions = Q()
+        for _index, employee_id, start, end in timed:
+            conditions |= Q(employee_id=employee_id, start_time__lt=end, end_time__gt=start)
+        stored = EmployeeWorkBlock.objects.filter(conditions).exclude(
+            id__in=[block['id'] for block in blocks if block.get('id') is not None]
+        )
+        service_ticket = getattr(self.parent, 'instance', None)
+        if isinstance(service_ticket, ServiceTicket):
+            # blocks of the updated ticket are replaced by the request ones
+            stored = stored.exclude(service_ticket=service_ticket)
+        stored = list(stored.values_list('employee_id', 'start_time', 'end_time'))
+        for index, employee_id, start, end in timed:
+            if any(
+                stored_employee_id == employee_id and stored_start < end and stored_end > start
+                for stored_employee_id, stored_start, stored_end in stored
+            ):
+                overlapping.add(index)
+        return overlapping
+
+
 class EmployeeWorkBlockSerializer(serializers.ModelSerializer):
     # make id field not read_only to get it in validated_data
     id = serializers.IntegerField(label='ID', required=False)
@@ -281,6 +360,7 @@ class EmployeeWorkBlockSerializer(serializers.ModelSerializer):
             'start_time', 'end_time', 'mileage', 'hotel', 'per_diem',
             'hours_worked', 'employee', 'id',
         )
+        list_serializer_class = EmployeeWorkBlockListSerializer
         extra_kwargs = {
             'employee': {
                 'error_messages': {
@@ -315,34 +395,14 @@ class EmployeeWorkBlockSerializer(serializers.ModelSerializer):
     def validate(self, data):
         in_time = data.get('start_time')
         out_time = data.get('end_time')
-        workblock_id = data.get('id', None)
-
 
         if in_time is None or out_time is None:
             raise ValidationError({'time': 'Enter both start and end time for the work'})
 
-        if (in_time and out_time) and (in_time > out_time):
+        if in_time > out_time:
             msg = 'Start Time can not be ahead of the End Time'
             raise ValidationError({'start_time': _(msg)})
-
-        time_overlap_qs = EmployeeWorkBlock.objects.filter(employee=data.get('employee')) \
-            .filter(
-            (Q(start_time__lt=out_time) & Q(end_time__gt=in_time))
-        )
-
-        print("serializers.py", in_time, out_time, workblock_id, time_overlap_qs.exclude(id=workblock_id).count())
-
-        """
-        .filter((Q(start_time__gte=start_time) & Q(end_time__lte=end_time)) |
-                (Q(start_time__lte=end_time) & Q(end_time__gte=end_time)) |
-                (Q(start_time__lte=start_time) & Q(end_time__gte=start_time)) |
-                (Q(start_time__lte=start_time) & Q(end_time__gte=end_time)))
-        """
-
-        if (workblock_id is not None and time_overlap_qs.exclude(id=workblock_id).count() > 0) or \
-                (workblock_id is None and time_overlap_qs.count() > 0):
-            raise ValidationError({'time': 'One or more mechanics were working during these hours'})
-
+        # overlaps are checked for all blocks at once in EmployeeWorkBlockListSerializer
         return data
 
 
@@ -443,12 +503,14 @@ class ServiceTicketWriteSerializer(serializers.ModelSerializer):
         }
 
     def to_representation(self, instance):
+        # work blocks were just written in bulk, load them with their employees at once
+        prefetch_related_objects([instance], 'employee_works__employee')
         return ServiceTicketReadSerializer(
             instance, context={'request': RequestMiddleware.get_request()}
         ).data
 
     def validate_created_by(self, value):
-        if value.groups.get().name == 'Biller':
+        if value.is_biller:
             raise ValidationError(
                 {'created_by': 'Service Ticket cannot be created by Biller.'}
             )
@@ -474,56 +536,74 @@ class ServiceTicketWriteSerializer(serializers.ModelSerializer):
         employee_works_data = validated_data.pop('employee_works', [])
         attachments_data = validated_data.pop('attachments', [])
         try:
-            service_ticket = ServiceTicket.objects.create(created_by=created_by, **validated_data)
-            for employee_work_data in employee_works_data:
-                EmployeeWorkBlock.objects.create(
-                    service_ticket=service_ticket, **employee_work_data
-                ).clean_employee()
-
-            for attachment_data in attachments_data:
-                Attachment.objects.create(service_ticket=service_ticket, **attachment_data)
+            with transaction.atomic():
+                service_ticket = ServiceTicket.objects.create(created_by=created_by, **validated_data)
+                self.sync_employee_works(service_ticket, employee_works_data, created=True)
+                Attachment.objects.bulk_create(
+                    Attachment(service_ticket=service_ticket, **attachment_data)
+                    for attachment_data in attachments_data
+                )
         except DjangoValidationError as error:
             # raise DRF ValidationError instead of Django one
             raise ValidationError(detail=serializers.as_serializer_error(error))
         return service_ticket
 
+    def sync_employee_works(self, service_ticket, employee_works_data, created=False):
+        """
+        Make the ticket work blocks match employee_works_data with one bulk insert,
+        one bulk update and one delete.
+        """
+        job_mechanic_ids = set(service_ticket.connected_job.mechanics.values_list('id', flat=True))
+        existing = {} if created else {block.id: block for block in service_ticket.employee_works.all()}
+        to_create, to_update, update_fields = [], [], set()
+        for employee_work_data in employee_works_data:
+            employee_work_data = dict(employee_work_data)
+            employee = employee_work_data.get('employee')
+            if employee is None:
+                raise ValidationError(
+                    {'employee': _('Employee is required for creating Service Ticket.')}
+                )
+            if employee.id not in job_mechanic_ids:
+                raise ValidationError(
+                    {'employee': mark_safe("Selected employee is not present in the related Job.")}
+                )
+            id = employee_work_data.pop('id', None)
+            if id is None:
+                to_create.append(EmployeeWorkBlock(service_ticket=service_ticket, **employee_work_data))
+                continue
+            employee_work = existing.pop(id, None)
+            if employee_work is None:
+                raise ValidationError({'employee_works': _(
+                    f"employee_work with id {id} doesn't exist in this ServiceTicket."
+                )})
+            for field, value in employee_work_data.items():
+                setattr(employee_work, field, value)
+            update_fields.update(employee_work_data)
+            to_update.append(employee_work)
+
+        with transaction.atomic(), deferred_totals_refresh(service_ticket.id):
+            if existing:  # blocks missing from the request
+                EmployeeWorkBlock.objects.filter(id__in=existing).delete()
+            if to_create:
+                EmployeeWorkBlock.objects.bulk_create(to_create)
+            if to_update and update_fields:
+                EmployeeWorkBlock.objects.bulk_update(to_update, update_fields)
+        service_ticket.refresh_from_db(fields=ServiceTicket.TOTALS_FIELDS)
+
     def update_employee_works(self, service_ticket, employee_works_data):
         employee_works = service_ticket.employee_works
 
         # delete all if employee_works for this ST if employee_works is empty str in request body
         if self.initial_data.get('employee_works') == '':
-            employee_works.all().delete()
+            with deferred_totals_refresh(service_ticket.id):
+                employee_works.all().delete()
+            service_ticket.refresh_from_db(fields=ServiceTicket.TOTALS_FIELDS)
             return None
 
         if employee_works_data is None:  # there is no employee_works_data in request body
             return None
 
-        all_ids = set(employee_works.values_list('id', flat=True))
-        ids_to_update = set()
-        for employee_work_data in employee_works_data:
-            employee = employee_work_data.get('employee')
-            if employee is None:
-                raise ValidationError(
-                    {'employee': _('Employee is required for creating Service Ticket.')}
-                )
-            # employee in validated_data is Mechanic object
-            employee_work_data.update({'employee': employee.id})
-            EmployeeWorkBlockSerializer(data=employee_work_data).is_valid(raise_exception=True)
-            id = employee_work_data.get('id', None)
-            if id is None:
-                employee_work_instance = employee_works.create(
-                    employee_id=employee.id, service_ticket=service_ticket
-                )
-            else:
-                employee_work_instance = employee_works.get(id=id)
-                ids_to_update.add(id)
-            # FIXME: if there is no employee_work with such id in this service_ticket
-            #        and id is not None error will be raised
-            # update works only on QuerySet
-            employee_works.filter(id=employee_work_instance.id).update(**dict(employee_work_data))
-        redundant_ids = all_ids - ids_to_update
-        for redundant_id in redundant_ids:
-            employee_works.get(id=redundant_id).delete()
+        self.sync_employee_works(service_ticket, employee_works_data)
 
     def update_attachments(self, service_ticket, attachments_data):
         attachments = service_ticket.attachments
@@ -537,14 +617,24 @@ class ServiceTicketWriteSerializer(serializers.ModelSerializer):
         if attachments_data is None:  # there is no attachments in request body
             return None
 
+        existing = {attachment.id: attachment for attachment in attachments.all()}
+        to_create, to_update = [], []
         for attachment_data in attachments_data:
             id = attachment_data.get('id', None)
             if id is None:
-                attachment_instance = attachments.create(**attachment_data)
-            else:
-                attachment_instance = attachments.get(id=id)
+                to_create.append(Attachment(service_ticket=service_ticket, **attachment_data))
+            elif id in existing:
+                attachment_instance = existing[id]
                 attachment_instance.description = attachment_data.get('description')
-                attachment_instance.save(update_fields=['description'])
+                to_update.append(attachment_instance)
+            else:
+                raise ValidationError({'attachments': _(
+                    f"attachment with id {id} doesn't exist in this ServiceTicket."
+                )})
+        if to_create:
+            Attachment.objects.bulk_create(to_create)
+        if to_update:
+            Attachment.objects.bulk_update(to_update, ['description'])
 
     def update(self, instance, validated_data):
         # Allow ST editing only in 'Open' and 'Rejected' statuses
@@ -554,7 +644,6 @@ class ServiceTicketWriteSerializer(serializers.ModelSerializer):
         status = validated_data.pop('status', instance.status)
         reject_description = validated_data.pop('reject_description', '')
         validated_data.update({'status': status, 'reject_description': reject_description})
-        print("update() with validated_data", instance.employee_works)
         """
             if len(validated_data) != 0:
                 raise ValidationError(
@@ -562,13 +651,14 @@ class ServiceTicketWriteSerializer(serializers.ModelSerializer):
                 )
         """
         try:
-            employee_works_data = validated_data.pop('employee_works', None)
-            self.update_employee_works(instance, employee_works_data)
-            attachments_data = validated_data.pop('attachments', None)
-            self.update_attachments(instance, attachments_data)
+            with transaction.atomic():
+                employee_works_data = validated_data.pop('employee_works', None)
+                self.update_employee_works(instance, employee_works_data)
+                attachments_data = validated_data.pop('attachments', None)
+                self.update_attachments(instance, attachments_data)
+                super().update(instance, validated_data)
         except DjangoValidationError as error:
             raise ValidationError(detail=serializers.as_serializer_error(error))
-        super().update(instance, validated_data)
         return instance
 
     def validate(self, data):
@@ -576,7 +666,8 @@ class ServiceTicketWriteSerializer(serializers.ModelSerializer):
         attachments = data.pop('attachments', None)
         date = data.get('date', None)
 
-        if date and DBLockDate.objects.get().lock_date and date < DBLockDate.objects.get().lock_date:
+        lock_date = DBLockDate.get_lock_date() if date else None
+        if lock_date and date < lock_date:
             raise DBLockedException()
 
         service_ticket = self.instance or ServiceTicket(**data)
@@ -594,3 +685,30 @@ class ServiceTicketWriteSerializer(serializers.ModelSerializer):
                 raise ValidationError({'attachments': serializer.errors})
             data.update({"attachments": attachments})
         return data
+
+
+class ServiceTicketExportSerializer(serializers.ModelSerializer):
+    status = IntegerChoiceField(choices=ServiceTicketExport.STATUSES, read_only=True)
+    status_url = serializers.SerializerMethodField()
+    download_url = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ServiceTicketExport
+        fields = (
+            'id', 'job', 'status', 'total', 'processed', 'error', 'created_at', 'finished_at',
+            'status_url', 'download_url',
+        )
+        read_only_fields = fields
+
+    def _build_url(self, name, obj):
+        url = reverse(name, args=[obj.id])
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request else url
+
+    def get_status_url(self, obj):
+        return self._build_url('api:service-ticket-export-status', obj)
+
+    def get_download_url(self, obj):
+        if obj.status != ServiceTicketExport.DONE:
+            return None
+        return self._build_url('api:service-ticket-export-download', obj)
@@ -32,7 +32,8 @@ class UserSerializer(serializers.ModelSerializer):
 
     def to_representation(self, instance):
         data = super().to_representation(instance)
-        role_value = instance.groups.get().id
+        # cached_groups reuses prefetched groups on list endpoints
+        role_value = instance.cached_groups[0].id
         data['role'] = self.fields.get('role').to_representation(role_value)
         return data
 
@@ -3,11 +3,14 @@ import functools
 from apps.accounts.decorators import mfa
 from django.contrib.auth import get_user
 from django.http import HttpResponse
-from django.test import RequestFactory, TestCase
+from django.test import RequestFactory, TestCase, override_settings
+from django.utils import translation
 from django.urls import reverse
 from django_otp.plugins.otp_totp.models import TOTPDevice
 
 from apps.accounts.models import User, UserToken
+from apps.healthcare.models import FhirReference, FhirResource
+from utils.helpers.fhir_render_cache import FhirRenderCache
 
 
 class TestBasic(TestCase):
@@ -99,3 +102,63 @@ class TestMFADecorator(TestCase):
         req.user = self._user
         resp = a_view(req)
         self.assertEqual(resp.status_code, 200)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TestFhirRenderCache(TestCase):
+
+    def setUp(self) -> None:
+        self._user: User = User.objects.create_user(username="test1", password="123456")
+        self._resource = FhirResource.objects.create(
+            resource_json={"resourceType": "Patient", "id": "p1"}, resource_id="p1", resource_type="Patient"
+        )
+        self.addCleanup(FhirRenderCache.invalidate, [self._resource.pk])
+
+    def test_render_is_keyed_by_language_and_timezone(self):
+        with translation.override("nl"):
+            FhirRenderCache.set(self._resource, self._user, "Europe/Amsterdam", "<table>nl</table>")
+            self.assertEqual(FhirRenderCache.get(self._resource, self._user, "Europe/Amsterdam"), "<table>nl</table>")
+            self.assertIsNone(FhirRenderCache.get(self._resource, self._user, "UTC"))
+        with translation.override("en"):
+            self.assertIsNone(FhirRenderCache.get(self._resource, self._user, "Europe/Amsterdam"))
+
+    def test_saving_the_resource_drops_the_render(self):
+        FhirRenderCache.set(self._resource, self._user, None, "<table></table>")
+        self.assertEqual(FhirRenderCache.get(self._resource, self._user, None), "<table></table>")
+        self._resource.resource_json = {"resourceType": "Patient", "id": "p1", "active": True}
+        self._resource.save()
+        self.assertIsNone(FhirRenderCache.get(self._resource, self._user, None))
+
+
+class TestFhirReference(TestCase):
+
+    def setUp(self) -> None:
+        self._observation = FhirResource.objects.create(
+            resource_json={
+                "resourceType": "Observation", "id": "obs-1",
+                "subject": {"reference": "Patient/p1"},
+                "performer": [
+                    {"reference": "https://fhir.example.org/r4/Practitioner/prac-1/_history/2"},
+                    {"reference": "#contained-1"},
+                ],
+            },
+            resource_id="obs-1", resource_type="Observation"
+        )
+
+    def test_references_are_indexed_on_save(self):
+        self.assertEqual(
+            set(self._observation.outgoing_references.values_list("target_type", "target_id")),
+            {("Patient", "p1"), ("Practitioner", "prac-1")}
+        )
+        self.assertEqual(list(FhirReference.referencing_resources("Patient", "p1")), [self._observation])
+        self.assertFalse(FhirReference.referencing_resources("Patient", "p12").exists())
+
+        self._observation.resource_json["subject"] = {"reference": "Patient/p2"}
+        self._observation.save()
+        self.assertFalse(FhirReference.referencing_resources("Patient", "p1").exists())
+        self.assertEqual(list(FhirReference.referencing_resources("Patient", "p2")), [self._observation])
+
+    def test_parse(self):
+        self.assertEqual(FhirReference.parse("Patient/p1"), ("Patient", "p1"))
+        self.assertIsNone(FhirReference.parse("#contained-1"))
+        self.assertIsNone(FhirReference.parse("urn:uuid:0d4d4b0e-2f3c-4c6c-9a61-2f0a4f9c8b11"))
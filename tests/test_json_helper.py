@@ -0,0 +1,267 @@
+import json
+import os
+import re
+import sys
+import time
+from pathlib import Path
+from unittest import skipUnless
+from unittest.mock import MagicMock, patch
+
+from dacite import from_dict
+from django.template.loader import render_to_string
+from django.test import SimpleTestCase, override_settings, tag
+from django.utils import translation
+from django.utils.safestring import mark_safe
+
+from fhir.foundation.domain_resource import DomainResource
+from utils.helpers.core_helpers import Render
+from utils.helpers.json_helper import (
+    JsonHelper, classify_path, clear_flattening_caches, flattening_cache_stats, get_label, get_profile_handler
+)
+from .json_helper_reference import JsonHelper as ReferenceJsonHelper
+
+FHIR_FIXTURES = Path(__file__).parent / 'fixtures' / 'fhir'
+# expected flattened rows of each fixture, FHIR_GOLDEN_UPDATE=1 records them from the reference helper
+FHIR_EXPECTED = FHIR_FIXTURES / 'expected'
+UPDATE_GOLDEN = os.environ.get('FHIR_GOLDEN_UPDATE') == '1'
+# benchmarks build megabytes of FHIR data, they are skipped unless asked for
+RUN_BENCHMARKS = os.environ.get('RUN_BENCHMARKS') == '1'
+MOCK_ID = re.compile(r" id=(?:'|&#x27;|&#39;)\d+(?:'|&#x27;|&#39;)")
+
+
+def sample_bundle(size_bytes):
+    """A Bundle of Observations of at least size_bytes once serialized."""
+    entries = []
+    bundle = {"resourceType": "Bundle", "type": "searchset", "entry": entries}
+    observation_size = 0
+    while observation_size * len(entries) < size_bytes:
+        index = len(entries)
+        entries.append({"resource": {
+            "resourceType": "Observation",
+            "id": f"obs-{index}",
+            "status": "final",
+            "code": {"coding": [{"system": "http://loinc.org", "code": "8867-4", "display": "Heart rate"}]},
+            "effectiveDateTime": f"2021-05-{index % 28 + 1:02d}T08:30:00+02:00",
+            "valueQuantity": {"value": 60 + index % 40, "unit": "beats/minute"},
+            "performer": [{"display": f"Practitioner {index % 50}"}],
+            "note": [{"text": "Measured at rest " * 4}],
+        }})
+        if index == 0:
+            observation_size = len(json.dumps(entries[0]))
+    return bundle
+
+
+def walk(json_obj, json_path):
+    """(kind, path, value) of the fragments a flattening run renders."""
+    if isinstance(json_obj, dict):
+        for key, value in json_obj.items():
+            yield from walk(value, f"{json_path}.{key}")
+    elif isinstance(json_obj, list):
+        yield 'sub_head', json_path, json_path.split('.')[-1]
+        for value in json_obj:
+            yield from walk(value, json_path)
+            yield 'divider', json_path, None
+        yield 'end_sub_head', json_path, None
+    else:
+        yield 'row', json_path, {'label': json_path.split('.')[-1], 'value': str(json_obj)}
+
+
+def render_with_lookup(kind, value):
+    """The fragments as rendered before they were precompiled."""
+    if kind == 'row':
+        return render_to_string('row.html', {'data': value})
+    if kind == 'sub_head':
+        return render_to_string('sub_head.html', {'data': value})
+    if kind == 'divider':
+        return render_to_string('divider.html')
+    return render_to_string('end_sub_head.html', {})
+
+
+def render_precompiled(kind, value):
+    if kind == 'row':
+        return Render.row(value)
+    if kind == 'sub_head':
+        return Render.sub_head(value)
+    if kind == 'divider':
+        return Render.divider()
+    return Render.end_sub_head()
+
+
+@override_settings(DEBUG=False)
+class TestRenderFragments(SimpleTestCase):
+
+    def test_fragments_are_identical_to_render_to_string(self):
+        for kind, _path, value in walk(sample_bundle(20000), 'Bundle'):
+            self.assertEqual(render_precompiled(kind, value), render_with_lookup(kind, value))
+
+    def test_safe_and_plain_titles_are_cached_apart(self):
+        title = '<b>Vital signs</b>'
+        self.assertEqual(Render.sub_head(title), render_to_string('sub_head.html', {'data': title}))
+        self.assertEqual(
+            Render.sub_head(mark_safe(title)), render_to_string('sub_head.html', {'data': mark_safe(title)})
+        )
+        self.assertEqual(Render.sub_head(title), render_to_string('sub_head.html', {'data': title}))
+
+
+@tag('benchmark')
+@skipUnless(RUN_BENCHMARKS, 'benchmark, run with RUN_BENCHMARKS=1')
+@override_settings(DEBUG=False)
+class TestRenderFragmentsBenchmark(SimpleTestCase):
+    """Run with: RUN_BENCHMARKS=1 manage.py test --tag benchmark"""
+
+    def test_benchmark_5mb_bundle(self):
+        fragments = list(walk(sample_bundle(5 * 1024 * 1024), 'Bundle'))
+
+        start = time.perf_counter()
+        expected = [render_with_lookup(kind, value) for kind, _path, value in fragments]
+        lookup_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        rendered = [render_precompiled(kind, value) for kind, _path, value in fragments]
+        precompiled_time = time.perf_counter() - start
+
+        self.assertEqual(rendered, expected)
+        sys.stderr.write(
+            f'\n{len(fragments)} fragments of a 5 MB bundle: '
+            f'render_to_string {lookup_time * 1000:.1f} ms, precompiled {precompiled_time * 1000:.1f} ms\n'
+        )
+
+
+def load_fixtures():
+    return {path.stem: json.loads(path.read_text()) for path in sorted(FHIR_FIXTURES.glob('*.json'))}
+
+
+def load_resources():
+    resources = load_fixtures()
+    resources['observations_50kb'] = sample_bundle(50 * 1024)
+    return resources
+
+
+def normalize(rows):
+    """The rendered rows as text, without the ids the terminology mock puts in its answers."""
+    return [MOCK_ID.sub('', str(row)) for row in rows]
+
+
+def flatten(helper_class, resource_json, terminology):
+    helper = helper_class(terminology=terminology, resource=from_dict(DomainResource, resource_json))
+    helper.start_flattening()
+    return helper.flattened_values
+
+
+@override_settings(DEBUG=False)
+class TestJsonHelperDispatch(SimpleTestCase):
+
+    def setUp(self):
+        self.terminology = MagicMock(name='terminology')
+        clear_flattening_caches()
+        self.addCleanup(clear_flattening_caches)
+        translation.activate('en')
+        self.addCleanup(translation.deactivate)
+
+    def test_output_matches_reference_helper(self):
+        for name, resource_json in load_resources().items():
+            with self.subTest(resource=name):
+                self.assertEqual(
+                    normalize(flatten(JsonHelper, resource_json, self.terminology)),
+                    normalize(flatten(ReferenceJsonHelper, resource_json, self.terminology))
+                )
+
+    def test_output_matches_expected_files(self):
+        for name, resource_json in load_fixtures().items():
+            with self.subTest(resource=name):
+                expected_path = FHIR_EXPECTED / f'{name}.json'
+                if UPDATE_GOLDEN:
+                    expected_path.parent.mkdir(exist_ok=True)
+                    rows = normalize(flatten(ReferenceJsonHelper, resource_json, self.terminology))
+                    expected_path.write_text(json.dumps(rows, indent=2, ensure_ascii=False) + '\n')
+                if not expected_path.exists():
+                    self.skipTest(f'{expected_path} is not recorded, record it with FHIR_GOLDEN_UPDATE=1')
+                self.assertEqual(
+                    normalize(flatten(JsonHelper, resource_json, self.terminology)),
+                    json.loads(expected_path.read_text())
+                )
+
+    def test_iter_flatten_streams_the_same_rows(self):
+        resource_json = load_fixtures()['observation_bundle']
+        helper = JsonHelper(terminology=self.terminology, resource=from_dict(DomainResource, resource_json))
+        rows = helper.iter_flatten()
+        first_row = next(rows)
+        self.assertTrue(helper._stack)  # the rest of the bundle is not processed yet
+        self.assertEqual(
+            normalize([first_row, *rows]),
+            normalize(flatten(ReferenceJsonHelper, resource_json, self.terminology))
+        )
+
+    def test_deep_nesting_does_not_recurse(self):
+        resource_json = {"resourceType": "Basic", "id": "deep"}
+        node = resource_json
+        for _ in range(3000):
+            node["item"] = {}
+            node = node["item"]
+        node["text"] = "leaf"
+        rows = flatten(JsonHelper, resource_json, self.terminology)
+        self.assertTrue(any('leaf' in str(row) for row in rows))
+
+    def test_stream_table_renders_like_table(self):
+        rows = flatten(JsonHelper, load_resources()['patient'], self.terminology)
+        self.assertEqual(''.join(Render.stream_table(iter(rows))).encode('utf-8'), Render.table(rows))
+
+    def test_path_is_classified_once(self):
+        classify_path.cache_clear()
+        flatten(JsonHelper, load_resources()['observations_50kb'], self.terminology)
+        info = classify_path.cache_info()
+        self.assertLess(info.misses, 50)
+        self.assertGreater(info.hits, info.misses * 10)
+
+
+@tag('benchmark')
+@skipUnless(RUN_BENCHMARKS, 'benchmark, run with RUN_BENCHMARKS=1')
+@override_settings(DEBUG=False)
+class TestJsonHelperDispatchBenchmark(SimpleTestCase):
+    """Run with: RUN_BENCHMARKS=1 manage.py test --tag benchmark"""
+
+    def setUp(self):
+        self.terminology = MagicMock(name='terminology')
+        clear_flattening_caches()
+        self.addCleanup(clear_flattening_caches)
+        translation.activate('en')
+        self.addCleanup(translation.deactivate)
+
+    def flattening_time(self, helper_class, resource_json):
+        start = time.perf_counter()
+        flatten(helper_class, resource_json, self.terminology)
+        return time.perf_counter() - start
+
+    def test_benchmark_dispatch(self):
+        self.flattening_time(JsonHelper, sample_bundle(50 * 1024))  # warm up the classification and label caches
+        for size in (50 * 1024, 1024 * 1024):
+            resource_json = sample_bundle(size)
+            reference_time = self.flattening_time(ReferenceJsonHelper, resource_json)
+            dispatch_time = self.flattening_time(JsonHelper, resource_json)
+            sys.stderr.write(
+                f'\n{size // 1024} kB bundle: if/elif {reference_time * 1000:.1f} ms, '
+                f'dispatch {dispatch_time * 1000:.1f} ms\n'
+            )
+
+
+class TestFlatteningCaches(SimpleTestCase):
+
+    def setUp(self):
+        clear_flattening_caches()
+        self.addCleanup(clear_flattening_caches)
+
+    @patch('utils.helpers.json_helper.LabelUtil.get_label', side_effect=lambda profile, path: path.upper())
+    def test_labels_are_resolved_once_per_language(self, get_label_mock):
+        with translation.override('nl'):
+            for _ in range(3):
+                self.assertEqual(get_label('nl-core-Patient', 'Patient.name'), 'PATIENT.NAME')
+        with translation.override('en'):
+            get_label('nl-core-Patient', 'Patient.name')
+        self.assertEqual(get_label_mock.call_count, 2)
+        self.assertEqual(flattening_cache_stats()['labels']['hits'], 2)
+
+    @patch('utils.helpers.json_helper.ProfileHandler')
+    def test_profile_is_parsed_once(self, profile_handler_mock):
+        self.assertIs(get_profile_handler('nl-core-Patient'), get_profile_handler('nl-core-Patient'))
+        profile_handler_mock.assert_called_once_with('nl-core-Patient')
+        self.assertEqual(flattening_cache_stats()['profiles']['misses'], 1)
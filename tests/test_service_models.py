@@ -1,8 +1,10 @@
 import os
-from datetime import datetime, timedelta
-from unittest.mock import patch
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from unittest.mock import PropertyMock, patch
 
-from django.test import TestCase
+from django.db import IntegrityError, connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
 from django.core.exceptions import ValidationError
 
 from apps.authentication.tests.factories import (
@@ -10,9 +12,14 @@ from apps.authentication.tests.factories import (
 )
 
 from apps.notifications.models import Action
+from apps.authentication.models import Mechanic
 from apps.authentication.tests.factories import UserFactory
+from apps.utils import notification_dispatch
+from apps.utils.beams import BeamsPublisher, beams_publisher
 from .factories import JobFactory, ServiceTicketFactory, EmployeeWorkBlockFactory
-from ..models import CommonInfo, Settings, ServiceTicket
+from ..models import (
+    CommonInfo, DailyWorkRollup, Job, JobNumberCounter, PendingStatusChange, Settings, ServiceTicket
+)
 from ..utils import delete_file
 
 
@@ -22,6 +29,7 @@ class MockedRequest:
         return super().__init__(*args, **kwargs)
 
 
+@override_settings(NOTIFICATION_DISPATCH_BACKEND='sync')
 class TestJob(TestCase):
 
     def setUp(self):
@@ -171,6 +179,7 @@ class TestJob(TestCase):
         self.assertEqual(actions_after, actions_before + 1)
 
 
+@override_settings(NOTIFICATION_DISPATCH_BACKEND='sync')
 class TestServiceTicket(TestCase):
 
     def setUp(self):
@@ -397,6 +406,7 @@ class TestServiceTicket(TestCase):
         employee_work.start_time = None
         employee_work.end_time = None
         employee_work.save()
+        st.refresh_from_db()
         self.assertEqual(st.total_worked_hours, '')
 
     def test_total_worked_hours_with_filled_worked_hours(self):
@@ -428,6 +438,7 @@ class TestServiceTicket(TestCase):
             end_time=datetime.now() + timedelta(minutes=30)
         )
         st.employee_works.set([wb1, wb2, wb3, wb4, wb5])
+        st.refresh_from_db()
         self.assertEqual(st.total_worked_hours, '1h 30m')
 
     def test_total_mileage(self):
@@ -442,4 +453,298 @@ class TestServiceTicket(TestCase):
         wb3 = EmployeeWorkBlockFactory(service_ticket_id=new_st.id)
         wb3.mileage = 2.2
         wb3.save()
+        new_st.refresh_from_db()
         self.assertEqual(new_st.total_mileage, '3.3')
+
+    def test_totals_follow_work_block_changes(self):
+        st = ServiceTicketFactory()
+        self.addCleanup(delete_file, st.customer_signature.path)
+        st.employee_works.all().delete()
+        start = datetime.now()
+        wb1 = EmployeeWorkBlockFactory(
+            service_ticket_id=st.id, start_time=start, end_time=start + timedelta(hours=2), hotel=True,
+            per_diem=False,
+        )
+        wb2 = EmployeeWorkBlockFactory(
+            service_ticket_id=st.id, start_time=start, end_time=start + timedelta(minutes=15), hotel=False,
+            per_diem=True,
+        )
+        st.refresh_from_db()
+        self.assertEqual(st.total_worked_hours, '2h 15m')
+        self.assertEqual(st.sum_hotel_checkboxes, 1)
+        self.assertEqual(st.sum_per_diem_checkboxes, 1)
+        self.assertEqual(
+            st.list_all_employees,
+            f"{wb1.employee.first_name} {wb1.employee.last_name},{wb2.employee.first_name} {wb2.employee.last_name}"
+        )
+
+        wb1.delete()
+        st.refresh_from_db()
+        self.assertEqual(st.total_worked_hours, '0h 15m')
+        self.assertEqual(st.sum_hotel_checkboxes, 0)
+
+    def test_employee_names_follow_user_rename(self):
+        st = ServiceTicketFactory()
+        self.addCleanup(delete_file, st.customer_signature.path)
+        st.employee_works.all().delete()
+        mechanic = MechanicFactory()
+        EmployeeWorkBlockFactory(
+            service_ticket_id=st.id, employee=mechanic,
+            start_time=datetime.now(), end_time=datetime.now() + timedelta(hours=1)
+        )
+        mechanic = Mechanic.objects.get(pk=mechanic.pk)  # saved through the proxy, like the admin does
+        mechanic.first_name = 'Renamed'
+        mechanic.save()
+        st.refresh_from_db()
+        self.assertEqual(st.list_all_employees, f'Renamed {mechanic.last_name}')
+
+    def test_save_does_not_overwrite_totals(self):
+        st = ServiceTicketFactory()
+        self.addCleanup(delete_file, st.customer_signature.path)
+        stale = ServiceTicket.objects.get(pk=st.pk)
+        EmployeeWorkBlockFactory(
+            service_ticket_id=st.id, start_time=datetime.now(), end_time=datetime.now() + timedelta(hours=1)
+        )
+        stale.save()
+        st.refresh_from_db()
+        self.assertEqual(st.compute_totals([st.id])[st.id]['worked_duration'], st.worked_duration)
+
+
+@override_settings(NOTIFICATION_DISPATCH_BACKEND='local')
+class TestNotificationDispatch(TestCase):
+
+    @patch('apps.api.models.RequestMiddleware')
+    def test_saves_are_coalesced_until_commit(self, mocked_req):
+        mocked_req.get_request.return_value = MockedRequest(user=UserFactory())
+        with self.captureOnCommitCallbacks(execute=True):
+            job = JobFactory()
+
+        coalesced = notification_dispatch.stats()['coalesced']
+        with patch.object(Job, 'run_notifications', new_callable=PropertyMock) as run_notifications:
+            with self.captureOnCommitCallbacks(execute=True):
+                job.status = CommonInfo.PENDING_FOR_APPROVAL
+                job.save()
+                job.save()
+                run_notifications.assert_not_called()
+            run_notifications.assert_called_once()
+        self.assertFalse(PendingStatusChange.objects.exists())
+        self.assertEqual(notification_dispatch.stats()['coalesced'], coalesced + 1)
+
+    @patch('apps.api.models.RequestMiddleware')
+    def test_rolled_back_change_is_not_sent(self, mocked_req):
+        mocked_req.get_request.return_value = MockedRequest(user=UserFactory())
+        with self.captureOnCommitCallbacks(execute=True):
+            job = JobFactory()
+
+        with patch.object(Job, 'run_notifications', new_callable=PropertyMock) as run_notifications:
+            with self.captureOnCommitCallbacks(execute=True):
+                with self.assertRaises(IntegrityError):
+                    with transaction.atomic():
+                        job.status = CommonInfo.PENDING_FOR_APPROVAL
+                        job.save()
+                        raise IntegrityError
+            run_notifications.assert_not_called()
+            self.assertFalse(PendingStatusChange.objects.exists())
+
+            with self.captureOnCommitCallbacks(execute=True):
+                job.save()
+            run_notifications.assert_called_once()
+
+    @patch('apps.api.models.RequestMiddleware')
+    def test_rolled_back_drain_publishes_nothing(self, mocked_req):
+        mocked_req.get_request.return_value = MockedRequest(user=UserFactory())
+        with self.captureOnCommitCallbacks(execute=True):
+            job = JobFactory()
+
+        def publish():
+            beams_publisher.publish_to_users(['1'], {'web': {'notification': {'title': 'Job approved'}}})
+
+        def count(key, delta):
+            if key == notification_dispatch.SENT_KEY:
+                raise IntegrityError
+
+        with patch.object(Job, 'run_notifications', new_callable=PropertyMock, side_effect=publish), \
+                patch.object(BeamsPublisher, '_send') as send, \
+                patch.object(notification_dispatch, '_count', side_effect=count):
+            with self.assertRaises(IntegrityError):
+                with self.captureOnCommitCallbacks(execute=True):
+                    job.status = CommonInfo.PENDING_FOR_APPROVAL
+                    job.save()
+            send.assert_not_called()
+        self.assertTrue(PendingStatusChange.objects.exists())
+
+    def test_changes_of_one_object_are_coalesced_across_transactions(self):
+        changes = [
+            PendingStatusChange(id=1, object_label='api.Job', object_id=7, original_status=1, status=2),
+            PendingStatusChange(id=2, object_label='api.ServiceTicket', object_id=7, original_status=1, status=2),
+            PendingStatusChange(id=3, object_label='api.Job', object_id=7, original_status=2, status=4),
+        ]
+        self.assertEqual(
+            notification_dispatch.coalesce(changes),
+            [['api.Job', 7, 1, 4], ['api.ServiceTicket', 7, 1, 2]]
+        )
+
+
+
+@override_settings(NOTIFICATION_DISPATCH_BACKEND='local')
+class TestNotificationDispatchAutocommit(TransactionTestCase):
+
+    @patch('apps.api.models.RequestMiddleware')
+    def test_save_outside_transaction_is_sent(self, mocked_req):
+        mocked_req.get_request.return_value = MockedRequest(user=UserFactory())
+        job = JobFactory()
+        with patch.object(Job, 'run_notifications', new_callable=PropertyMock) as run_notifications:
+            job.status = CommonInfo.PENDING_FOR_APPROVAL
+            job.save()
+            run_notifications.assert_called_once()
+        self.assertFalse(PendingStatusChange.objects.exists())
+
+
+class TestJobNumberCounter(TestCase):
+
+    def test_counter_is_seeded_from_settings_and_existing_jobs(self):
+        Settings.objects.create(job_number_starting_point=100)
+        self.assertEqual(JobNumberCounter.allocate()[0], 100)
+        self.assertEqual(JobNumberCounter.allocate()[0], 101)
+
+    def test_counter_continues_after_existing_jobs(self):
+        JobFactory(number_id=500)
+        self.assertEqual(JobNumberCounter.allocate()[0], 501)
+
+    def test_raising_starting_point_moves_counter(self):
+        settings = Settings.objects.create(job_number_starting_point=1)
+        JobNumberCounter.allocate()
+        settings.job_number_starting_point = 300
+        settings.save()
+        self.assertEqual(JobNumberCounter.allocate()[0], 300)
+
+    def test_allocate_block(self):
+        first = JobNumberCounter.allocate()
+        block = JobNumberCounter.allocate(10)
+        self.assertEqual(list(block), list(range(first[0] + 1, first[0] + 11)))
+
+    def test_generate_number_uses_counter(self):
+        job = JobFactory.build(number_id=None)
+        number = job.generate_number()
+        self.assertEqual(job.number_id, JobNumberCounter.objects.get().last_number_id)
+        self.assertTrue(number.endswith('{:04d}'.format(job.number_id)))
+
+
+@skipUnlessDBFeature('has_select_for_update')
+class TestJobNumberCounterConcurrency(TransactionTestCase):
+
+    def allocate(self, count):
+        try:
+            return [number for _ in range(20) for number in JobNumberCounter.allocate(count)]
+        finally:
+            connection.close()
+
+    def test_concurrent_allocations_are_unique(self):
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(self.allocate, [1, 3] * 8))
+        numbers = [number for result in results for number in result]
+        self.assertEqual(len(numbers), len(set(numbers)))
+        self.assertEqual(sorted(numbers), list(range(1, len(numbers) + 1)))
+
+
+class TestDailyWorkRollup(TestCase):
+
+    @patch('apps.api.models.RequestMiddleware')
+    def test_work_of_approved_tickets_is_rolled_up(self, mocked_req):
+        mocked_req.get_request.return_value = MockedRequest(user=AdminFactory())
+        st = ServiceTicketFactory(date=date(2021, 5, 3))
+        self.addCleanup(delete_file, st.customer_signature.path)
+        st.employee_works.all().delete()
+        mechanic = MechanicFactory()
+        start = datetime(2021, 5, 3, 8)
+        EmployeeWorkBlockFactory(
+            service_ticket_id=st.id, employee=mechanic, start_time=start,
+            end_time=start + timedelta(hours=2, minutes=30)
+        )
+        may = (date(2021, 5, 1), date(2021, 5, 31))
+        self.assertEqual(DailyWorkRollup.worked_hours_by_mechanic(*may), {})
+
+        st.status = ServiceTicket.APPROVED
+        st.save()
+        self.assertEqual(DailyWorkRollup.worked_hours_by_mechanic(*may), {mechanic.id: 2.5})
+        self.assertEqual(DailyWorkRollup.worked_hours_by_mechanic(date(2021, 6, 1), date(2021, 6, 30)), {})
+
+        st.is_archive = True
+        st.save()
+        self.assertEqual(DailyWorkRollup.worked_hours_by_mechanic(*may), {})
+
+    @patch('apps.api.models.RequestMiddleware')
+    def test_work_block_changes_of_approved_ticket_are_rolled_up(self, mocked_req):
+        mocked_req.get_request.return_value = MockedRequest(user=AdminFactory())
+        st = ServiceTicketFactory(date=date(2021, 5, 3))
+        self.addCleanup(delete_file, st.customer_signature.path)
+        st.employee_works.all().delete()
+        mechanics = [MechanicFactory(), MechanicFactory()]
+        start = datetime(2021, 5, 3, 8)
+        block = EmployeeWorkBlockFactory(
+            service_ticket_id=st.id, employee=mechanics[0], start_time=start, end_time=start + timedelta(hours=2)
+        )
+        st.status = ServiceTicket.APPROVED
+        st.save()
+        may = (date(2021, 5, 1), date(2021, 5, 31))
+
+        # like the admin inline, saved after the ticket
+        block.end_time = start + timedelta(hours=3)
+        block.save()
+        self.assertEqual(DailyWorkRollup.worked_hours_by_mechanic(*may), {mechanics[0].id: 3})
+
+        block.employee = mechanics[1]
+        block.save()
+        self.assertEqual(DailyWorkRollup.worked_hours_by_mechanic(*may), {mechanics[1].id: 3})
+
+        block.delete()
+        self.assertEqual(DailyWorkRollup.worked_hours_by_mechanic(*may), {})
+
+    @patch('apps.api.models.RequestMiddleware')
+    def test_refreshed_slice_keeps_one_row_per_day_mechanic_and_job(self, mocked_req):
+        mocked_req.get_request.return_value = MockedRequest(user=AdminFactory())
+        st = ServiceTicketFactory(date=date(2021, 5, 3))
+        self.addCleanup(delete_file, st.customer_signature.path)
+        st.employee_works.all().delete()
+        mechanic = MechanicFactory()
+        start = datetime(2021, 5, 3, 8)
+        EmployeeWorkBlockFactory(
+            service_ticket_id=st.id, employee=mechanic, start_time=start, end_time=start + timedelta(hours=2)
+        )
+        st.status = ServiceTicket.APPROVED
+        st.save()
+
+        DailyWorkRollup.refresh_jobs([st.connected_job_id])
+        DailyWorkRollup.refresh_jobs([st.connected_job_id])
+        self.assertEqual(DailyWorkRollup.objects.filter(mechanic=mechanic).count(), 1)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            DailyWorkRollup.objects.create(
+                day=st.date, mechanic=mechanic, job_id=st.connected_job_id, worked=timedelta(hours=1)
+            )
+
+
+class TestMechanicWorkingTime(TestCase):
+
+    @patch('apps.api.models.RequestMiddleware')
+    def test_total_working_time_is_read_from_rollup(self, mocked_req):
+        mocked_req.get_request.return_value = MockedRequest(user=AdminFactory())
+        mechanics = [MechanicFactory(), MechanicFactory()]
+        start = datetime(2021, 5, 3, 8)
+        for minutes, status in ((90, ServiceTicket.APPROVED), (45, ServiceTicket.APPROVED), (600, ServiceTicket.OPEN)):
+            st = ServiceTicketFactory(date=date(2021, 5, 3))
+            self.addCleanup(delete_file, st.customer_signature.path)
+            st.employee_works.all().delete()
+            for mechanic in mechanics:
+                EmployeeWorkBlockFactory(
+                    service_ticket_id=st.id, employee=mechanic,
+                    start_time=start, end_time=start + timedelta(minutes=minutes)
+                )
+            st.status = status
+            st.save()
+
+        may = (date(2021, 5, 1), date(2021, 5, 31))
+        self.assertEqual(mechanics[0].get_total_working_time(*may), 2.25)
+        self.assertEqual(mechanics[0].get_total_working_time(date(2021, 6, 1), date(2021, 6, 30)), 0)
+        with self.assertNumQueries(1):
+            totals = Mechanic.get_total_working_time_by_mechanic(*may)
+        self.assertEqual(totals, {mechanic.id: 2.25 for mechanic in mechanics})
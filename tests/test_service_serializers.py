@@ -1,11 +1,16 @@
-from django.test import TestCase
+from datetime import date, timedelta
+
+from django.test import TestCase, override_settings
 from django.conf import settings
+from django.utils import timezone
 
 from apps.authentication.tests.factories import ManagerFactory, MechanicFactory
-from .factories import JobFactory, ServiceTicketFactory
-from ..models import ServiceTicket
+from .factories import EmployeeWorkBlockFactory, JobFactory, ServiceTicketFactory
+from ..exceptions import DBLockedException
+from ..models import CachedSingletonMixin, DBLockDate, ServiceTicket
 from ..serializers import (
-    JobReadSerializer, JobWriteSerializer, ServiceTicketReadSerializer
+    EmployeeWorkBlockSerializer, JobReadSerializer, JobWriteSerializer, ServiceTicketReadSerializer,
+    ServiceTicketWriteSerializer
 )
 from ..utils import delete_file
 
@@ -285,3 +290,86 @@ class TestServiceTicketReadSerializer(TestCase):
             serializer.data.get('attachments')[0].get('id'),
             attachment.id
         )
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TestServiceTicketWriteSerializerLockDate(TestCase):
+
+    def setUp(self):
+        self.addCleanup(DBLockDate.invalidate_cache)
+        DBLockDate(lock_date=date(2021, 6, 1)).save()
+
+    def test_lock_date_is_read_from_memory(self):
+        serializer = ServiceTicketWriteSerializer()
+        DBLockDate.get_lock_date()
+        with self.assertNumQueries(0):
+            with self.assertRaises(DBLockedException):
+                serializer.validate({'date': date(2021, 5, 31)})
+            with self.assertRaises(DBLockedException):
+                serializer.validate({'date': date(2021, 1, 1)})
+
+    def test_new_lock_date_is_seen_after_save(self):
+        self.assertEqual(DBLockDate.get_lock_date(), date(2021, 6, 1))
+        DBLockDate(lock_date=date(2021, 7, 1)).save()
+        self.assertEqual(DBLockDate.get_lock_date(), date(2021, 7, 1))
+
+    def test_singleton_without_loader_is_rejected(self):
+        with self.assertRaises(TypeError):
+            type('Unloadable', (CachedSingletonMixin,), {})
+
+
+class TestEmployeeWorkBlockListSerializer(TestCase):
+
+    def setUp(self):
+        self.mechanics = [MechanicFactory() for _ in range(2)]
+        self.start = timezone.now().replace(microsecond=0) + timedelta(days=30)
+
+    def block(self, mechanic, start_hour, end_hour):
+        return {
+            'employee': mechanic.id,
+            'start_time': (self.start + timedelta(hours=start_hour)).isoformat(),
+            'end_time': (self.start + timedelta(hours=end_hour)).isoformat(),
+            'mileage': 0,
+        }
+
+    def test_overlaps_are_checked_with_one_query(self):
+        data = [self.block(mechanic, hour, hour + 1) for hour in range(10) for mechanic in self.mechanics]
+        serializer = EmployeeWorkBlockSerializer(data=data, many=True)
+        # one query per employee lookup and one for the overlaps
+        with self.assertNumQueries(len(data) + 1):
+            self.assertTrue(serializer.is_valid(), serializer.errors)
+
+    def test_overlap_inside_request(self):
+        data = [
+            self.block(self.mechanics[0], 0, 2),
+            self.block(self.mechanics[1], 1, 3),
+            self.block(self.mechanics[0], 1, 3),
+        ]
+        serializer = EmployeeWorkBlockSerializer(data=data, many=True)
+        self.assertFalse(serializer.is_valid())
+        self.assertEqual([bool(error) for error in serializer.errors], [True, False, True])
+
+    def test_overlap_with_long_block_across_shorter_ones(self):
+        data = [
+            self.block(self.mechanics[0], 8, 17),
+            self.block(self.mechanics[0], 9, 10),
+            self.block(self.mechanics[0], 11, 12),
+        ]
+        serializer = EmployeeWorkBlockSerializer(data=data, many=True)
+        self.assertFalse(serializer.is_valid())
+        self.assertEqual([bool(error) for error in serializer.errors], [True, True, True])
+
+    def test_overlap_with_stored_block(self):
+        st = ServiceTicketFactory()
+        EmployeeWorkBlockFactory(
+            service_ticket_id=st.id, employee=self.mechanics[0],
+            start_time=self.start, end_time=self.start + timedelta(hours=2)
+        )
+        self.addCleanup(delete_file, st.customer_signature.path)
+        for attachment in st.attachments.all():
+            self.addCleanup(delete_file, attachment.file.path)
+        data = [self.block(self.mechanics[0], 1, 3), self.block(self.mechanics[1], 1, 3)]
+        serializer = EmployeeWorkBlockSerializer(data=data, many=True)
+        self.assertFalse(serializer.is_valid())
+        self.assertIn('time', serializer.errors[0])
+        self.assertEqual(serializer.errors[1], {})
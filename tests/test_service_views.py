@@ -0,0 +1,434 @@
+import json
+import os
+import re
+import sys
+import time
+import zipfile
+from datetime import timedelta
+from io import BytesIO
+from unittest import skipUnless
+from unittest.mock import patch
+
+from django.db import connection
+from django.test import TestCase, override_settings, tag
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from rest_framework import status
+
+from apps.authentication.models import Mechanic
+from apps.authentication.tests.factories import AdminFactory, ManagerFactory, MechanicFactory
+from apps.utils.pdf_cache import ServiceTicketPDFCache
+from .factories import JobFactory, ServiceTicketFactory
+from ..models import EmployeeWorkBlock, ServiceTicket, ServiceTicketExport
+from ..views import ServiceTicketViewSet, STExportView
+from ..utils import delete_file
+
+# benchmarks create thousands of rows, they are skipped unless asked for
+RUN_BENCHMARKS = os.environ.get('RUN_BENCHMARKS') == '1'
+
+
+class TestJobViewSet(TestCase):
+
+    def setUp(self):
+        self.user = AdminFactory()
+        self.client.force_login(self.user)
+        self.service_tickets = []
+
+    def tearDown(self):
+        for st in self.service_tickets:
+            delete_file(st.customer_signature.path)
+            for attachment in st.attachments.all():
+                delete_file(attachment.file.path)
+
+    def _create_job_with_tickets(self):
+        job = JobFactory(managers=(ManagerFactory(),), mechanics=(MechanicFactory(),))
+        self.service_tickets.append(ServiceTicketFactory(connected_job=job))
+        self.service_tickets.append(
+            ServiceTicketFactory(connected_job=job, status=ServiceTicket.APPROVED)
+        )
+        return job
+
+    def _count_list_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('api:job-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(context.captured_queries)
+
+    def test_list_queries_do_not_depend_on_page_size(self):
+        self._create_job_with_tickets()
+        queries_for_one_job = self._count_list_queries()
+        for _ in range(5):
+            self._create_job_with_tickets()
+        self.assertEqual(self._count_list_queries(), queries_for_one_job)
+
+    def test_list_counters_and_time_worked(self):
+        job = self._create_job_with_tickets()
+        response = self.client.get(reverse('api:job-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        job_data = next(item for item in response.data['results'] if item['id'] == job.id)
+        self.assertEqual(
+            job_data['approved_tickets'],
+            job.serviceticket_set.filter(status=ServiceTicket.APPROVED).count()
+        )
+        self.assertEqual(job_data['total_tickets'], job.serviceticket_set.count())
+        self.assertAlmostEqual(job_data['time_worked'], job.time_worked)
+
+    def _count_archive_queries(self, ids):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post(
+                reverse('api:job-archive-job'),
+                data=json.dumps({'ids': ids}),
+                content_type='application/json'
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(context.captured_queries)
+
+    def test_archive_jobs_with_fixed_number_of_queries(self):
+        one_job_queries = self._count_archive_queries([JobFactory().id])
+        job_ids = [self._create_job_with_tickets().id for _ in range(5)]
+        self.assertEqual(self._count_archive_queries(job_ids), one_job_queries)
+        self.assertFalse(ServiceTicket.objects.filter(
+            connected_job__in=job_ids, is_archive=False
+        ).exists())
+
+    def test_archive_and_unarchive_report(self):
+        job = JobFactory()
+        error_ids = [10000000, 'wrong']
+        response = self.client.post(
+            reverse('api:job-archive-job'),
+            data=json.dumps({'ids': [job.id] + error_ids}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.data.get('Successfully archived Job (IDs)'), [job.id])
+        self.assertEqual(response.data.get('Failed to archive Job (IDs)'), error_ids)
+        job.refresh_from_db()
+        self.assertTrue(job.is_archive)
+
+        response = self.client.post(
+            reverse('api:job-unarchive-job'),
+            data=json.dumps({'ids': [job.id]}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.data.get('Successfully unarchived Job (IDs)'), [job.id])
+        job.refresh_from_db()
+        self.assertFalse(job.is_archive)
+
+
+class TestServiceTicketViewSet(TestCase):
+
+    def setUp(self):
+        self.user = AdminFactory()
+        self.client.force_login(self.user)
+        self.st = ServiceTicketFactory()
+
+    def tearDown(self):
+        delete_file(self.st.customer_signature.path)
+        for attachment in self.st.attachments.all():
+            delete_file(attachment.file.path)
+
+    def test_partial_update_resolves_roles_once(self):
+        url = reverse('api:service_ticket-detail', args=[self.st.id])
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.patch(
+                url, data=json.dumps({'lease_name': 'New lease_name'}),
+                content_type='application/json'
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        user_filter = re.compile(rf'"user_id" = {self.user.id}\b')
+        role_queries = [
+            query['sql'] for query in context.captured_queries
+            if '"auth_group"' in query['sql'] and user_filter.search(query['sql'])
+        ]
+        self.assertEqual(len(role_queries), 1)
+
+    def test_list_queries_do_not_depend_on_page_size(self):
+        def count_list_queries():
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(reverse('api:service_ticket-list'))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return len(context.captured_queries)
+
+        queries_for_one_ticket = count_list_queries()
+        for _ in range(5):
+            st = ServiceTicketFactory(
+                connected_job=JobFactory(managers=(ManagerFactory(),), mechanics=(MechanicFactory(),))
+            )
+            self.addCleanup(delete_file, st.customer_signature.path)
+            for attachment in st.attachments.all():
+                self.addCleanup(delete_file, attachment.file.path)
+        self.assertEqual(count_list_queries(), queries_for_one_ticket)
+
+    def search_ids(self, term):
+        response = self.client.get(reverse('api:service_ticket-list'), {'search': term})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [item['id'] for item in response.data['results']]
+
+    def test_search_document_follows_related_changes(self):
+        self.st.additional_notes = 'Replaced the VALVE cover'
+        self.st.save()
+        self.assertEqual(self.search_ids('valve Cover'), [self.st.id])
+        self.assertEqual(self.search_ids('valve gasket'), [])
+
+        customer = self.st.connected_job.customer
+        customer.name = 'Zephyr Gas Co'
+        customer.save()
+        self.assertEqual(self.search_ids('zephyr'), [self.st.id])
+
+    def test_search_document_follows_employee_rename(self):
+        mechanic = MechanicFactory()
+        EmployeeWorkBlock.objects.create(
+            service_ticket=self.st, employee=mechanic, mileage=0,
+            start_time=timezone.now(), end_time=timezone.now() + timedelta(hours=1)
+        )
+        mechanic = Mechanic.objects.get(pk=mechanic.pk)  # the admin saves users through the proxies
+        mechanic.first_name = 'Quillon'
+        mechanic.save()
+        self.assertEqual(self.search_ids('quillon'), [self.st.id])
+
+    def test_job_save_refreshes_tickets_only_for_copied_fields(self):
+        job = self.st.connected_job
+        with patch.object(ServiceTicket, 'refresh_search_documents') as refresh_search_documents:
+            job.description = 'Compressor overhaul'
+            job.save()
+            refresh_search_documents.assert_not_called()
+            job.number = 'X-0001'
+            job.save()
+            refresh_search_documents.assert_called_once()
+
+    def test_csv_export(self):
+        response = self.client.get(reverse('api:service_ticket-export'), {'file_format': 'csv'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        header = lines[0].split(',')
+        self.assertEqual(header[:3], ['id', 'status', 'job_number'])
+        self.assertEqual(len(lines), 1 + ServiceTicket.objects.count())
+        row = next(line.split(',') for line in lines[1:] if line.startswith(f'{self.st.id},'))
+        self.assertEqual(row[2], str(self.st.connected_job.number))
+
+    def test_export_unknown_format(self):
+        response = self.client.get(reverse('api:service_ticket-export'), {'file_format': 'pdf'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def patch_employee_works(self, blocks_count):
+        mechanic = self.st.connected_job.mechanics.first()
+        start = timezone.now().replace(microsecond=0) + timedelta(days=30)
+        employee_works = [
+            {
+                'employee': mechanic.id,
+                'start_time': (start + timedelta(hours=hour)).isoformat(),
+                'end_time': (start + timedelta(hours=hour, minutes=30)).isoformat(),
+                'mileage': 1,
+            }
+            for hour in range(blocks_count)
+        ]
+        url = reverse('api:service_ticket-detail', args=[self.st.id])
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.patch(
+                url, data=json.dumps({'employee_works': employee_works}), content_type='application/json'
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+        return context.captured_queries
+
+    def test_employee_works_are_written_in_bulk(self):
+        queries = self.patch_employee_works(50)
+        self.assertEqual(self.st.employee_works.count(), 50)
+        inserts = [query for query in queries if query['sql'].startswith('INSERT INTO "api_employeeworkblock"')]
+        self.assertEqual(len(inserts), 1)
+
+        # updating the 50 blocks and replacing them costs the same
+        blocks = list(self.st.employee_works.order_by('start_time'))
+        url = reverse('api:service_ticket-detail', args=[self.st.id])
+        employee_works = [
+            {
+                'id': block.id,
+                'employee': block.employee_id,
+                'start_time': block.start_time.isoformat(),
+                'end_time': block.end_time.isoformat(),
+                'mileage': 2,
+            }
+            for block in blocks[:25]
+        ]
+        response = self.client.patch(
+            url, data=json.dumps({'employee_works': employee_works}), content_type='application/json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+        self.assertEqual(
+            sorted(self.st.employee_works.values_list('id', flat=True)), sorted(block.id for block in blocks[:25])
+        )
+        self.assertFalse(self.st.employee_works.exclude(mileage=2).exists())
+
+    def test_employee_works_queries_do_not_depend_on_blocks_count(self):
+        small = self.patch_employee_works(5)
+        large = self.patch_employee_works(50)
+        # one employee lookup per block is done by the field validation
+        self.assertEqual(len(large) - len(small), 45)
+
+
+class TestServiceTicketExportView(TestCase):
+
+    def setUp(self):
+        self.user = AdminFactory()
+        self.client.force_login(self.user)
+        self.job = JobFactory()
+        self.service_tickets = [ServiceTicketFactory(connected_job=self.job) for _ in range(3)]
+
+    def tearDown(self):
+        for st in self.service_tickets:
+            delete_file(st.customer_signature.path)
+            for attachment in st.attachments.all():
+                delete_file(attachment.file.path)
+
+    def test_streamed_zip_contains_every_ticket(self):
+        url = reverse('api:service-ticket-export-view', args=[self.job.id])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        archive = zipfile.ZipFile(BytesIO(b''.join(response.streaming_content)))
+        self.assertEqual(
+            sorted(archive.namelist()),
+            sorted(f'{st.id}.pdf' for st in self.service_tickets)
+        )
+        for name in archive.namelist():
+            self.assertTrue(archive.read(name).startswith(b'%PDF'))
+
+    def test_mechanic_not_in_job_is_forbidden(self):
+        self.client.force_login(MechanicFactory())
+        url = reverse('api:service-ticket-export-view', args=[self.job.id])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    @override_settings(SERVICE_TICKET_EXPORT_BACKEND='local')
+    def test_async_export_can_be_polled_and_downloaded(self):
+        url = reverse('api:service-ticket-export-view', args=[self.job.id])
+        response = self.client.get(url, {'async': 'true'})
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        export = ServiceTicketExport.objects.get(pk=response.data['id'])
+        self.addCleanup(delete_file, export.file.path)
+
+        response = self.client.get(response.data['status_url'])
+        self.assertEqual(response.data['status'], ServiceTicketExport.DONE)
+        self.assertEqual(response.data['processed'], len(self.service_tickets))
+
+        response = self.client.get(response.data['download_url'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        archive = zipfile.ZipFile(BytesIO(b''.join(response.streaming_content)))
+        self.assertEqual(len(archive.namelist()), len(self.service_tickets))
+
+    @override_settings(SERVICE_TICKET_EXPORT_BACKEND='local', SERVICE_TICKET_EXPORT_PENDING_LIMIT=1)
+    def test_stale_running_export_does_not_block_new_exports(self):
+        stale = ServiceTicketExport.objects.create(
+            job=self.job, requested_by=self.user, status=ServiceTicketExport.RUNNING,
+            started_at=timezone.now() - timedelta(days=1)
+        )
+        url = reverse('api:service-ticket-export-view', args=[self.job.id])
+        response = self.client.get(url, {'async': 'true'})
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.addCleanup(delete_file, ServiceTicketExport.objects.get(pk=response.data['id']).file.path)
+        stale.refresh_from_db()
+        self.assertEqual(stale.status, ServiceTicketExport.FAILED)
+
+    @override_settings(SERVICE_TICKET_EXPORT_BACKEND='local')
+    def test_async_export_records_tickets_that_failed_to_render(self):
+        failed_st = self.service_tickets[0]
+        render_pdf = STExportView.render_pdf
+
+        def render_or_fail(st_ctx):
+            return None if st_ctx['id'] == failed_st.id else render_pdf(st_ctx)
+
+        url = reverse('api:service-ticket-export-view', args=[self.job.id])
+        with patch.object(STExportView, 'render_pdf', side_effect=render_or_fail):
+            response = self.client.get(url, {'async': 'true'})
+        export = ServiceTicketExport.objects.get(pk=response.data['id'])
+        self.addCleanup(delete_file, export.file.path)
+        self.assertEqual(export.status, ServiceTicketExport.DONE)
+        self.assertEqual(export.processed, len(self.service_tickets) - 1)
+        self.assertIn(str(failed_st.id), export.error)
+
+    def test_export_status_is_private(self):
+        export = ServiceTicketExport.objects.create(job=self.job, requested_by=ManagerFactory())
+        response = self.client.get(reverse('api:service-ticket-export-status', args=[export.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)  # admins see every export
+        self.client.force_login(ManagerFactory())
+        response = self.client.get(reverse('api:service-ticket-export-download', args=[export.id]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TestSTExportViewCache(TestCase):
+
+    def setUp(self):
+        self.client.force_login(AdminFactory())
+        self.st = ServiceTicketFactory()
+        self.url = reverse('export_st_pdf', args=[self.st.id])
+
+    def tearDown(self):
+        delete_file(self.st.customer_signature.path)
+        for attachment in self.st.attachments.all():
+            delete_file(attachment.file.path)
+
+    def test_second_export_is_served_from_cache(self):
+        self.assertEqual(self.client.get(self.url)['X-PDF-Cache'], 'miss')
+        self.assertEqual(self.client.get(self.url)['X-PDF-Cache'], 'hit')
+        self.assertEqual(ServiceTicketPDFCache.stats(), {'hits': 1, 'misses': 1})
+
+    def test_ticket_and_job_changes_invalidate_cached_pdf(self):
+        self.client.get(self.url)
+        self.st.save()
+        self.assertEqual(self.client.get(self.url)['X-PDF-Cache'], 'miss')
+        self.st.connected_job.save()
+        self.assertEqual(self.client.get(self.url)['X-PDF-Cache'], 'miss')
+        self.assertEqual(self.client.get(self.url)['X-PDF-Cache'], 'hit')
+
+    def test_pdf_rendered_before_invalidation_is_not_served(self):
+        key, pdf = ServiceTicketPDFCache.get(self.st)
+        self.assertIsNone(pdf)
+        ServiceTicketPDFCache.invalidate(st_ids=[self.st.id])
+        ServiceTicketPDFCache.set(key, b'stale')
+        self.assertIsNone(ServiceTicketPDFCache.get(self.st)[1])
+
+
+@tag('benchmark')
+@skipUnless(RUN_BENCHMARKS, 'benchmark, run with RUN_BENCHMARKS=1')
+class TestServiceTicketScopingBenchmark(TestCase):
+    """Run with: RUN_BENCHMARKS=1 manage.py test --tag benchmark"""
+    TICKETS_COUNT = 5000
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.mechanic = MechanicFactory()
+        other_mechanic = MechanicFactory()
+        job = JobFactory(mechanics=(cls.mechanic, other_mechanic))
+        tickets = ServiceTicket.objects.bulk_create(
+            ServiceTicket(connected_job=job) for _ in range(cls.TICKETS_COUNT)
+        )
+        # two crew entries of the mechanic per ticket, the old join returned every ticket twice
+        EmployeeWorkBlock.objects.bulk_create(
+            EmployeeWorkBlock(service_ticket=st, employee=mechanic, mileage=0)
+            for st in tickets for mechanic in (cls.mechanic, cls.mechanic, other_mechanic)
+        )
+
+    @staticmethod
+    def measure(queryset):
+        started = time.perf_counter()
+        page = list(queryset.order_by('-creation_date', '-id').values_list('id', flat=True)[:25])
+        count = queryset.count()
+        return time.perf_counter() - started, page, count
+
+    def test_exists_scoping_against_distinct_join(self):
+        tickets = ServiceTicket.objects.filter(is_archive=False)
+        before = tickets.filter(employee_works__employee=self.mechanic.id).distinct()
+        after = ServiceTicketViewSet.scope_to_user(tickets, self.mechanic)
+
+        before_time, before_page, before_count = self.measure(before)
+        after_time, after_page, after_count = self.measure(after)
+        self.assertEqual(after_page, before_page)
+        self.assertEqual(after_count, before_count)
+        self.assertEqual(after_count, self.TICKETS_COUNT)
+        self.assertNotIn('DISTINCT', str(after.query))
+        sys.stderr.write(
+            f'\nmechanic with {self.TICKETS_COUNT} tickets, first page and count: '
+            f'DISTINCT join {before_time * 1000:.1f} ms, EXISTS {after_time * 1000:.1f} ms\n'
+        )
@@ -1,12 +1,16 @@
 import json
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread
 from unittest.mock import patch
 from urllib.parse import urlencode
 
+from django.contrib.auth.models import Group
 from django.test import TestCase
 from django.urls import reverse
 
 from rest_framework import status
 
+from apps.utils.beams import BeamsPublisher
 from apps.utils.communication import encode_dict_to_base64
 from ..models import User
 from .factories import AdminFactory, UserFactory, MechanicFactory, ManagerFactory
@@ -221,8 +225,34 @@ class TestUserViewSet(TestCase):
     def test_no_pagination(self):
         url = '/api/v1/auth/?all=True'
         response = self.client.get(url, content_type='application/json')
-        self.assertNotIn('next', response.data)
-        self.assertNotIn('previous', response.data)
+        self.assertTrue(response.streaming)
+        data = json.loads(b''.join(response.streaming_content))
+        self.assertIsInstance(data, list)
+        self.assertEqual(len(data), User.objects.count())
+
+    def test_no_pagination_reads_keyset_chunks_in_list_order(self):
+        for _ in range(4):
+            MechanicFactory()
+        with patch('apps.authentication.views.UserViewSet.stream_chunk_size', 2):
+            response = self.client.get('/api/v1/auth/?all=true', content_type='application/json')
+            data = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(
+            [user['id'] for user in data],
+            list(User.objects.order_by('status', '-date_joined', 'pk').values_list('pk', flat=True))
+        )
+
+    def test_cursor_pagination(self):
+        for _ in range(3):
+            MechanicFactory()
+        url = reverse('authentication:user-list')
+        response = self.client.get(url, {'cursor': '', 'page_size': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        ids = [user['id'] for user in response.data['results']]
+        self.assertNotIn('count', response.data)
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            ids += [user['id'] for user in response.data['results']]
+        self.assertEqual(ids, list(User.objects.order_by('-date_joined', '-id').values_list('id', flat=True)))
 
     def test_get_all_manager(self):
         new_manager = ManagerFactory()
@@ -259,3 +289,101 @@ class TestUserViewSet(TestCase):
             response.data.get('detail'),
             'You do not have permission to perform this action.'
         )
+
+
+class TestUserRoleCache(TestCase):
+
+    def test_role_flags_use_one_query(self):
+        mechanic = User.objects.get(id=MechanicFactory().id)
+        with self.assertNumQueries(1):
+            self.assertFalse(mechanic.is_admin)
+            self.assertFalse(mechanic.is_manager)
+            self.assertFalse(mechanic.is_biller)
+            self.assertTrue(mechanic.is_mechanic)
+            self.assertTrue(mechanic.is_mechanic)
+
+    def test_role_cache_reset_on_groups_change(self):
+        user = User.objects.get(id=MechanicFactory().id)
+        self.assertTrue(user.is_mechanic)
+        user.groups.clear()
+        self.assertFalse(user.is_mechanic)
+        user.groups.add(Group.objects.get(name='Manager'))
+        self.assertTrue(user.is_manager)
+
+    def test_role_cache_reset_on_refresh_from_db(self):
+        user = User.objects.get(id=MechanicFactory().id)
+        self.assertTrue(user.is_mechanic)
+        Group.objects.get(name='Mechanic').user_set.remove(user)
+        self.assertTrue(user.is_mechanic)
+        user.refresh_from_db()
+        self.assertFalse(user.is_mechanic)
+
+
+class FakeBeamsHandler(BaseHTTPRequestHandler):
+    """Beams publish API answering with a publish id, fails the first `failures` requests."""
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if server.failures:
+            server.failures -= 1
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        server.publishes.append((self.path, body))
+        content = json.dumps({'publishId': f'pub-{len(server.publishes)}'}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestBeamsPublisher(TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), FakeBeamsHandler)
+        self.server.publishes = []
+        self.server.failures = 0
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.publisher = BeamsPublisher(
+            instance_id='instance', secret_key='secret',
+            base_url=f'http://127.0.0.1:{self.server.server_port}', backoff_factor=0
+        )
+        self.body = {'web': {'notification': {'title': 'Job approved'}}}
+
+    def test_batch_groups_users_of_the_same_notification(self):
+        with self.publisher.batch():
+            for user_id in range(1, 1201):
+                self.publisher.publish_to_users([user_id], self.body)
+            self.publisher.publish_to_interests(['managers'], self.body)
+            self.assertEqual(self.server.publishes, [])
+
+        paths = [path for path, _body in self.server.publishes]
+        self.assertEqual(paths, [
+            '/publish_api/v1/instances/instance/publishes/users',
+            '/publish_api/v1/instances/instance/publishes/users',
+            '/publish_api/v1/instances/instance/publishes/interests',
+        ])
+        users = [body['users'] for path, body in self.server.publishes if path.endswith('users')]
+        self.assertEqual([len(ids) for ids in users], [1000, 200])
+        self.assertEqual(users[0][0], '1')
+        self.assertEqual(self.server.publishes[0][1]['web'], self.body['web'])
+
+    def test_batch_that_raises_sends_nothing(self):
+        with self.assertRaises(ValueError):
+            with self.publisher.batch():
+                self.publisher.publish_to_users([1], self.body)
+                raise ValueError
+        self.assertEqual(self.server.publishes, [])
+
+    def test_failed_publish_is_retried(self):
+        self.server.failures = 2
+        self.assertEqual(self.publisher.publish_to_users([1], self.body), ['pub-1'])
+        self.assertEqual(len(self.server.publishes), 1)
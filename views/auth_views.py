@@ -30,6 +30,8 @@ from apps.utils.tasks import (
     send_reset_password
 )
 from apps.notifications.notification_interface import beams_client
+from apps.utils.bulk_helpers import parse_ids, split_ids
+from apps.utils.pagination import KeysetPaginationMixin
 from apps.utils.request_middleware import RequestMiddleware
 from .authentication import CsrfExemptAuthentication
 from .filters import UserFilter
@@ -43,7 +45,8 @@ from .serializers import (
 )
 
 
-class UserViewSet(ListModelMixin,
+class UserViewSet(KeysetPaginationMixin,
+                  ListModelMixin,
                   CreateModelMixin,
                   RetrieveModelMixin,
                   UpdateModelMixin,
@@ -64,7 +67,8 @@ class UserViewSet(ListModelMixin,
             /?status=archived - get all archived users
             /?status=active - get all active users
         Available ordering fields: name, role, email
-        Request without pagination example: /?all=true
+        Request without pagination example (streamed JSON array): /?all=true
+        Cursor pagination example: /?cursor= , then follow the next link
     """
     serializer_class = UserSerializer
     queryset = User.objects.order_by('status', '-date_joined')
@@ -73,12 +77,7 @@ class UserViewSet(ListModelMixin,
     filter_backends = (DjangoFilterBackend, SearchFilter,)
     filterset_class = UserFilter
     search_fields = ('first_name', 'last_name', 'groups__name', 'email',)
-
-    def paginate_queryset(self, queryset):
-        """Turn off the Pagination if the server gets all=True query parameter."""
-        do_pagination = 'true' not in self.request.query_params.get('all', '').lower()
-        if do_pagination:
-            return super().paginate_queryset(queryset)
+    cursor_ordering = ('-date_joined', '-id')
 
     def get_permissions(self):
         if self.action in ('partial_update', 'retrieve', 'update',):
@@ -231,6 +230,20 @@ class UserViewSet(ListModelMixin,
         transaction.on_commit(lambda: send_reset_password.delay(user.id, password))
         return Response({'detail': [_('Email is sent!')]}, status=status.HTTP_200_OK)
 
+    def set_status(self, ids, user_status, sent_notifications):
+        """
+        Archive or restore users in a single UPDATE.
+        Returns (success_ids, error_ids).
+        """
+        with transaction.atomic():
+            user_ids = list(User.objects.filter(id__in=parse_ids(ids)).values_list('id', flat=True))
+            User.objects.filter(id__in=user_ids).update(
+                status=user_status,
+                sent_email_notifications=sent_notifications,
+                sent_push_notifications=sent_notifications
+            )
+        return split_ids(ids, set(user_ids))
+
     @action(detail=False, methods=['post'], permission_classes=[IsAdmin])
     def archive_users(self, request, pk=None):
         """
@@ -242,23 +255,7 @@ class UserViewSet(ListModelMixin,
         if ids is None or not isinstance(ids, list):
             response = {'ids': [_('This field is required. And it should be a list')]}
             return Response(response, status=status.HTTP_400_BAD_REQUEST)
-        error_ids = []
-        success_ids = []
-        for id in ids:
-            try:
-                user_obj = User.objects.get(id=id)
-                user_obj.status = User.ARCHIVED
-                user_obj.sent_email_notifications = False
-                user_obj.sent_push_notifications = False
-                user_obj.save(
-                    update_fields=[
-                        'status', 'sent_email_notifications',
-                        'sent_push_notifications'
-                    ]
-                )
-                success_ids.append(id)
-            except (ValueError, User.DoesNotExist,):
-                error_ids.append(id)
+        success_ids, error_ids = self.set_status(ids, User.ARCHIVED, False)
         response = {
             "Successfully archived Users (IDs)": success_ids,
             "Failed to archive Users (IDs)": error_ids
@@ -276,23 +273,7 @@ class UserViewSet(ListModelMixin,
         if ids is None or not isinstance(ids, list):
             response = {'ids': [_('This field is required. And it should be a list')]}
             return Response(response, status=status.HTTP_400_BAD_REQUEST)
-        error_ids = []
-        success_ids = []
-        for id in ids:
-            try:
-                user_obj = User.objects.get(id=id)
-                user_obj.status = User.ACTIVE
-                user_obj.sent_email_notifications = True
-                user_obj.sent_push_notifications = True
-                user_obj.save(
-                    update_fields=[
-                        'status', 'sent_email_notifications',
-                        'sent_push_notifications'
-                    ]
-                )
-                success_ids.append(id)
-            except (ValueError, User.DoesNotExist,):
-                error_ids.append(id)
+        success_ids, error_ids = self.set_status(ids, User.ACTIVE, True)
         response = {
             "Successfully unarchived Users (IDs)": success_ids,
             "Failed to unarchive Users (IDs)": error_ids
@@ -18,6 +18,7 @@ from fhir.foundation.other.bundle import Bundle as ExpBundle, Entry
 from utils.dto.fhir_dto import FhirResult
 from utils.helpers.core_helpers import Render
 from utils.helpers.fhir_helper import render_fhir_resources
+from utils.helpers.fhir_render_cache import render_cached
 from utils.helpers.pgo_regex import Pgex
 from utils.helpers.resource_helper import ResUtil
 from utils.http.http_client import PgoHttp
@@ -74,7 +75,9 @@ async def handle_db_resource(request, db_resource: FhirResource, user):
             else:
                 logger.error("Document not available or URL not found")
                 return render(request, resource_page_template, locals())
-        rendered_result = await render_single_resource(rsrc_json, request.user)
+        rendered_result = await render_cached(
+            db_resource, request.user, user_tz, lambda: render_single_resource(rsrc_json, request.user)
+        )
     except Exception as e:
         logger.error(f"{db_resource.resource_type}/{db_resource.resource_id} \n {traceback.print_exc()}")
         messages.warning(request, f"{db_resource.resource_type}/{db_resource.resource_id}: {e}")
@@ -111,10 +114,19 @@ async def handle_resource_result(request, resp: FhirResult, endpoint):
     if ResUtil.type(resp.http_resp.json) == ResType.BINARY:
         return await sync_to_async(handle_binary_resource)(resp.http_resp.json, request)
 
-    rendered_result = await render_single_resource(resp.http_resp.json, request.user)
+    rendered_result = await render_cached(
+        saved_rsrc, request.user, user_tz, lambda: render_single_resource(resp.http_resp.json, request.user)
+    )
     return await sync_to_async(render)(request, resource_page_template, locals())
 
 
+async def render_bundle(bundle_json: dict, user: User):
+    exp_bundle: ExpBundle = from_dict(data_class=ExpBundle, data=bundle_json)
+    flatten_resources = await render_fhir_resources(user, exp_bundle.entry)
+    rendered_result = Render.table(fhir_resources=flatten_resources, render_template="bundle_render.html")
+    return rendered_result.decode("utf-8").strip()
+
+
 async def render_single_resource(resource_json: dict, user: User):
     entry: Entry = from_dict(data_class=Entry, data={'resource': resource_json})
     flatten_resources = await render_fhir_resources(user, [entry])
@@ -243,16 +255,18 @@ class MyHealthDataView(AsyncLoginRequiredMixin, PgoLogMixin, View):
 
         json_b = resource_data.resource_json
         resource_type = ResUtil.type(json_b)
+        # repeat views of an unchanged resource skip the parsing and flattening
         if resource_type == ResType.BUNDLE:
-            exp_bundle: ExpBundle = from_dict(data_class=ExpBundle, data=json_b)
-            flatten_resources = await render_fhir_resources(request.user, exp_bundle.entry)
-            rendered_result = Render.table(fhir_resources=flatten_resources, render_template="bundle_render.html")
-            rendered_result = rendered_result.decode("utf-8").strip()
+            rendered_result = await render_cached(
+                resource_data, request.user, user_tz, lambda: render_bundle(json_b, request.user)
+            )
             # if string is empty, set to none
             if not rendered_result:
                 rendered_result = None
         else:
-            rendered_result = await render_single_resource(json_b, request.user)
+            rendered_result = await render_cached(
+                resource_data, request.user, user_tz, lambda: render_single_resource(json_b, request.user)
+            )
 
         # set the scope if necessary on other paths for requests
         request.session['scope'] = scope
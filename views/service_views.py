@@ -2,13 +2,15 @@
 
 import time
 
-from datetime import datetime
+from datetime import datetime, timedelta
 
-from django.http import HttpResponse
+from django.conf import settings
+from django.http import FileResponse, StreamingHttpResponse
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.translation import gettext_lazy as _
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
 from django.shortcuts import get_object_or_404
 
 from django_filters.rest_framework import DjangoFilterBackend
@@ -27,25 +29,33 @@ from rest_framework.parsers import JSONParser, FormParser, MultiPartParser
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from apps.utils.bulk_helpers import parse_ids, split_ids
+from apps.utils.export_helpers import bounded_map, stream_zip
+from apps.utils.export_queue import enqueue_service_ticket_export
+from apps.utils import notification_dispatch
 from apps.utils.fields import IntegerChoiceField
+from apps.utils.pagination import KeysetPaginationMixin
+from apps.utils.pdf_cache import ServiceTicketPDFCache
+from apps.utils.search import DocumentSearchFilter
+from apps.utils.tabular_export import CSV, FILE_FORMATS, tabular_response
 from .exceptions import DBLockedException
-from .models import Job, Customer, Location, ServiceTicket, DBLockDate
+from .models import (
+    Job, Customer, DailyWorkRollup, EmployeeWorkBlock, Location, ServiceTicket, ServiceTicketExport, DBLockDate
+)
 from .filters import JobFilter, ServiceTicketFilter
 from .serializers import (
     CustomerSerializer, RemoveCustomerLocationSerializer, JobWriteSerializer, JobReadSerializer,
     ServiceTicketReadSerializer, ServiceTicketWriteSerializer, DeleteAttachmentSerializer,
-    DeleteEmployeeWorksSerializer
+    DeleteEmployeeWorksSerializer, ServiceTicketExportSerializer
 )
 from apps.notifications.models import Action
 from .permissions import IsHaveAccessToCustomer, CanRemoveCustomerLocation
 from apps.authentication.permissions import IsAdmin
 from apps.api.utils import dict_none_defaults, render_to_pdf, PDFRenderer
 
-from io import BytesIO
-
-import zipfile
 
-class JobViewSet(CreateModelMixin,
+class JobViewSet(KeysetPaginationMixin,
+                 CreateModelMixin,
                  ListModelMixin,
                  RetrieveModelMixin,
                  UpdateModelMixin,
@@ -65,10 +75,11 @@ class JobViewSet(CreateModelMixin,
         Available ordering fields: number, status, created_by, requested_by, approved_by, location, customer, time_stamp
         If you want to exclude: /?status!=Open
         If you want to get archived objects: /?is_archive=true
+        Cursor pagination example: /?cursor= , then follow the next link
     """
 
     queryset = Job.objects.all().order_by('-creation_date')
-    filter_backends = (DjangoFilterBackend, SearchFilter,)
+    filter_backends = (DjangoFilterBackend, DocumentSearchFilter,)
     filterset_class = JobFilter
     search_fields = (
         'location__name', 'customer__name', 'number',
@@ -91,8 +102,15 @@ class JobViewSet(CreateModelMixin,
         is_archive = self.request.query_params.get('is_archive', None)
         if is_archive is None:
             queryset = queryset.filter(is_archive=False)
+        if self.action == 'list':
+            queryset = queryset.select_related(
+                'created_by', 'requester', 'approval', 'customer', 'location',
+            ).prefetch_related(
+                'customer__locations', 'created_by__groups', 'requester__groups',
+                'approval__groups', 'mechanics__groups', 'managers__groups',
+            ).with_list_counters()
         return queryset
-    
+
 
     @swagger_auto_schema(responses={200: JobReadSerializer})
     def create(self, request, *args, **kwargs):
@@ -102,18 +120,34 @@ class JobViewSet(CreateModelMixin,
     def partial_update(self, request, *args, **kwargs):
         return super().partial_update(request, args, kwargs)
 
-    def change_action_is_viewed(self, job_id):
+    def change_action_is_viewed(self, job_ids):
         """
         Makes notifications is_viewed
         """
         list_st_id = ServiceTicket.objects.filter(
-            connected_job=job_id
-        ).values_list('id', flat=True)
+            connected_job__in=job_ids
+        ).values('id')
         Action.objects.filter(
-            Q(connected_object_id=job_id, object_type=0) |  # OBJECT_TYPES Jobh
+            Q(connected_object_id__in=job_ids, object_type=0) |  # OBJECT_TYPES Jobh
             Q(connected_object_id__in=list_st_id, object_type=1)  # OBJECT_TYPES ST
         ).update(is_viewed=True)
 
+    def set_is_archive(self, ids, is_archive):
+        """
+        Archive or restore the jobs and their service tickets with a fixed
+        number of statements, whatever the number of ids.
+        Returns (success_ids, error_ids).
+        """
+        with transaction.atomic():
+            job_ids = list(Job.objects.filter(id__in=parse_ids(ids)).values_list('id', flat=True))
+            Job.objects.filter(id__in=job_ids).update(is_archive=is_archive)
+            ServiceTicket.objects.filter(connected_job__in=job_ids).update(is_archive=is_archive)
+            if is_archive:
+                self.change_action_is_viewed(job_ids)
+        ServiceTicketPDFCache.invalidate(job_ids=job_ids)
+        DailyWorkRollup.refresh_jobs(job_ids)
+        return split_ids(ids, set(job_ids))
+
     @action(detail=False, methods=['post'], permission_classes=[IsAdmin])
     def archive_job(self, request, pk=None):
         """
@@ -125,22 +159,11 @@ class JobViewSet(CreateModelMixin,
         if ids is None or not isinstance(ids, list):
             response = {'ids': [_('This field is required. And it should be a list')]}
             return Response(response, status=status.HTTP_400_BAD_REQUEST)
-        error_ids = []
-        success_ids = []
-        for id in ids:
-            try:
-                ih_obj = Job.objects.get(id=id)
-                ih_obj.is_archive = True
-                ih_obj.save(update_fields=['is_archive'])
-                ServiceTicket.objects.filter(connected_job=ih_obj).update(is_archive=True)
-                success_ids.append(id)
-                self.change_action_is_viewed(ih_obj.id)
-            except (ValueError, Job.DoesNotExist,):
-                error_ids.append(id)
-            response = {
-                "Successfully archived Job (IDs)": success_ids,
-                "Failed to archive Job (IDs)": error_ids
-            }
+        success_ids, error_ids = self.set_is_archive(ids, True)
+        response = {
+            "Successfully archived Job (IDs)": success_ids,
+            "Failed to archive Job (IDs)": error_ids
+        }
         return Response(response, status=status.HTTP_200_OK)
 
     @action(detail=False, methods=['post'], permission_classes=[IsAdmin])
@@ -154,25 +177,16 @@ class JobViewSet(CreateModelMixin,
         if ids is None or not isinstance(ids, list):
             response = {'ids': [_('This field is required. And it should be a list')]}
             return Response(response, status=status.HTTP_400_BAD_REQUEST)
-        error_ids = []
-        success_ids = []
-        for id in ids:
-            try:
-                ih_obj = Job.objects.get(id=id)
-                ih_obj.is_archive = False
-                ih_obj.save(update_fields=['is_archive'])
-                ServiceTicket.objects.filter(connected_job=ih_obj).update(is_archive=False)
-                success_ids.append(id)
-            except (ValueError, Job.DoesNotExist,):
-                error_ids.append(id)
-            response = {
-                "Successfully unarchived Job (IDs)": success_ids,
-                "Failed to unarchive Job (IDs)": error_ids
-            }
+        success_ids, error_ids = self.set_is_archive(ids, False)
+        response = {
+            "Successfully unarchived Job (IDs)": success_ids,
+            "Failed to unarchive Job (IDs)": error_ids
+        }
         return Response(response, status=status.HTTP_200_OK)
 
 
-class ServiceTicketViewSet(CreateModelMixin,
+class ServiceTicketViewSet(KeysetPaginationMixin,
+                           CreateModelMixin,
                            ListModelMixin,
                            RetrieveModelMixin,
                            UpdateModelMixin,
@@ -193,12 +207,13 @@ class ServiceTicketViewSet(CreateModelMixin,
         Filter example: /?status=Open&start_date=09/13/19&end_date=10/13/19&search=WTX&ordering=-number
         Available ordering fields: id, status, date, number, created_by, requested_by, approved_by, location, customer, notes
         If you want to get archived objects: /?is_archive=true
+        Cursor pagination example: /?cursor= , then follow the next link
     """
 
     parser_classes = (JSONParser, FormParser, MultiPartParser,)
     queryset = ServiceTicket.objects.filter(is_archive=False).prefetch_related('employee_works').order_by('-creation_date')
     permission_classes = (IsAuthenticated,)
-    filter_backends = (DjangoFilterBackend, SearchFilter,)
+    filter_backends = (DjangoFilterBackend, DocumentSearchFilter,)
     filterset_class = ServiceTicketFilter
     search_fields = (
         'connected_job__location__name', 'connected_job__customer__name', 'connected_job__number',
@@ -213,13 +228,80 @@ class ServiceTicketViewSet(CreateModelMixin,
 
     def get_queryset(self, *args, **kwargs):
         queryset = super().get_queryset(*args, **kwargs)
-        user = self.request.user
+        if self.action in ('list', 'retrieve'):
+            # everything ServiceTicketReadSerializer touches, so a page costs the same whatever its size
+            queryset = queryset.select_related(
+                'connected_job__customer', 'connected_job__location', 'created_by', 'requester', 'approval',
+            ).prefetch_related(
+                'connected_job__customer__locations', 'employee_works__employee', 'attachments',
+                'created_by__groups', 'requester__groups', 'approval__groups',
+            )
+        return self.scope_to_user(queryset, self.request.user)
+
+    @staticmethod
+    def scope_to_user(queryset, user):
+        """
+        Limit the tickets to the ones the user may see.
+        EXISTS subqueries keep one row per ticket, so no DISTINCT over the wide ticket row is needed.
+        """
         if user.is_mechanic:
-            queryset = queryset.filter(employee_works__employee=user.id)
-            # q = list(queryset)
+            queryset = queryset.filter(Exists(
+                EmployeeWorkBlock.objects.filter(service_ticket=OuterRef('pk'), employee=user.id)
+            ))
         elif user.is_manager:
-            queryset = queryset.filter(connected_job__managers=user.id)
-        return queryset.distinct()
+            queryset = queryset.filter(Exists(
+                Job.managers.through.objects.filter(job=OuterRef('connected_job'), manager=user.id)
+            ))
+        return queryset
+
+    EXPORT_COLUMNS = (
+        ('id', 'id'),
+        ('status', 'status'),
+        ('job_number', 'connected_job__number'),
+        ('customer', 'connected_job__customer__name'),
+        ('location', 'connected_job__location__name'),
+        ('created_by_first_name', 'created_by__first_name'),
+        ('created_by_last_name', 'created_by__last_name'),
+        ('employees', 'employee_names'),
+        ('worked_hours', 'worked_duration'),
+        ('mileage', 'mileage_total'),
+        ('hotel', 'hotel_count'),
+        ('per_diem', 'per_diem_count'),
+    ) + tuple(
+        (field, field) for field in ServiceTicketWriteSerializer.Meta.fields
+        if field not in ('status', 'connected_job', 'employee_works', 'attachments', 'customer_signature')
+    )
+
+    def iter_export_rows(self, queryset):
+        statuses = dict(ServiceTicket.STATUSES)
+        lookups = [lookup for _header, lookup in self.EXPORT_COLUMNS]
+        status_index = lookups.index('status')
+        worked_index = lookups.index('worked_duration')
+        # iterator() reads through a server-side cursor, rows are never collected in a list
+        for row in queryset.order_by('id').values_list(*lookups).iterator(chunk_size=2000):
+            row = list(row)
+            row[status_index] = statuses.get(row[status_index])
+            row[worked_index] = round(row[worked_index] / timedelta(hours=1), 2) if row[worked_index] else 0
+            yield row
+
+    @action(detail=False, methods=['get'])
+    def export(self, request):
+        """
+        Export the filtered Service Tickets as a table: /export/?file_format=csv (default) or xlsx.
+        Takes the same filters and search as the list.
+        """
+        file_format = request.query_params.get('file_format', CSV)
+        if file_format not in FILE_FORMATS:
+            return Response(
+                {'status': 'error', 'message': f'file_format must be one of: {", ".join(FILE_FORMATS)}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        queryset = self.filter_queryset(self.get_queryset())
+        header = [header for header, _lookup in self.EXPORT_COLUMNS]
+        try:
+            return tabular_response(header, self.iter_export_rows(queryset), file_format, 'service-tickets')
+        except ValueError as error:
+            return Response({'status': 'error', 'message': str(error)}, status=status.HTTP_400_BAD_REQUEST)
 
     @swagger_auto_schema(
         methods=['patch'],
@@ -308,26 +390,28 @@ class ServiceTicketViewSet(CreateModelMixin,
         if ids is None or not isinstance(ids, list):
             response = {'ids': [_('This field is required. And it should be a list')]}
             return Response(response, status=status.HTTP_400_BAD_REQUEST)
-        error_ids = []
-        success_ids = []
-        for id in ids:
-            try:
-                ih_obj = ServiceTicket.objects.get(id=id)
-                ih_obj.is_archive = True
-                ih_obj.save(update_fields=['is_archive'])
-                success_ids.append(id)
-                Action.objects.filter(
-                    connected_object_id=ih_obj.id,
-                    object_type=1  # OBJECT_TYPES ST
-                ).update(is_viewed=True)
-            except (ValueError, ServiceTicket.DoesNotExist,):
-                error_ids.append(id)
-            response = {
-                "Successfully archived Service Ticket (IDs)": success_ids,
-                "Failed to archive Service Ticket (IDs)": error_ids
-            }
+        with transaction.atomic():
+            st_ids = list(
+                ServiceTicket.objects.filter(id__in=parse_ids(ids)).values_list('id', flat=True)
+            )
+            ServiceTicket.objects.filter(id__in=st_ids).update(is_archive=True)
+            Action.objects.filter(
+                connected_object_id__in=st_ids,
+                object_type=1  # OBJECT_TYPES ST
+            ).update(is_viewed=True)
+        ServiceTicketPDFCache.invalidate(st_ids=st_ids)
+        DailyWorkRollup.refresh_jobs(
+            ServiceTicket.objects.filter(id__in=st_ids, status=ServiceTicket.APPROVED).values_list(
+                'connected_job_id', flat=True
+            )
+        )
+        success_ids, error_ids = split_ids(ids, set(st_ids))
+        response = {
+            "Successfully archived Service Ticket (IDs)": success_ids,
+            "Failed to archive Service Ticket (IDs)": error_ids
+        }
         return Response(response, status=status.HTTP_200_OK)
-    
+
     def get_object(self):
         """
         Returns the object the view is displaying.
@@ -370,14 +454,15 @@ class ServiceTicketViewSet(CreateModelMixin,
 
 
 
-class CustomerViewSet(viewsets.ModelViewSet):
+class CustomerViewSet(KeysetPaginationMixin, viewsets.ModelViewSet):
     """
     list:
 
     Customer endpoint.\n
         Filter example: /?search=CustomerName
 
-        Request without pagination example: /?all=true
+        Request without pagination example (streamed JSON array): /?all=true
+        Cursor pagination example: /?cursor= , then follow the next link
 
     create:
     Create a new Customer instance.
@@ -407,12 +492,7 @@ class CustomerViewSet(viewsets.ModelViewSet):
     filter_backends = [SearchFilter]
     search_fields = ['name']
     permission_classes = (IsAuthenticated, IsHaveAccessToCustomer,)
-
-    def paginate_queryset(self, queryset):
-        """Turn off the Pagination if the server gets all=True query parameter."""
-        do_pagination = 'true' not in self.request.query_params.get('all', '').lower()
-        if do_pagination:
-            return super().paginate_queryset(queryset)
+    cursor_ordering = ('id',)
 
     def destroy(self, request, *args, **kwargs):
         instance = self.get_object()
@@ -449,6 +529,26 @@ class CustomerViewSet(viewsets.ModelViewSet):
 class STExportView(APIView):
 
     renderer_classes = [PDFRenderer]
+    template_name = 'service_tickets/service_ticket.html'
+
+    @staticmethod
+    def get_pdf_context(st):
+        return dict_none_defaults(ServiceTicketReadSerializer(st).data)
+
+    @classmethod
+    def render_pdf(cls, st_ctx):
+        return render_to_pdf(cls.template_name, st_ctx)
+
+    @classmethod
+    def get_pdf(cls, st):
+        """Return (pdf, is_cached), rendering and caching the PDF on a cache miss."""
+        key, pdf = ServiceTicketPDFCache.get(st)
+        if pdf is not None:
+            return pdf, True
+        pdf = cls.render_pdf(cls.get_pdf_context(st))
+        if pdf:
+            ServiceTicketPDFCache.set(key, pdf)
+        return pdf, False
 
     @method_decorator(csrf_exempt)
     def get(self, request, st_id):
@@ -461,19 +561,15 @@ class STExportView(APIView):
             if not mechanic_connected:
                 return Response('This PDF is not yours', status=status.HTTP_403_FORBIDDEN)
 
-        # print(ServiceTicketReadSerializer(st))
-        st_ctx = dict_none_defaults(ServiceTicketReadSerializer(st).data)
-
-        template_name = 'service_tickets/service_ticket.html'
-
-        response_pdf = render_to_pdf(template_name, st_ctx)
+        response_pdf, is_cached = self.get_pdf(st)
         if not response_pdf:
             return Response('PDF is not available', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
         timestamp = int(time.time())
         filename = f'service_ticket_{st.id}_{timestamp}.pdf'
         headers = {
-            'Content-Disposition': f'inline; filename={filename}'
+            'Content-Disposition': f'inline; filename={filename}',
+            'X-PDF-Cache': 'hit' if is_cached else 'miss',
         }
 
         return Response(response_pdf, headers=headers, content_type='application/pdf')
@@ -485,21 +581,105 @@ class ServiceTicketExportView(APIView):
     def post(self, request, job_id):
         return Response({'status': 'error', 'message': 'method not allowed'}, status=status.HTTP_403_FORBIDDEN)
 
+    @staticmethod
+    def _render_entry(item):
+        st, key, st_ctx, pdf = item
+        if pdf is None:
+            pdf = STExportView.render_pdf(st_ctx)
+            if pdf:
+                ServiceTicketPDFCache.set(key, pdf)
+        return st.id, pdf
+
+    @staticmethod
+    def _iter_contexts(service_tickets):
+        for st in service_tickets.iterator(chunk_size=100):
+            key, pdf = ServiceTicketPDFCache.get(st)
+            if pdf is None:
+                yield st, key, STExportView.get_pdf_context(st), None
+            else:
+                yield st, key, None, pdf
+
+    def iter_pdf_entries(self, service_tickets, failed=None):
+        """
+        Serialize tickets one by one (DB access stays in the response thread)
+        and render the PDFs missing from the cache in a bounded worker pool.
+        Tickets whose PDF can't be rendered are left out, their ids are appended to failed.
+        """
+        workers = getattr(settings, 'SERVICE_TICKET_EXPORT_WORKERS', 4)
+        for st_id, pdf in bounded_map(self._render_entry, self._iter_contexts(service_tickets), workers):
+            if pdf:
+                yield f'{st_id}.pdf', pdf
+            elif failed is not None:
+                failed.append(st_id)
+
+    @staticmethod
+    def get_export_queryset(job_id):
+        return ServiceTicket.objects.filter(connected_job__id=job_id).select_related(
+            'connected_job__customer', 'connected_job__location',
+            'created_by', 'requester', 'approval',
+        ).prefetch_related(
+            'connected_job__customer__locations', 'employee_works__employee', 'attachments',
+        ).order_by('id')
+
     def get(self, request, job_id):
-        # print("Exporting tickets for job =", job_id)
-        if ServiceTicket.objects.filter(connected_job__id=job_id).count() > 0:
-            zip_archive = BytesIO()
-            with zipfile.ZipFile(zip_archive, mode='w', compression=zipfile.ZIP_DEFLATED) as zip_file:
-                for t in ServiceTicket.objects.filter(connected_job__id=job_id):
-                    zip_file.writestr(str(t.id) + '.pdf', STExportView.as_view()(request._request, t.id).render().content)
-            zip_file.close()
-
-            response = HttpResponse(zip_archive.getvalue(), content_type='application/zip')
-            # response.write(zip_archive)
-            response['Content-Disposition'] = 'attachment; filename="job-{}-service-tickets.zip"'.format(job_id)
-            return response
-        else:
+        service_tickets = ServiceTicket.objects.filter(connected_job__id=job_id)
+        if not service_tickets.exists():
             return Response({'status': 'error', 'message': 'No service ticket exist'}, status=status.HTTP_400_BAD_REQUEST)
+        if request.user.is_mechanic and not Job.objects.filter(id=job_id, mechanics=request.user.id).exists():
+            return Response('This PDF is not yours', status=status.HTTP_403_FORBIDDEN)
+        if request.query_params.get('async') == 'true':
+            return self.start_export(request, job_id, service_tickets.count())
+
+        response = StreamingHttpResponse(
+            stream_zip(self.iter_pdf_entries(self.get_export_queryset(job_id))), content_type='application/zip'
+        )
+        response['Content-Disposition'] = 'attachment; filename="job-{}-service-tickets.zip"'.format(job_id)
+        return response
+
+    def start_export(self, request, job_id, total):
+        """Queue a background export, the client polls its status_url."""
+        pending_limit = getattr(settings, 'SERVICE_TICKET_EXPORT_PENDING_LIMIT', 3)
+        ServiceTicketExport.fail_stale(requested_by=request.user)
+        pending = ServiceTicketExport.objects.filter(
+            requested_by=request.user, status__in=ServiceTicketExport.PENDING_STATUSES
+        ).count()
+        if pending >= pending_limit:
+            return Response(
+                {'status': 'error', 'message': 'Too many exports in progress'},
+                status=status.HTTP_429_TOO_MANY_REQUESTS
+            )
+        export = ServiceTicketExport.objects.create(job_id=job_id, requested_by=request.user, total=total)
+        enqueue_service_ticket_export(export)
+        export.refresh_from_db()
+        serializer = ServiceTicketExportSerializer(export, context={'request': request})
+        return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
+
+
+class ServiceTicketExportStatusView(APIView):
+    permission_classes = [IsAuthenticated, ]
+
+    @staticmethod
+    def get_export(request, export_id):
+        exports = ServiceTicketExport.objects.all()
+        if not request.user.is_admin:
+            exports = exports.filter(requested_by=request.user)
+        return get_object_or_404(exports, pk=export_id)
+
+    def get(self, request, export_id):
+        export = self.get_export(request, export_id)
+        return Response(ServiceTicketExportSerializer(export, context={'request': request}).data)
+
+
+class ServiceTicketExportDownloadView(ServiceTicketExportStatusView):
+
+    def get(self, request, export_id):
+        export = self.get_export(request, export_id)
+        if export.status != ServiceTicketExport.DONE:
+            return Response({'status': 'error', 'message': 'Export is not finished'}, status=status.HTTP_409_CONFLICT)
+        return FileResponse(
+            export.file.open('rb'), as_attachment=True,
+            filename='job-{}-service-tickets.zip'.format(export.job_id)
+        )
 
 
 class DBLockView(APIView):
@@ -517,3 +697,11 @@ class DBLockView(APIView):
         else:
             return Response({'status': 'error', 'message': 'Only manager can lock the DB'},
                             status=status.HTTP_403_FORBIDDEN)
+
+
+class NotificationDispatchStatsView(APIView):
+    """Queue depth of the notification dispatcher: pending, sent and coalesced status changes."""
+    permission_classes = [IsAdmin, ]
+
+    def get(self, request):
+        return Response(notification_dispatch.stats())